@@ -0,0 +1,151 @@
+# async_routes.py  async versions of the hot read endpoints (ASYNC_READS=true)
+# main.py includes this router before its own routes when async reads are
+# enabled, so these handlers take precedence over the sync ones with the same
+# paths; otherwise it is never mounted and nothing here opens a connection.
+import logging
+import traceback
+from datetime import date, datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+
+from app import crud, crud_async, models, schemas
+from app.dependencies import (
+    AsyncRequestContext,
+    get_async_request_context,
+    get_group_with_access_check_async,
+    verify_group_admin_async,
+)
+
+async_read_router = APIRouter(tags=["async reads"])
+
+
+@async_read_router.get("/groups/{group_id}/members", response_model=list[schemas.GroupMember])
+async def get_group_members(
+    group: models.Group = Depends(get_group_with_access_check_async),
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+):
+    """Get all members of a group (requires membership)."""
+    return await crud_async.get_group_members(ctx.db, group_id=group.id)
+
+
+@async_read_router.get(
+    "/groups/{group_id}/expenses",
+    response_model=List[schemas.ExpenseListItem],
+    response_model_exclude_unset=True,
+)
+async def read_group_expenses(
+    group_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=crud.EXPENSE_PAGE_MAX_LIMIT),
+    payer_id: Optional[int] = None,
+    participant_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    min_amount: Optional[int] = None,
+    max_amount: Optional[int] = None,
+    has_image: Optional[bool] = None,
+    fields: Optional[str] = None,
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+    group: models.Group = Depends(get_group_with_access_check_async),
+):
+    """
+    (US9) Retrieve the expenses of a group, newest first (same parameters as the sync route).
+    """
+    try:
+        items, next_cursor = await crud_async.get_group_expenses_page(
+            ctx.db, group_id, cursor=cursor, limit=limit, fields=fields,
+            payer_id=payer_id, participant_id=participant_id,
+            date_from=date_from, date_to=date_to,
+            min_amount=min_amount, max_amount=max_amount, has_image=has_image,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+
+@async_read_router.get("/groups/{group_id}/audit-logs", response_model=List[schemas.AuditLog])
+@async_read_router.get("/groups/{group_id}/audit-trail", response_model=List[schemas.AuditLog])
+async def read_audit_trail(
+    group_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=crud.AUDIT_PAGE_MAX_LIMIT),
+    page: Optional[int] = Query(None, ge=1),
+    action: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    archived: bool = False,
+    format: Optional[str] = None,
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+    group: models.Group = Depends(verify_group_admin_async),
+):
+    """Get the audit trail for a group (admins only; same parameters as the sync route)."""
+    filters = dict(action=action, user_id=user_id, since=since, until=until)
+    if format == "ndjson":
+        return StreamingResponse(
+            crud_async.iter_audit_logs_ndjson(group_id, archived=archived, **filters),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="group-{group_id}-audit.ndjson"'},
+        )
+    if format not in (None, "json"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    try:
+        logs, next_cursor = await crud_async.get_audit_logs_page(
+            ctx.db, group_id, cursor=cursor, limit=limit, page=page, archived=archived, **filters
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return logs
+
+
+@async_read_router.get("/groups/{group_id}/settlement", response_model=schemas.SettlementSummary)
+async def get_group_settlement(
+    group_id: int,
+    strategy: Optional[str] = None,
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+    group: models.Group = Depends(get_group_with_access_check_async),
+):
+    """获取群组结算汇总信息 (async)"""
+    try:
+        return await crud_async.get_group_settlement_summary(ctx.db, group_id, strategy=strategy)
+    except ValueError as e:
+        logging.error(f"ValueError in get_group_settlement for group {group_id}: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"获取群组结算信息失败 for group {group_id}: {e}")
+        logging.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="获取结算信息时发生错误")
+
+
+@async_read_router.get("/groups/{group_id}/settlement/member/{user_id}", response_model=schemas.SettlementBalance)
+async def get_member_settlement_balance(
+    group_id: int,
+    user_id: int,
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+    group: models.Group = Depends(get_group_with_access_check_async),
+):
+    """获取指定群组成员的结算余额详情 (async)"""
+    member = await ctx.get_member(group_id, user_id)
+    if not member:
+        raise HTTPException(status_code=404, detail="用户不是该群组成员")
+
+    try:
+        settlement_summary = await crud_async.get_group_settlement_summary(ctx.db, group_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"获取用户结算余额失败: {e}")
+        raise HTTPException(status_code=500, detail="获取用户余额时发生错误")
+
+    for balance in settlement_summary['balances']:
+        if balance['user_id'] == user_id:
+            return schemas.SettlementBalance(**balance)
+    raise HTTPException(status_code=404, detail="未找到该用户的余额信息")
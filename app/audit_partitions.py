@@ -0,0 +1,419 @@
+"""
+Month-partitioned audit log storage and retention archiving
+
+    python -m app.audit_partitions partition   convert audit_logs to monthly partitions (Postgres)
+    python -m app.audit_partitions maintain    create upcoming partitions / rotate shards, then archive
+    python -m app.audit_partitions status      list live months and archive files
+
+Postgres: audit_logs becomes a native RANGE (timestamp) partitioned table with
+one partition per UTC month (audit_logs_yYYYYmMM) plus a DEFAULT partition.
+`partition` is a one-off conversion that copies the rows under an exclusive
+lock; afterwards `maintain` keeps AUDIT_PARTITIONS_AHEAD future months created.
+
+SQLite has no partitioning, so audit_logs stays the hot table for the current
+month and `maintain` moves closed months into shard tables with the same name
+scheme and index (only when AUDIT_PARTITIONING=true).
+
+Retention: with AUDIT_RETENTION_MONTHS=N, months older than N are written to
+AUDIT_ARCHIVE_DIR/audit_logs_yYYYYmMM.ndjson.gz (one schemas.AuditLog per
+line, newest first) and their partition / shard is dropped. The audit trail
+reads shards transparently and archives with ?archived=true.
+"""
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+from itertools import islice
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import (
+    JSON, Column, DateTime, Integer, MetaData, String, Table, cast, inspect, literal, select, text,
+)
+
+from app import models, schemas
+from app.database import engine
+
+AUDIT_PARTITIONING = os.getenv("AUDIT_PARTITIONING", "false").lower() in ("1", "true", "yes")
+AUDIT_RETENTION_MONTHS = int(os.getenv("AUDIT_RETENTION_MONTHS", "0"))  # 0 keeps everything live
+AUDIT_PARTITIONS_AHEAD = int(os.getenv("AUDIT_PARTITIONS_AHEAD", "2"))
+AUDIT_ARCHIVE_DIR = os.getenv("AUDIT_ARCHIVE_DIR", "audit_archive")
+
+_MAINTENANCE_LOCK_KEY = 7412018
+_MONTH_TABLE_RE = re.compile(r"^audit_logs_y(\d{4})m(\d{2})$")
+
+logger = logging.getLogger("audit_partitions")
+
+
+# ----------- months -----------
+
+def add_months(year: int, month: int, delta: int):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+
+def current_month():
+    now = datetime.now(timezone.utc)
+    return now.year, now.month
+
+
+def month_table(year: int, month: int) -> str:
+    return f"audit_logs_y{year:04d}m{month:02d}"
+
+
+def month_bounds(year: int, month: int):
+    """[start, end) of a UTC month as 'YYYY-MM-DD HH:MM:SS' text (compares correctly on SQLite too)."""
+    next_year, next_month = add_months(year, month, 1)
+    return f"{year:04d}-{month:02d}-01 00:00:00", f"{next_year:04d}-{next_month:02d}-01 00:00:00"
+
+
+def archive_path(year: int, month: int) -> str:
+    return os.path.join(AUDIT_ARCHIVE_DIR, f"{month_table(year, month)}.ndjson.gz")
+
+
+def _months_in(names) -> List[tuple]:
+    months = []
+    for name in names:
+        match = _MONTH_TABLE_RE.match(name)
+        if match:
+            months.append((int(match.group(1)), int(match.group(2))))
+    return sorted(months)
+
+
+def live_month_tables(connection) -> List[tuple]:
+    """(year, month) of every Postgres partition / SQLite shard, oldest first."""
+    if connection.dialect.name == "postgresql":
+        names = connection.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'audit_logs'"
+        )).scalars().all()
+    else:
+        names = inspect(connection).get_table_names()
+    return _months_in(names)
+
+
+def archived_months() -> List[tuple]:
+    if not os.path.isdir(AUDIT_ARCHIVE_DIR):
+        return []
+    return _months_in(name[:-len(".ndjson.gz")] for name in os.listdir(AUDIT_ARCHIVE_DIR) if name.endswith(".ndjson.gz"))
+
+
+# ----------- Postgres native partitions -----------
+
+def is_partitioned(connection) -> bool:
+    if connection.dialect.name != "postgresql":
+        return False
+    return connection.execute(text("SELECT relkind FROM pg_class WHERE relname = 'audit_logs'")).scalar() == "p"
+
+
+def _create_partition(connection, year: int, month: int):
+    start, end = month_bounds(year, month)
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {month_table(year, month)} PARTITION OF audit_logs "
+        f"FOR VALUES FROM ('{start}+00') TO ('{end}+00')"
+    ))
+
+
+def ensure_partitions(connection, ahead: int = None):
+    """Creates the partitions from the current month to `ahead` months out."""
+    ahead = AUDIT_PARTITIONS_AHEAD if ahead is None else ahead
+    year, month = current_month()
+    for delta in range(ahead + 1):
+        _create_partition(connection, *add_months(year, month, delta))
+
+
+def partition_audit_logs():
+    """
+    One-off conversion of a plain Postgres audit_logs into a partitioned table.
+    Runs in one transaction holding an exclusive lock on audit_logs, so writers
+    wait (audit writes in buffered / outbox mode just queue up meanwhile).
+    """
+    with engine.begin() as connection:
+        if connection.dialect.name != "postgresql":
+            raise RuntimeError("native partitioning needs Postgres; on SQLite use AUDIT_PARTITIONING=true and `maintain`")
+        if is_partitioned(connection):
+            logger.info("audit_logs is already partitioned")
+            return
+        connection.execute(text("LOCK TABLE audit_logs IN ACCESS EXCLUSIVE MODE"))
+        # the partition key is part of the primary key, so it can't be NULL
+        connection.execute(text("UPDATE audit_logs SET timestamp = now() WHERE timestamp IS NULL"))
+        connection.execute(text(
+            "CREATE TABLE audit_logs_partitioned (LIKE audit_logs INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            "PARTITION BY RANGE (timestamp)"
+        ))
+        connection.execute(text("ALTER TABLE audit_logs_partitioned ALTER COLUMN timestamp SET NOT NULL"))
+        connection.execute(text("ALTER TABLE audit_logs_partitioned ADD PRIMARY KEY (id, timestamp)"))
+
+        oldest = connection.execute(text(
+            "SELECT date_trunc('month', MIN(timestamp) AT TIME ZONE 'UTC') FROM audit_logs"
+        )).scalar()
+        year, month = current_month()
+        first = (oldest.year, oldest.month) if oldest else (year, month)
+        count = (year * 12 + month) - (first[0] * 12 + first[1]) + AUDIT_PARTITIONS_AHEAD + 1
+        for delta in range(count):
+            start, end = month_bounds(*add_months(*first, delta))
+            connection.execute(text(
+                f"CREATE TABLE {month_table(*add_months(*first, delta))} PARTITION OF audit_logs_partitioned "
+                f"FOR VALUES FROM ('{start}+00') TO ('{end}+00')"
+            ))
+        connection.execute(text("CREATE TABLE audit_logs_default PARTITION OF audit_logs_partitioned DEFAULT"))
+
+        connection.execute(text("INSERT INTO audit_logs_partitioned SELECT * FROM audit_logs"))
+        connection.execute(text("ALTER SEQUENCE audit_logs_id_seq OWNED BY audit_logs_partitioned.id"))
+        connection.execute(text("DROP TABLE audit_logs"))
+        connection.execute(text("ALTER TABLE audit_logs_partitioned RENAME TO audit_logs"))
+        connection.execute(text("ALTER TABLE audit_logs ADD FOREIGN KEY (group_id) REFERENCES groups (id)"))
+        connection.execute(text("ALTER TABLE audit_logs ADD FOREIGN KEY (user_id) REFERENCES users (id)"))
+        # created on the parent, so every current and future partition gets them
+        connection.execute(text("CREATE INDEX ix_audit_logs_id ON audit_logs (id)"))
+        connection.execute(text(
+            "CREATE INDEX ix_audit_logs_group_timestamp_id ON audit_logs (group_id, timestamp DESC, id DESC)"
+        ))
+    logger.info(f"audit_logs partitioned by month starting {first[0]:04d}-{first[1]:02d}")
+
+
+# ----------- SQLite shards -----------
+
+def _shard_table(name: str) -> Table:
+    return Table(
+        name, MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("group_id", Integer, nullable=False),
+        Column("user_id", Integer, nullable=False),
+        Column("timestamp", DateTime(timezone=True)),
+        Column("action", String, nullable=False),
+        Column("details", JSON),
+    )
+
+
+def rotate_sqlite(connection):
+    """Moves every closed month out of audit_logs into its shard table."""
+    current_start, _ = month_bounds(*current_month())
+    months = connection.execute(text(
+        "SELECT DISTINCT substr(timestamp, 1, 7) FROM audit_logs WHERE timestamp < :start"
+    ), {"start": current_start}).scalars().all()
+    for value in sorted(months):
+        year, month = int(value[:4]), int(value[5:7])
+        name = month_table(year, month)
+        start, end = month_bounds(year, month)
+        _shard_table(name).create(connection, checkfirst=True)
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_{name}_group_timestamp_id ON {name} (group_id, timestamp DESC, id DESC)"
+        ))
+        moved = connection.execute(text(
+            f"INSERT INTO {name} (id, group_id, user_id, timestamp, action, details) "
+            "SELECT id, group_id, user_id, timestamp, action, details FROM audit_logs "
+            "WHERE timestamp >= :start AND timestamp < :end"
+        ), {"start": start, "end": end}).rowcount
+        connection.execute(text("DELETE FROM audit_logs WHERE timestamp >= :start AND timestamp < :end"),
+                           {"start": start, "end": end})
+        logger.info(f"audit: moved {moved} rows of {year:04d}-{month:02d} to {name}")
+
+
+# ----------- retention -----------
+
+def _row_user(row) -> Optional[schemas.User]:
+    """The user of a shard row outer joined with users; None once the user is deleted."""
+    if row.email is None:
+        return None
+    return schemas.User(id=row.user_id, email=row.email, username=row.username)
+
+
+def archive_month(year: int, month: int) -> int:
+    """
+    Writes one month's partition / shard to a gzip NDJSON file and drops it.
+    The file is complete (written to a temp name, then renamed) before the
+    table goes away, so an interrupted run is simply repeated.
+    """
+    name = month_table(year, month)
+    table = _shard_table(name)
+    users = models.User.__table__
+    path = archive_path(year, month)
+    os.makedirs(AUDIT_ARCHIVE_DIR, exist_ok=True)
+
+    with engine.begin() as connection:
+        query = (
+            select(table, users.c.email, users.c.username)
+            .join(users, users.c.id == table.c.user_id, isouter=True)
+            .order_by(table.c.timestamp.desc(), table.c.id.desc())
+        )
+        rows = 0
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as archive:
+            for row in connection.execute(query.execution_options(yield_per=1000)):
+                log = schemas.AuditLog(
+                    id=row.id, group_id=row.group_id, user_id=row.user_id, timestamp=row.timestamp,
+                    action=row.action, details=row.details,
+                    user=_row_user(row),
+                )
+                archive.write(log.model_dump_json() + "\n")
+                rows += 1
+        os.replace(path + ".tmp", path)
+        if connection.dialect.name == "postgresql":
+            connection.execute(text(f"ALTER TABLE audit_logs DETACH PARTITION {name}"))
+        connection.execute(text(f"DROP TABLE {name}"))
+    logger.info(f"audit: archived {rows} rows of {year:04d}-{month:02d} to {path}")
+    return rows
+
+
+def apply_retention(retention_months: int = None) -> List[tuple]:
+    """Archives every live month older than the retention window; returns the months archived."""
+    retention_months = AUDIT_RETENTION_MONTHS if retention_months is None else retention_months
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(*current_month(), -retention_months)
+    with engine.connect() as connection:
+        expired = [month for month in live_month_tables(connection) if month < cutoff]
+    for month in expired:
+        archive_month(*month)
+    return expired
+
+
+def run_maintenance():
+    """Daily job: keep future partitions (Postgres) / rotate shards (SQLite), then apply retention."""
+    with engine.connect() as lock_connection:
+        # several app processes schedule this job; one of them does the work
+        if lock_connection.dialect.name == "postgresql" and not lock_connection.execute(
+            text("SELECT pg_try_advisory_lock(:k)"), {"k": _MAINTENANCE_LOCK_KEY}
+        ).scalar():
+            return
+        try:
+            with engine.begin() as connection:
+                if is_partitioned(connection):
+                    ensure_partitions(connection)
+                elif connection.dialect.name == "sqlite" and AUDIT_PARTITIONING:
+                    rotate_sqlite(connection)
+                elif AUDIT_PARTITIONING:
+                    logger.warning("AUDIT_PARTITIONING is set but audit_logs is not partitioned; "
+                                   "run `python -m app.audit_partitions partition`")
+            apply_retention()
+        finally:
+            if lock_connection.dialect.name == "postgresql":
+                lock_connection.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _MAINTENANCE_LOCK_KEY})
+
+
+# ----------- reads of shards and archives (used by crud.get_audit_logs_page) -----------
+
+def _timestamp_key(value) -> datetime:
+    """Naive UTC datetime for ordering rows from different storage tiers."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def read_shards(db, group_id: int, after: Optional[tuple], limit: Optional[int], action: Optional[str] = None,
+                user_id: Optional[int] = None, since=None, until=None) -> List[tuple]:
+    """
+    Rows from the SQLite shard tables, newest first, as (schemas.AuditLog, stored
+    timestamp text). `after` is the decoded (timestamp text, id) cursor.
+    """
+    if db.bind.dialect.name != "sqlite":
+        return []
+    users = models.User.__table__
+    results = []
+    for year, month in reversed(live_month_tables(db.connection())):
+        if limit is not None and len(results) >= limit:
+            break
+        table = _shard_table(month_table(year, month))
+        # outer join: the rows of deleted users stay in the trail, like in the archive files
+        query = (
+            select(table, cast(table.c.timestamp, String).label("stored_timestamp"), users.c.email, users.c.username)
+            .join(users, users.c.id == table.c.user_id, isouter=True)
+            .where(table.c.group_id == group_id)
+        )
+        if action:
+            query = query.where(table.c.action.in_([item.strip() for item in action.split(",") if item.strip()]))
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        if since is not None:
+            query = query.where(table.c.timestamp >= since)
+        if until is not None:
+            query = query.where(table.c.timestamp < until)
+        if after:
+            bound = literal(after[0], String)
+            query = query.where((table.c.timestamp < bound) | ((table.c.timestamp == bound) & (table.c.id < after[1])))
+        query = query.order_by(table.c.timestamp.desc(), table.c.id.desc())
+        if limit is not None:
+            query = query.limit(limit - len(results))
+        results += db.execute(query).all()
+    return [
+        (schemas.AuditLog(id=row.id, group_id=row.group_id, user_id=row.user_id, timestamp=row.timestamp,
+                          action=row.action, details=row.details,
+                          user=_row_user(row)),
+         row.stored_timestamp)
+        for row in results
+    ]
+
+
+def iter_shards(db, group_id: int, batch: int, **filters):
+    """read_shards in keyset batches of `batch` rows, so an export never holds every shard row."""
+    after = None
+    while True:
+        rows = read_shards(db, group_id, after, batch, **filters)
+        yield from rows
+        if len(rows) < batch:
+            return
+        log, stored_timestamp = rows[-1]
+        after = (stored_timestamp, log.id)
+
+
+def iter_archives(group_id: int, after: Optional[tuple] = None, action: Optional[str] = None,
+                  user_id: Optional[int] = None, since=None, until=None):
+    """Rows from the archive files, newest first. Each month file is scanned in full."""
+    actions = {item.strip() for item in action.split(",") if item.strip()} if action else None
+    after_key = (_timestamp_key(after[0]), after[1]) if after else None
+    since_key = _timestamp_key(since) if since is not None else None
+    until_key = _timestamp_key(until) if until is not None else None
+    for year, month in reversed(archived_months()):
+        if since_key and (year, month) < (since_key.year, since_key.month):
+            return
+        with gzip.open(archive_path(year, month), "rt", encoding="utf-8") as archive:
+            for line in archive:
+                record = json.loads(line)
+                if record["group_id"] != group_id:
+                    continue
+                if record.get("user") and not record["user"].get("email"):
+                    record["user"] = None  # written for a deleted user by older versions
+                if actions and record["action"] not in actions:
+                    continue
+                if user_id is not None and record["user_id"] != user_id:
+                    continue
+                key = (_timestamp_key(record["timestamp"]), record["id"])
+                if after_key and key >= after_key:
+                    continue
+                if since_key and key[0] < since_key:
+                    return  # files and their lines are ordered newest first
+                if until_key and key[0] >= until_key:
+                    continue
+                yield schemas.AuditLog.model_validate(record)
+
+
+def read_archives(group_id: int, after: Optional[tuple], limit: Optional[int], **filters) -> List[schemas.AuditLog]:
+    return list(islice(iter_archives(group_id, after, **filters), limit))
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    command = (argv if argv is not None else sys.argv[1:] or ["status"])[0]
+    if command == "partition":
+        partition_audit_logs()
+    elif command == "maintain":
+        run_maintenance()
+    elif command == "status":
+        with engine.connect() as connection:
+            live = live_month_tables(connection)
+            partitioned = is_partitioned(connection)
+        print(f"partitioned: {partitioned}")
+        print("live months: " + (", ".join(f"{y:04d}-{m:02d}" for y, m in live) or "-"))
+        print("archived months: " + (", ".join(f"{y:04d}-{m:02d}" for y, m in archived_months()) or "-"))
+    else:
+        print(__doc__)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# audit_writer.py  opt-in audit log pipeline (AUDIT_LOG_MODE)
+#
+#   sync      (default) crud.create_audit_log adds an AuditLog row to the
+#             business transaction, as before
+#   buffered  details are serialized once to compact JSON and the entry is
+#             queued when the business transaction commits (dropped on
+#             rollback); a background thread writes the queue to audit_logs
+#             in multi-row INSERTs every AUDIT_FLUSH_SIZE entries or
+#             AUDIT_FLUSH_INTERVAL_MS. Entries still queued when the process
+#             dies are lost.
+#   outbox    the entry goes to the narrow, unindexed audit_outbox table inside
+#             the business transaction (atomic with it); a background thread
+#             moves outbox rows to audit_logs in batches
+#
+# In the two asynchronous modes new entries show up in the audit trail after
+# at most one flush interval.
+import json
+import logging
+import os
+import queue
+import threading
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import exc, DateTime, Integer, String, Text, column, delete, event, insert, select, table
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import engine
+
+AUDIT_LOG_MODE = os.getenv("AUDIT_LOG_MODE", "sync").lower()  # sync | buffered | outbox
+AUDIT_FLUSH_SIZE = int(os.getenv("AUDIT_FLUSH_SIZE", "200"))
+AUDIT_FLUSH_INTERVAL_MS = int(os.getenv("AUDIT_FLUSH_INTERVAL_MS", "500"))
+# queue bound; producers block (backpressure) when the writer falls this far behind
+AUDIT_BUFFER_MAX = int(os.getenv("AUDIT_BUFFER_MAX", "10000"))
+
+if AUDIT_LOG_MODE not in ("sync", "buffered", "outbox"):
+    raise ValueError(f"AUDIT_LOG_MODE must be sync, buffered or outbox, not {AUDIT_LOG_MODE!r}")
+
+logger = logging.getLogger("audit_writer")
+
+# audit_logs as a plain table with `details` typed as text, so the compact JSON
+# built at enqueue time is inserted as-is instead of being encoded again by the
+# JSON column type
+_audit_rows = table(
+    "audit_logs",
+    column("group_id", Integer),
+    column("user_id", Integer),
+    column("action", String),
+    column("details", Text),
+    column("timestamp", DateTime(timezone=True)),
+)
+
+_PENDING_KEY = "pending_audit_entries"
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    try:
+        return jsonable_encoder(obj)
+    except Exception:
+        return repr(obj)
+
+
+def serialize_details(details: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Details as compact JSON in a single pass; unknown objects go through jsonable_encoder."""
+    if details is None:
+        return None
+    try:
+        return json.dumps(details, default=_json_default, separators=(",", ":"))
+    except (TypeError, ValueError) as e:
+        logger.error(f"AUDIT LOG: Could not serialize details: {e}")
+        return json.dumps({"error": f"Serialization failed: {e}", "raw_details_type": str(type(details))})
+
+
+def enabled() -> bool:
+    return AUDIT_LOG_MODE != "sync"
+
+
+def record(db: Session, *, group_id: int, user_id: int, action: str, details: Optional[Dict[str, Any]] = None):
+    """Asynchronous-mode counterpart of crud.create_audit_log; the caller commits as usual."""
+    details_json = serialize_details(details)
+    now = datetime.now(timezone.utc)
+    if AUDIT_LOG_MODE == "outbox":
+        entry = models.AuditOutbox(group_id=group_id, user_id=user_id, action=action,
+                                   details=details_json, created_at=now)
+        db.add(entry)
+        return entry
+    entry = {"group_id": group_id, "user_id": user_id, "action": action, "details": details_json, "timestamp": now}
+    if not db.in_transaction():
+        db.begin()  # so a rollback before anything is flushed still discards the entry
+    db.info.setdefault(_PENDING_KEY, []).append(entry)
+    return entry
+
+
+# ----------- buffered mode: hand entries over on commit -----------
+
+@event.listens_for(Session, "after_commit")
+def _enqueue_committed(session):
+    entries = session.info.pop(_PENDING_KEY, None)
+    if entries:
+        _writer.enqueue(entries)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_rolled_back(session, previous_transaction):
+    # also fires when nothing was flushed yet; a savepoint rollback keeps the outer entries
+    if not previous_transaction.nested:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _insert_rows(connection, rows):
+    for start in range(0, len(rows), AUDIT_FLUSH_SIZE):
+        connection.execute(insert(_audit_rows).values(rows[start:start + AUDIT_FLUSH_SIZE]))
+
+
+def _insert_rows_one_by_one(rows):
+    """Fallback after a failed batch: writes rows separately and drops the ones that
+    cannot be stored (e.g. their group was deleted meanwhile) so they don't block the rest.
+    Any other database error (e.g. a lost connection) is raised with the rows handled
+    so far removed from `rows`, so the caller retries exactly the unwritten ones."""
+    for index, row in enumerate(rows):
+        try:
+            with engine.begin() as connection:
+                connection.execute(insert(_audit_rows).values(row))
+        except exc.IntegrityError as e:
+            logger.error(f"AUDIT LOG: dropping entry {row['action']} for group {row['group_id']}: {e.orig}")
+        except exc.SQLAlchemyError:
+            del rows[:index]
+            raise
+
+
+class _Worker(ABC):
+    """Background thread that runs `flush()` every AUDIT_FLUSH_INTERVAL_MS or when woken."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread after a final flush."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(AUDIT_FLUSH_INTERVAL_MS / 1000)
+            self._wake.clear()
+            self._flush_safely()
+        self._flush_safely()
+
+    def _flush_safely(self):
+        try:
+            while self.flush() >= AUDIT_FLUSH_SIZE:
+                pass  # keep going while full batches come back
+        except Exception:
+            logger.exception(f"{self.name}: flush failed, retrying on the next interval")
+
+    @abstractmethod
+    def flush(self) -> int:
+        """Writes one batch; returns how many entries it handled."""
+
+
+class BufferedAuditWriter(_Worker):
+
+    def __init__(self):
+        super().__init__("audit-writer")
+        self._queue = queue.Queue(maxsize=AUDIT_BUFFER_MAX)
+        self._retry = []
+
+    def enqueue(self, entries):
+        for entry in entries:
+            self._queue.put(entry)
+        if self._queue.qsize() >= AUDIT_FLUSH_SIZE:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """Writes up to AUDIT_FLUSH_SIZE queued entries in one transaction; returns how many."""
+        rows, self._retry = self._retry, []
+        while len(rows) < AUDIT_FLUSH_SIZE:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return 0
+        count = len(rows)
+        try:
+            try:
+                with engine.begin() as connection:
+                    _insert_rows(connection, rows)
+            except exc.IntegrityError:
+                _insert_rows_one_by_one(rows)
+        except Exception:
+            self._retry = rows  # keep the unwritten ones for the next attempt
+            raise
+        return count
+
+
+class OutboxDrainer(_Worker):
+
+    def __init__(self):
+        super().__init__("audit-outbox-drainer")
+
+    def flush(self) -> int:
+        """Moves the oldest AUDIT_FLUSH_SIZE outbox rows to audit_logs; returns how many."""
+        try:
+            with engine.begin() as connection:
+                pending = self._claim(connection, limit=AUDIT_FLUSH_SIZE)
+                if pending:
+                    self._move(connection, pending)
+            return len(pending)
+        except exc.IntegrityError:
+            pass
+        # a row of the batch cannot be stored: move the rows one at a time instead
+        for row_id in [row.id for row in pending]:
+            try:
+                with engine.begin() as connection:
+                    self._move(connection, self._claim(connection, row_id=row_id))
+            except exc.IntegrityError as e:
+                logger.error(f"AUDIT LOG: dropping outbox entry {row_id}: {e.orig}")
+                with engine.begin() as connection:
+                    connection.execute(delete(self._outbox).where(self._outbox.c.id == row_id))
+        return len(pending)
+
+    @property
+    def _outbox(self):
+        return models.AuditOutbox.__table__
+
+    def _claim(self, connection, limit: int = None, row_id: int = None):
+        query = select(self._outbox).order_by(self._outbox.c.id)
+        query = query.where(self._outbox.c.id == row_id) if row_id is not None else query.limit(limit)
+        # SKIP LOCKED lets several app processes drain concurrently on Postgres
+        return connection.execute(query.with_for_update(skip_locked=True)).all()
+
+    def _move(self, connection, pending):
+        if not pending:
+            return
+        _insert_rows(connection, [
+            {"group_id": row.group_id, "user_id": row.user_id, "action": row.action,
+             "details": row.details, "timestamp": row.created_at}
+            for row in pending
+        ])
+        connection.execute(delete(self._outbox).where(self._outbox.c.id.in_([row.id for row in pending])))
+
+
+_writer = BufferedAuditWriter()
+_drainer = OutboxDrainer()
+
+
+def start():
+    """Starts the background writer for the configured mode (no-op in sync mode)."""
+    if AUDIT_LOG_MODE == "buffered":
+        _writer.start()
+    elif AUDIT_LOG_MODE == "outbox":
+        _drainer.start()
+
+
+def stop():
+    """Flushes what is pending and stops the background writer."""
+    _writer.stop()
+    _drainer.stop()
+
+
+def flush():
+    """Synchronously writes everything pending (used by scripts and at shutdown)."""
+    _writer._flush_safely()
+    _drainer._flush_safely()
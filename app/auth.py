@@ -1,9 +1,13 @@
 from passlib.context import CryptContext
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import Depends, HTTPException, status
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
+import asyncio
+import os
+import threading
 from sqlalchemy.orm import Session
 
 from . import schemas, crud, database
@@ -27,6 +31,50 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+# ----------- bcrypt off the event loop -----------
+# bcrypt costs ~100-300 ms of CPU per call. Async routes hand it to a bounded
+# pool so the event loop (and the APScheduler jobs sharing it) keeps running;
+# PASSWORD_HASH_WORKERS caps how many hashes run at once, extra logins queue.
+# bcrypt releases the GIL, so threads scale across cores; "process" is there
+# for hashers that don't.
+PASSWORD_HASH_POOL = os.getenv("PASSWORD_HASH_POOL", "thread").lower()
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_password_pool: Optional[Executor] = None
+_password_pool_lock = threading.Lock()
+
+
+def _get_password_pool() -> Executor:
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            if PASSWORD_HASH_POOL == "process":
+                _password_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+            else:
+                _password_pool = ThreadPoolExecutor(
+                    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+                )
+        return _password_pool
+
+
+def shutdown_password_pool():
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is not None:
+            _password_pool.shutdown(wait=False, cancel_futures=True)
+            _password_pool = None
+
+
+async def get_password_hash_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_password_pool(), get_password_hash, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_password_pool(), verify_password, plain_password, hashed_password)
+
+
 def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
     user = crud.get_user_by_email(db, email=email)
 
@@ -38,6 +86,22 @@ def authenticate_user(db: Session, email: str, password: str) -> Optional[User]:
     return user
 
 
+async def authenticate_user_async(db: Session, email: str, password: str) -> Optional[User]:
+    """authenticate_user for async routes: the bcrypt check runs in the password pool."""
+    user = crud.get_user_by_email(db, email=email)
+
+    if not user:
+        return None
+    # give the connection back before waiting on bcrypt, otherwise a burst of
+    # logins holds every pooled connection; the detached user keeps its loaded columns
+    db.expunge(user)
+    db.rollback()
+    if not await verify_password_async(password, user.hashed_password):
+        return None
+
+    return user
+
+
 # def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
 
 #     to_encode = data.copy()
@@ -1,6 +1,6 @@
 from fastapi import HTTPException, status, Depends, UploadFile
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import insert, delete
+from sqlalchemy.orm import Session, joinedload, selectinload, load_only
+from sqlalchemy import insert, delete, select, update, literal, cast, String
 from passlib.context import CryptContext
 from typing import Optional, List, Dict, Set, Any
 from collections import defaultdict
@@ -9,14 +9,35 @@ from decimal import Decimal
 import logging
 import json
 import traceback # 导入 traceback
+import base64
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
-from app import models, schemas, auth
+from app import models, schemas, auth, audit_writer, audit_partitions, uploads, recurring_leases
+from app.database import SessionLocal
+try:
+    from app import settlement_numpy  # optional vectorized engine, needs numpy
+except ImportError:
+    settlement_numpy = None
 from fastapi.encoders import jsonable_encoder
 # --- for img 03 Nov ------
-import uuid  # 🚨 新增：用于生成唯一文件名
-import shutil # 🚨 新增：用于将文件流写入磁盘
 import os     # 🚨 新增：用于创建文件夹
+import time
+
+# --- settlement balance computation ---
+# "ledger": read the incrementally maintained group_member_balances rows
+# "sql":    aggregate the history in one grouped SQL statement
+# "python": hydrate expenses / payments and sum them in Python (reference path)
+# "numpy":  load (user_id, amount) columns and sum them with NumPy (optional dependency)
+SETTLEMENT_BALANCE_MODES = ("ledger", "sql", "python", "numpy")
+SETTLEMENT_BALANCE_MODE = os.getenv("SETTLEMENT_BALANCE_MODE", "ledger")
+# Recompute with the Python path as well and log any mismatch
+SETTLEMENT_BALANCE_CROSSCHECK = os.getenv("SETTLEMENT_BALANCE_CROSSCHECK", "false").lower() in ("1", "true", "yes")
+
+# --- settlement transaction strategy (see generate_settlement_transactions) ---
+SETTLEMENT_STRATEGY = os.getenv("SETTLEMENT_STRATEGY", "greedy")
+# "exact" is exponential in the number of unsettled members; above this it falls back to "heuristic"
+SETTLEMENT_EXACT_MAX_MEMBERS = int(os.getenv("SETTLEMENT_EXACT_MAX_MEMBERS", "14"))
+SETTLEMENT_HEURISTIC_TIME_BUDGET_MS = int(os.getenv("SETTLEMENT_HEURISTIC_TIME_BUDGET_MS", "200"))
 
 # ----------- User CRUD -----------
 def get_user_by_email(db: Session, email: str):
@@ -27,8 +48,10 @@ def get_user_by_id(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = auth.get_password_hash(user.password)
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: Optional[str] = None):
+    """`hashed_password` lets async callers hash in auth's password pool first."""
+    if hashed_password is None:
+        hashed_password = auth.get_password_hash(user.password)
     db_user = models.User(
         email=user.email, username=user.username, hashed_password=hashed_password
     )
@@ -278,12 +301,12 @@ def get_pending_invitations_for_user(db: Session, user_id: int) -> List[models.G
 
 
 # ----------- Expense CRUD (US7, US9) -----------
-def _create_splits(db: Session, expense: models.Expense, splits_in: List[schemas.ExpenseSplitCreate], split_type: str):
+def _calculate_split_amounts(expense_amount_cents: int, splits_in: List[schemas.ExpenseSplitCreate], split_type: str) -> List[tuple]:
     """
-    Internal helper function to create expense splits for a given expense.
+    (user_id, amount_cents) for each split of an expense of `expense_amount_cents`.
+    Raises ValueError when the splits cannot cover the amount.
     """
-    db_splits = []
-    expense_amount_cents = expense.amount # amount 现在是整数 (美分)
+    split_amounts = []
 
     if split_type == "equal":
         member_count = len(splits_in)
@@ -294,59 +317,54 @@ def _create_splits(db: Session, expense: models.Expense, splits_in: List[schemas
         equal_amount_cents = expense_amount_cents // member_count
         remainder_cents = expense_amount_cents % member_count
 
-        total_cents_allocated = 0
-
         for i, split in enumerate(splits_in):
             amount_cents = equal_amount_cents
             if i < remainder_cents:
                 # 将余下的美分分配给前几个成员
                 amount_cents += 1
+            split_amounts.append((split.user_id, amount_cents))
 
-            total_cents_allocated += amount_cents
-
-            db_split = models.ExpenseSplit(
-                expense_id=expense.id,
-                user_id=split.user_id,
-                amount=amount_cents,
-                balance=amount_cents, # 初始余额
-                share_type="equal"
-            )
-            db.add(db_split)
-            db_splits.append(db_split)
-
+        total_cents_allocated = sum(amount for _, amount in split_amounts)
         if total_cents_allocated != expense_amount_cents:
              # 安全检查，理论上不应发生
-             logging.warning(f"Equal split total ({total_cents_allocated}) does not match expense amount ({expense_amount_cents}) for expense {expense.id}")
+             logging.warning(f"Equal split total ({total_cents_allocated}) does not match expense amount ({expense_amount_cents})")
 
     elif split_type == "custom":
-        total_provided_cents = 0
         for split in splits_in:
             if split.amount is None:
                 raise ValueError(f"Amount is required for user {split.user_id} in custom split")
-
             # amount 现在是整数 (美分)
-            split_amount_cents = split.amount
-            total_provided_cents += split_amount_cents
-
-            db_split = models.ExpenseSplit(
-                expense_id=expense.id,
-                user_id=split.user_id,
-                amount=split_amount_cents,
-                balance=split_amount_cents, # 初始余额
-                share_type="custom"
-            )
-            db.add(db_split)
-            db_splits.append(db_split)
+            split_amounts.append((split.user_id, split.amount))
 
+        total_provided_cents = sum(amount for _, amount in split_amounts)
         if total_provided_cents != expense_amount_cents:
-             logging.error(f"Critical: Custom split sum ({total_provided_cents}) does not match expense amount ({expense_amount_cents}) for expense {expense.id}.")
+             logging.error(f"Critical: Custom split sum ({total_provided_cents}) does not match expense amount ({expense_amount_cents}).")
              raise ValueError("Custom split sum does not match expense amount")
 
+    return split_amounts
+
+
+def _create_splits(db: Session, expense: models.Expense, splits_in: List[schemas.ExpenseSplitCreate], split_type: str):
+    """
+    Internal helper function to create expense splits for a given expense.
+    """
+    db_splits = []
+    for user_id, amount_cents in _calculate_split_amounts(expense.amount, splits_in, split_type): # amount 现在是整数 (美分)
+        db_split = models.ExpenseSplit(
+            expense_id=expense.id,
+            user_id=user_id,
+            amount=amount_cents,
+            balance=amount_cents, # 初始余额
+            share_type=split_type
+        )
+        db.add(db_split)
+        db_splits.append(db_split)
+
     return db_splits
 
 
 #def create_expense(db: Session, group_id: int, creator_id: int, expense: schemas.ExpenseCreateWithSplits) -> Dict:
-def create_expense(db: Session, group_id: int, creator_id: int, expense: schemas.ExpenseCreateWithSplits, image_file: Optional[UploadFile] = None) -> Dict:
+def create_expense(db: Session, group_id: int, creator_id: int, expense: schemas.ExpenseCreateWithSplits, upload: Optional[uploads.StoredUpload] = None) -> Dict:
     """Create a new expense and its splits within a group."""
 # ---------------------- change date 03 Nov ------------------   
     if expense.date is not None and isinstance(expense.date, str):
@@ -364,32 +382,12 @@ def create_expense(db: Session, group_id: int, creator_id: int, expense: schemas
         expense_date = expense.date
 # --------------------- end -----------------------------------#
 # ------------- add for img 03 Nov ----------------------------#
-# 🚨 新增：文件上传和 URL 处理逻辑
-    image_url = None
-    if image_file and image_file.filename:
-        # 1. 设置存储目录 (app/static/uploads)
-        upload_dir = "app/static/uploads"
-        os.makedirs(upload_dir, exist_ok=True) # 确保目录存在
-        
-        # 2. 生成唯一文件名 (保留原始后缀)
-        file_extension = os.path.splitext(image_file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_location = os.path.join(upload_dir, unique_filename)
-
-        try:
-            # 3. 将文件内容写入磁盘
-            with open(file_location, "wb") as file_object:
-                shutil.copyfileobj(image_file.file, file_object)
-            
-            # 4. 设置公共访问 URL (对应 main1.py 中的 app.mount("/static", ...))
-            image_url = f"/static/uploads/{unique_filename}"
-            logging.info(f"Successfully saved file to: {file_location}")
-        except Exception as e:
-            logging.error(f"Failed to save uploaded file '{image_file.filename}': {e}")
-            image_file.file.close() # 确保关闭文件流
-            # 如果文件保存失败，不影响费用创建，但 image_url 为 None
-    # 🚨 结束文件上传处理
+    # the file was published to storage before the transaction started (app/uploads.py);
+    # here its stored_files row is only claimed
+    image_url = uploads.attach_to_transaction(db, upload) if upload else None
 # -------------------- END -----------------------------------
+    _ensure_group_balance_ledger(db, group_id)
+
     db_expense = models.Expense(
         description=expense.description,
         amount=expense.amount,
@@ -418,6 +416,8 @@ def create_expense(db: Session, group_id: int, creator_id: int, expense: schemas
         # Re-raise as HTTPException for the API layer
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
+    _apply_balance_deltas(db, group_id, _expense_balance_deltas(db_expense.payer_id, db_expense.amount, db_splits))
+
     original_input_log = jsonable_encoder(expense)
     calculated_splits_for_log = [jsonable_encoder(s) for s in db_splits]
 
@@ -457,6 +457,141 @@ def get_group_expenses(db: Session, group_id: int) -> List[models.Expense]:
     ).filter(models.Expense.group_id == group_id).order_by(models.Expense.date.desc(), models.Expense.id.desc()).all()
 
 
+# ----------- Paginated expense listing -----------
+# Keyset pagination on (date DESC, id DESC), served by ix_expenses_group_date_id.
+# The cursor is the (date, id) of the last row of the previous page.
+
+EXPENSE_PAGE_MAX_LIMIT = 200
+EXPENSE_LIST_FIELDS = (
+    "id", "description", "amount", "payer_id", "image_url", "thumbnail_url", "display_url",
+    "group_id", "creator_id", "date", "split_type", "splits",
+)
+
+
+def encode_expense_cursor(expense_date: Optional[date], expense_id: int) -> str:
+    raw = f"{expense_date.isoformat() if expense_date else ''}|{expense_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_expense_cursor(cursor: str):
+    """Returns (date or None, id); raises ValueError for a malformed cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        date_part, id_part = raw.split("|")
+        return (date.fromisoformat(date_part) if date_part else None), int(id_part)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _parse_expense_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in EXPENSE_LIST_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(EXPENSE_LIST_FIELDS)}")
+    return requested
+
+
+def build_group_expenses_query(
+    group_id: int,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    payer_id: Optional[int] = None,
+    participant_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    min_amount: Optional[int] = None,
+    max_amount: Optional[int] = None,
+    has_image: Optional[bool] = None,
+    fields: Optional[List[str]] = None,
+    nulls_first: bool = False,
+):
+    """
+    SELECT for one page of a group's expenses, shared by the sync and async
+    listings. Fetches limit + 1 rows so the caller can tell whether another
+    page exists. Only the projected columns are loaded, and splits are
+    selectin-loaded only when `fields` is None (full rows) or lists "splits".
+    `nulls_first` tells where the dialect sorts NULL dates under DESC (Postgres: first).
+    """
+    Expense = models.Expense
+    query = select(Expense).where(Expense.group_id == group_id)
+
+    if payer_id is not None:
+        query = query.where(Expense.payer_id == payer_id)
+    if participant_id is not None:
+        query = query.where(
+            select(models.ExpenseSplit.id).where(
+                models.ExpenseSplit.expense_id == Expense.id,
+                models.ExpenseSplit.user_id == participant_id,
+            ).exists()
+        )
+    if date_from is not None:
+        query = query.where(Expense.date >= date_from)
+    if date_to is not None:
+        query = query.where(Expense.date <= date_to)
+    if min_amount is not None:
+        query = query.where(Expense.amount >= min_amount)
+    if max_amount is not None:
+        query = query.where(Expense.amount <= max_amount)
+    if has_image is not None:
+        has_image_clause = (Expense.image_url.isnot(None)) & (Expense.image_url != "")
+        query = query.where(has_image_clause if has_image else ~has_image_clause)
+
+    if cursor:
+        cursor_date, cursor_id = decode_expense_cursor(cursor)
+        if cursor_date is None:
+            # still inside the NULL-date block
+            after = (Expense.date.is_(None)) & (Expense.id < cursor_id)
+            if nulls_first:
+                after = after | Expense.date.isnot(None)
+        else:
+            after = (Expense.date < cursor_date) | ((Expense.date == cursor_date) & (Expense.id < cursor_id))
+            if not nulls_first:
+                after = after | Expense.date.is_(None)
+        query = query.where(after)
+
+    if fields is not None:
+        columns = {"id", "date"} | {field for field in fields if field != "splits"}
+        query = query.options(load_only(*(getattr(Expense, column) for column in columns)))
+    if fields is None or "splits" in fields:
+        query = query.options(selectinload(Expense.splits))
+
+    query = query.order_by(Expense.date.desc(), Expense.id.desc())
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
+
+
+def paginate_expenses(expenses: List[models.Expense], limit: Optional[int], fields: Optional[List[str]]):
+    """Trims the extra row fetched by build_group_expenses_query; returns (items, next_cursor)."""
+    next_cursor = None
+    if limit is not None and len(expenses) > limit:
+        expenses = expenses[:limit]
+        last = expenses[-1]
+        next_cursor = encode_expense_cursor(last.date, last.id)
+    if fields is None:
+        return expenses, next_cursor
+    return [{field: getattr(expense, field) for field in fields} for expense in expenses], next_cursor
+
+
+def get_group_expenses_page(db: Session, group_id: int, fields: Optional[str] = None, limit: Optional[int] = None, **filters):
+    """
+    One page of a group's expenses, newest first; see build_group_expenses_query
+    for the filters. Returns (items, next_cursor); next_cursor is None on the last page.
+    Without `limit` every matching expense is returned.
+    """
+    if limit is not None and not 1 <= limit <= EXPENSE_PAGE_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {EXPENSE_PAGE_MAX_LIMIT}")
+    field_list = _parse_expense_fields(fields)
+    query = build_group_expenses_query(
+        group_id, limit=limit, fields=field_list,
+        nulls_first=db.get_bind().dialect.name == "postgresql", **filters
+    )
+    expenses = db.execute(query).scalars().all()
+    return paginate_expenses(expenses, limit, field_list)
+
+
 def update_expense(db: Session, expense_id: int, expense_update: schemas.ExpenseUpdate, user_id: int) -> Optional[models.Expense]:
     """Update an existing expense, potentially including splits."""
     db_expense = get_expense_by_id(db, expense_id)
@@ -466,6 +601,11 @@ def update_expense(db: Session, expense_id: int, expense_update: schemas.Expense
     # Capture old state BEFORE modification using jsonable_encoder
     old_value = jsonable_encoder(db_expense)
 
+    _ensure_group_balance_ledger(db, db_expense.group_id)
+    old_split_shares = [(split.user_id, split.amount) for split in db_expense.splits]
+    old_deltas = _expense_balance_deltas(db_expense.payer_id, db_expense.amount, old_split_shares)
+    new_split_shares = old_split_shares
+
     update_data = expense_update.dict(exclude_unset=True)
 
     # Flag to check if splits were recalculated
@@ -493,7 +633,7 @@ def update_expense(db: Session, expense_id: int, expense_update: schemas.Expense
                  db_expense.amount = new_amount
 
             # Create new splits using the potentially updated amount
-            _create_splits(
+            new_splits = _create_splits(
                 db=db,
                 expense=db_expense, # Pass potentially updated expense
                 # Ensure input splits are correctly formatted (e.g., from dicts if needed)
@@ -502,6 +642,7 @@ def update_expense(db: Session, expense_id: int, expense_update: schemas.Expense
             )
 
             db_expense.split_type = split_type # Ensure split_type is updated
+            new_split_shares = [(split.user_id, split.amount) for split in new_splits]
 
             # Remove processed fields from update_data
             del update_data["splits"]
@@ -524,6 +665,11 @@ def update_expense(db: Session, expense_id: int, expense_update: schemas.Expense
     for key, value in update_data.items():
         setattr(db_expense, key, value)
 
+    new_deltas = _expense_balance_deltas(db_expense.payer_id, db_expense.amount, new_split_shares)
+    expense_deltas = _merge_deltas(_negate_deltas(old_deltas), new_deltas)
+    _apply_balance_deltas(db, db_expense.group_id, expense_deltas)
+    _patch_settlement_checkpoints(db, db_expense.group_id, expense_deltas, expense_id=expense_id)
+
     # Use jsonable_encoder for the new value in audit log (represents the incoming update request)
     new_value_for_log = jsonable_encoder(expense_update)
 
@@ -561,6 +707,23 @@ def delete_expense(db: Session, expense_id: int, user_id: int) -> bool:
     deleted_value = jsonable_encoder(db_expense) # Capture state including splits
 
     try:
+        _ensure_group_balance_ledger(db, group_id)
+        payment_rows = db.query(
+            models.Payment.id, models.Payment.from_user_id, models.Payment.to_user_id, models.Payment.amount,
+            models.Payment.image_url,
+        ).filter(models.Payment.expense_id == expense_id).all()
+        expense_deltas = _negate_deltas(
+            _expense_balance_deltas(db_expense.payer_id, db_expense.amount, db_expense.splits)
+        )
+        payment_deltas = {
+            row.id: _negate_deltas(_payment_balance_deltas(row.from_user_id, row.to_user_id, row.amount))
+            for row in payment_rows
+        }
+        _apply_balance_deltas(db, group_id, _merge_deltas(expense_deltas, *payment_deltas.values()))
+        _patch_settlement_checkpoints(db, group_id, expense_deltas, expense_id=expense_id)
+        for payment_id, deltas in payment_deltas.items():
+            _patch_settlement_checkpoints(db, group_id, deltas, payment_id=payment_id)
+
         create_audit_log(
             db=db,
             group_id=group_id,
@@ -570,6 +733,8 @@ def delete_expense(db: Session, expense_id: int, user_id: int) -> bool:
         )
 
         db.query(models.Payment).filter(models.Payment.expense_id == expense_id).delete(synchronize_session='fetch')
+        # the bulk delete skips the mapper events, so drop the receipt references here
+        uploads.release(db, [row.image_url for row in payment_rows])
 
         db.delete(db_expense)
 
@@ -708,93 +873,226 @@ def _calculate_next_due_date(current_due_date: date, frequency: str) -> date:
          return current_due_date + relativedelta(days=1)
 
 
-def process_due_recurring_expenses(db: Session):
+# instances written per transaction when a template catches up on missed periods
+RECURRING_BULK_BATCH = int(os.getenv("RECURRING_BULK_BATCH", "200"))
+
+
+def process_due_recurring_expenses(db: Session, template_ids: Optional[List[int]] = None):
     """
-    Finds and processes active recurring expenses due on or before today.
-    Creates standard Expense entries. Designed for schedulers.
+    Finds and processes active recurring expenses due on or before today
+    (only `template_ids` if given, see app/recurring_scheduler.py).
+    Creates standard Expense entries. Designed for schedulers; safe to run in
+    several processes at once (app/recurring_leases.py).
     """
     today = date.today()
-    due_expense_templates = db.query(models.RecurringExpense).filter(
+    query = db.query(models.RecurringExpense.id).filter(
         models.RecurringExpense.is_active == True,
         models.RecurringExpense.next_due_date <= today
-    ).all()
+    )
+    if template_ids is not None:
+        query = query.filter(models.RecurringExpense.id.in_(template_ids))
+    due_template_ids = [template_id for (template_id,) in query.all()]
+    db.rollback()  # don't hold the read transaction open between claims
 
-    if not due_expense_templates:
+    if not due_template_ids:
         logging.info("Scheduler: No due recurring expenses found.")
         return
 
-    logging.info(f"Scheduler: Found {len(due_expense_templates)} potentially due recurring expense templates.")
+    logging.info(f"Scheduler: Found {len(due_template_ids)} potentially due recurring expense templates.")
     created_count = 0
 
-    for template in due_expense_templates:
-        while template.is_active and template.next_due_date <= today:
-            instance_due_date = template.next_due_date
-            logging.info(f"Scheduler: Processing template_id {template.id} for due date {instance_due_date}")
+    for template_id in due_template_ids:
+        with recurring_leases.template_lease(template_id) as leased:
+            if not leased:
+                continue
+            created_count += _generate_due_instances(db, template_id, today)
 
-            try:
-                # 1. Validate and prepare splits
-                splits_definition = template.splits_definition
-                if not splits_definition:
-                    logging.error(f"Skipping template_id {template.id} due {instance_due_date}: splits_definition is missing or empty.")
-                    break
+    logging.info(f"Scheduler: Finished run. Created {created_count} new expenses.")
 
-                if not isinstance(splits_definition, list):
-                     logging.error(f"Skipping template_id {template.id} due {instance_due_date}: splits_definition is not a list ({type(splits_definition)}).")
-                     break
 
-                try:
-                    splits_in = [schemas.ExpenseSplitCreate(**split_data) for split_data in splits_definition]
-                except Exception as p_err:
-                    logging.error(f"Skipping template_id {template.id} due {instance_due_date}: Error creating splits from definition: {p_err}. Definition: {splits_definition}")
-                    break
+def _missed_due_dates(next_due_date: date, frequency: str, today: date, limit: int):
+    """Up to `limit` due dates from `next_due_date` through `today`, and the next_due_date that follows them."""
+    due_dates = []
+    due_date = next_due_date
+    while due_date <= today and len(due_dates) < limit:
+        due_dates.append(due_date)
+        due_date = _calculate_next_due_date(due_date, frequency)
+    return due_dates, due_date
 
-                # 2. Prepare data for the new Expense
-                new_expense_data = schemas.ExpenseCreateWithSplits(
-                    description=f"{template.description} (Recurring on {instance_due_date.isoformat()})",
-                    amount=template.amount,
-                    payer_id=template.payer_id,
-                    date=instance_due_date,
-                    splits=splits_in,
-                    split_type=template.split_type,
-                    image_url=None
-                )
-
-                # 3. Create the standard Expense
-                create_result = create_expense(
-                    db=db,
-                    group_id=template.group_id,
-                    creator_id=template.creator_id,
-                    expense=new_expense_data
-                )
-                new_expense_id = create_result["expense"].id
-                logging.info(f"Scheduler: Created Expense {new_expense_id} from template {template.id} for {instance_due_date}")
-                created_count += 1
-
-                # 4. Update the next_due_date on the template
-                template.next_due_date = _calculate_next_due_date(
-                    instance_due_date,
-                    template.frequency
-                )
-
-                # Commit changes for this instance
-                db.commit()
-
-            except HTTPException as http_exc:
-                 logging.error(f"Scheduler: HTTP Error creating expense from template {template.id} for {instance_due_date}: {http_exc.detail}")
-                 db.rollback()
-                 break
-            except ValueError as val_err:
-                 logging.error(f"Scheduler: Value Error creating expense from template {template.id} for {instance_due_date}: {val_err}")
-                 db.rollback()
-                 break
-            except Exception as e:
-                logging.error(f"Scheduler: Unexpected error processing template {template.id} for {instance_due_date}: {e}")
-                logging.error(traceback.format_exc())
-                db.rollback()
-                break
-        # End of while loop for a single template
 
-    logging.info(f"Scheduler: Finished run. Created {created_count} new expenses.")
+def _template_splits(template: models.RecurringExpense) -> List[schemas.ExpenseSplitCreate]:
+    """The template's splits_definition as ExpenseSplitCreate; ValueError if it is missing or malformed."""
+    splits_definition = template.splits_definition
+    if not splits_definition:
+        raise ValueError("splits_definition is missing or empty")
+    if not isinstance(splits_definition, list):
+        raise ValueError(f"splits_definition is not a list ({type(splits_definition)})")
+    try:
+        return [schemas.ExpenseSplitCreate(**split_data) for split_data in splits_definition]
+    except Exception as p_err:
+        raise ValueError(f"Error creating splits from definition: {p_err}. Definition: {splits_definition}")
+
+
+def _generate_due_instances(db: Session, template_id: int, today: date) -> int:
+    """
+    Creates the template's due instances; returns how many.
+    One due period goes through create_expense; a template further behind
+    (e.g. after an outage) is caught up in bulk by _catch_up_recurring_expense.
+    """
+    # re-read under the claim: another process may have generated this date already
+    template = recurring_leases.claim_template(db, template_id, today)
+    if template is None:
+        db.rollback()
+        return 0
+    if _calculate_next_due_date(template.next_due_date, template.frequency) <= today:
+        return _catch_up_recurring_expense(db, template, today)
+
+    instance_due_date = template.next_due_date
+    logging.info(f"Scheduler: Processing template_id {template.id} for due date {instance_due_date}")
+
+    try:
+        # 1. Prepare data for the new Expense
+        new_expense_data = schemas.ExpenseCreateWithSplits(
+            description=f"{template.description} (Recurring on {instance_due_date.isoformat()})",
+            amount=template.amount,
+            payer_id=template.payer_id,
+            date=instance_due_date,
+            splits=_template_splits(template),
+            split_type=template.split_type,
+            image_url=None
+        )
+
+        # 2. Advance next_due_date first so create_expense commits it together
+        # with the expense (and, on Postgres, releases the row lock only then)
+        template.next_due_date = _calculate_next_due_date(
+            instance_due_date,
+            template.frequency
+        )
+
+        # 3. Create the standard Expense
+        create_result = create_expense(
+            db=db,
+            group_id=template.group_id,
+            creator_id=template.creator_id,
+            expense=new_expense_data
+        )
+        logging.info(f"Scheduler: Created Expense {create_result['expense'].id} from template {template_id} for {instance_due_date}")
+        return 1
+
+    except HTTPException as http_exc:
+         logging.error(f"Scheduler: HTTP Error creating expense from template {template_id} for {instance_due_date}: {http_exc.detail}")
+    except ValueError as val_err:
+         logging.error(f"Scheduler: Value Error creating expense from template {template_id} for {instance_due_date}: {val_err}")
+    except Exception as e:
+        logging.error(f"Scheduler: Unexpected error processing template {template_id} for {instance_due_date}: {e}")
+        logging.error(traceback.format_exc())
+    db.rollback()
+    return 0
+
+
+def _insert_recurring_instances(db: Session, template: models.RecurringExpense, due_dates: List[date]) -> List[tuple]:
+    """
+    One expense per due date, plus splits and the ledger update, written with
+    multi-row INSERTs (no ORM objects, so no per-row flush or refresh).
+    Returns (expense id, date) pairs in due date order. Does not commit.
+    """
+    split_amounts = _calculate_split_amounts(template.amount, _template_splits(template), template.split_type)
+    _ensure_group_balance_ledger(db, template.group_id)
+
+    created_rows = db.execute(
+        insert(models.Expense).returning(models.Expense.id, models.Expense.date, sort_by_parameter_order=True),
+        [{
+            'description': f"{template.description} (Recurring on {due_date.isoformat()})",
+            'amount': template.amount,
+            'payer_id': template.payer_id,
+            'date': due_date,
+            'group_id': template.group_id,
+            'creator_id': template.creator_id,
+            'split_type': template.split_type,
+            'image_url': None,
+        } for due_date in due_dates]
+    ).all()
+    db.execute(insert(models.ExpenseSplit), [{
+        'expense_id': row.id,
+        'user_id': user_id,
+        'amount': amount_cents,
+        'balance': amount_cents, # 初始余额
+        'share_type': template.split_type,
+    } for row in created_rows for user_id, amount_cents in split_amounts])
+
+    # every instance moves the balances by the same amounts
+    deltas = _expense_balance_deltas(template.payer_id, template.amount, split_amounts)
+    _apply_balance_deltas(db, template.group_id, {
+        user_id: delta * len(created_rows) for user_id, delta in deltas.items()
+    })
+    return [(row.id, row.date) for row in created_rows]
+
+
+def _audit_recurring_catch_up(db: Session, template_id: int, group_id: int, creator_id: int,
+                              instances: List[tuple], next_due_date: date):
+    create_audit_log(
+        db=db,
+        group_id=group_id,
+        user_id=creator_id,
+        action="CREATE_RECURRING_EXPENSES",
+        details={
+            "recurring_expense_id": template_id,
+            "instances_created": len(instances),
+            "first_date": instances[0][1],
+            "last_date": instances[-1][1],
+            "expense_ids": [expense_id for expense_id, _ in instances],
+            "next_due_date": next_due_date
+        }
+    )
+
+
+def _catch_up_recurring_expense(db: Session, template: models.RecurringExpense, today: date) -> int:
+    """
+    Creates every missed instance of a claimed template in transactions of up to
+    RECURRING_BULK_BATCH instances. Each transaction re-claims the template,
+    inserts its batch and advances next_due_date past it, so a failure keeps the
+    committed batches and the next run resumes after them. The whole catch-up
+    gets one CREATE_RECURRING_EXPENSES audit entry, written with the last batch.
+    """
+    template_id, group_id, creator_id = template.id, template.group_id, template.creator_id
+    created = []  # (expense id, date) of the committed batches
+    committed_next_due_date = None
+
+    while template is not None:
+        due_dates, next_due_date = _missed_due_dates(template.next_due_date, template.frequency, today, RECURRING_BULK_BATCH)
+        finished = next_due_date > today
+        logging.info(f"Scheduler: Catching up template_id {template_id}: {len(due_dates)} instance(s) from {due_dates[0]} to {due_dates[-1]}")
+        try:
+            batch = _insert_recurring_instances(db, template, due_dates)
+            template.next_due_date = next_due_date
+            if finished:
+                _audit_recurring_catch_up(db, template_id, group_id, creator_id, created + batch, next_due_date)
+            db.commit()
+        except ValueError as val_err:
+            logging.error(f"Scheduler: Value Error catching up template {template_id} from {due_dates[0]}: {val_err}")
+            db.rollback()
+            break
+        except Exception as e:
+            logging.error(f"Scheduler: Unexpected error catching up template {template_id} from {due_dates[0]}: {e}")
+            logging.error(traceback.format_exc())
+            db.rollback()
+            break
+        created.extend(batch)
+        committed_next_due_date = next_due_date
+        if finished:
+            return len(created)
+        template = recurring_leases.claim_template(db, template_id, today)
+
+    # stopped early (an error, or the template changed in between): still summarize the committed batches
+    db.rollback()
+    if created:
+        try:
+            _audit_recurring_catch_up(db, template_id, group_id, creator_id, created, committed_next_due_date)
+            db.commit()
+        except Exception as e:
+            logging.error(f"Scheduler: Could not write the catch-up audit entry for template {template_id}: {e}")
+            db.rollback()
+    return len(created)
 
 # ----------- END OF SCHEDULER FUNCTION -----------
 
@@ -821,7 +1119,7 @@ def create_payment(
     expense_id: int,
     creator_id: int,
     payment: schemas.PaymentCreate,
-    image_file: Optional[UploadFile] = None  # 修复：添加 image_file
+    upload: Optional[uploads.StoredUpload] = None  # 修复：上传的凭证图片 (app/uploads.py)
 ) -> models.Payment:
 # 🔴 [END] 修复
     """Creates a new payment related to an expense."""
@@ -843,25 +1141,8 @@ def create_payment(
     # Use Decimal for amount precision
     payment_amount_dec = Decimal(str(payment.amount)).quantize(Decimal("0.01"))
 
-    # 🔴 [START] 修复：添加文件上传逻辑
-    image_url = None
-    if image_file and image_file.filename:
-        upload_dir = "app/static/uploads"
-        os.makedirs(upload_dir, exist_ok=True)
-        
-        file_extension = os.path.splitext(image_file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_location = os.path.join(upload_dir, unique_filename)
-
-        try:
-            with open(file_location, "wb") as file_object:
-                shutil.copyfileobj(image_file.file, file_object)
-            image_url = f"/static/uploads/{unique_filename}"
-            logging.info(f"Successfully saved payment file to: {file_location}")
-        except Exception as e:
-            logging.error(f"Failed to save uploaded payment file '{image_file.filename}': {e}")
-            if image_file.file:
-                image_file.file.close()
+    # 🔴 [START] 修复：添加文件上传逻辑 (published by app/uploads.py before the transaction)
+    image_url = uploads.attach_to_transaction(db, upload) if upload else None
     # 🔴 [END] 修复
 
     db_payment = models.Payment(
@@ -875,9 +1156,14 @@ def create_payment(
         image_url=image_url # 🔴 修复：使用新的 image_url
     )
 
+    _ensure_group_balance_ledger(db, expense.group_id)
     db.add(db_payment)
     db.flush() # Flush to get payment ID
 
+    _apply_balance_deltas(db, expense.group_id, _payment_balance_deltas(
+        db_payment.from_user_id, db_payment.to_user_id, db_payment.amount
+    ))
+
     create_audit_log(
         db=db,
         group_id=expense.group_id,
@@ -953,6 +1239,11 @@ def update_payment(
 
     update_data = payment_update.dict(exclude_unset=True)
 
+    group_id = payment.expense.group_id if payment.expense else None
+    if group_id is not None:
+        _ensure_group_balance_ledger(db, group_id)
+    old_deltas = _payment_balance_deltas(payment.from_user_id, payment.to_user_id, payment.amount)
+
     # Apply updates using setattr (handles description, image_url)
     # Update amount separately using the precise float value
     payment.amount = new_amount_float
@@ -969,6 +1260,12 @@ def update_payment(
     # Update payment_date to today
     payment.payment_date = date.today()
 
+    if group_id is not None:
+        new_deltas = _payment_balance_deltas(payment.from_user_id, payment.to_user_id, payment.amount)
+        payment_deltas = _merge_deltas(_negate_deltas(old_deltas), new_deltas)
+        _apply_balance_deltas(db, group_id, payment_deltas)
+        _patch_settlement_checkpoints(db, group_id, payment_deltas, payment_id=payment_id)
+
     # Create audit log AFTER preparing updates but BEFORE commit
     new_values_for_log = jsonable_encoder(payment_update)
 
@@ -1023,6 +1320,14 @@ def delete_payment(db: Session, payment_id: int, current_user_id: int, is_admin:
             "image_url": payment.image_url
         }
 
+    if group_id is not None:
+        _ensure_group_balance_ledger(db, group_id)
+        payment_deltas = _negate_deltas(
+            _payment_balance_deltas(payment.from_user_id, payment.to_user_id, payment.amount)
+        )
+        _apply_balance_deltas(db, group_id, payment_deltas)
+        _patch_settlement_checkpoints(db, group_id, payment_deltas, payment_id=payment_id)
+
     db.delete(payment)
 
     # Create log AFTER db.delete() but BEFORE commit
@@ -1111,7 +1416,14 @@ def create_audit_log(db: Session, *, group_id: int, user_id: int, action: str, d
     """
     Helper function to create an audit log entry.
     Handles JSON serialization for date/datetime objects within 'details'.
+    With AUDIT_LOG_MODE=buffered|outbox the entry goes through app/audit_writer.py instead.
     """
+    if audit_writer.enabled():
+        if group_id is None:
+            logging.error(f"AUDIT LOG: Skipping log for action '{action}' by user {user_id} due to missing group_id. Details: {details}")
+            return None
+        return audit_writer.record(db, group_id=group_id, user_id=user_id, action=action, details=details)
+
     serialized_details = None
     if details is not None:
         try:
@@ -1148,7 +1460,449 @@ def get_audit_logs(db: Session, group_id: int):
     # Eager load user associated with the log entry
     return db.query(models.AuditLog).options(
         joinedload(models.AuditLog.user)
-    ).filter(models.AuditLog.group_id == group_id).order_by(models.AuditLog.timestamp.desc()).all()
+    ).filter(models.AuditLog.group_id == group_id).order_by(
+        models.AuditLog.timestamp.desc(), models.AuditLog.id.desc()
+    ).all()
+
+
+# ----------- Paginated audit trail -----------
+# Keyset pagination on (timestamp DESC, id DESC), served by ix_audit_logs_group_timestamp_id.
+# The cursor carries the timestamp exactly as the database stores it: SQLite keeps
+# DateTime as text and CURRENT_TIMESTAMP has no microseconds, so a re-formatted
+# datetime would not compare equal to the stored value.
+
+AUDIT_PAGE_DEFAULT_LIMIT = 100
+AUDIT_PAGE_MAX_LIMIT = 500
+AUDIT_EXPORT_BATCH = int(os.getenv("AUDIT_EXPORT_BATCH", "1000"))
+
+
+_ARCHIVE_CURSOR_PREFIX = "archive|"
+
+
+def encode_audit_cursor(timestamp_value: str, log_id: int, archived: bool = False) -> str:
+    raw = f"{_ARCHIVE_CURSOR_PREFIX if archived else ''}{timestamp_value}|{log_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_audit_cursor(cursor: str):
+    """
+    Returns (timestamp text, id, archived); raises ValueError for a malformed
+    cursor. `archived` cursors point into the archive files, past all live rows.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        archived = raw.startswith(_ARCHIVE_CURSOR_PREFIX)
+        if archived:
+            raw = raw[len(_ARCHIVE_CURSOR_PREFIX):]
+        timestamp_part, id_part = raw.rsplit("|", 1)
+        if not timestamp_part:
+            raise ValueError
+        return timestamp_part, int(id_part), archived
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _audit_cursor_bound(dialect_name: str, timestamp_text: str):
+    """The cursor timestamp as a bind value comparable with audit_logs.timestamp."""
+    if dialect_name == "sqlite":
+        return literal(timestamp_text, String)
+    return datetime.fromisoformat(timestamp_text)
+
+
+def build_audit_logs_query(
+    group_id: int,
+    dialect_name: str,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    page: Optional[int] = None,
+    action: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    with_user: bool = True,
+):
+    """
+    SELECT for one page of a group's audit trail, newest first; fetches limit + 1
+    rows so the caller can tell whether another page exists. `action` accepts a
+    comma separated list. `page` (1-based OFFSET paging) is kept for older
+    clients and ignored when a cursor is given.
+    """
+    AuditLog = models.AuditLog
+    query = select(AuditLog).where(AuditLog.group_id == group_id)
+
+    if action:
+        actions = [item.strip() for item in action.split(",") if item.strip()]
+        query = query.where(AuditLog.action.in_(actions))
+    if user_id is not None:
+        query = query.where(AuditLog.user_id == user_id)
+    if since is not None:
+        query = query.where(AuditLog.timestamp >= since)
+    if until is not None:
+        query = query.where(AuditLog.timestamp < until)
+
+    if cursor:
+        timestamp_text, cursor_id, _ = decode_audit_cursor(cursor)
+        try:
+            bound = _audit_cursor_bound(dialect_name, timestamp_text)
+        except ValueError:
+            raise ValueError("Invalid cursor")
+        query = query.where(
+            (AuditLog.timestamp < bound) | ((AuditLog.timestamp == bound) & (AuditLog.id < cursor_id))
+        )
+    elif page and page > 1 and limit:
+        query = query.offset((page - 1) * limit)
+
+    if with_user:
+        query = query.options(joinedload(AuditLog.user))
+    query = query.order_by(AuditLog.timestamp.desc(), AuditLog.id.desc())
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
+
+
+def audit_cursor_timestamp_query(log_id: int, dialect_name: str):
+    """The stored timestamp of one row, for the next-page cursor (raw text on SQLite)."""
+    column = models.AuditLog.timestamp
+    if dialect_name == "sqlite":
+        column = cast(column, String)
+    return select(column).where(models.AuditLog.id == log_id)
+
+
+_ARCHIVED = object()  # marks page items that came from the archive files
+
+
+def audit_live_page_items(db: Session, group_id: int, limit: int, cursor: Optional[str] = None,
+                          page: Optional[int] = None, **filters):
+    """
+    The live table and SQLite shard part of audit_page_items: up to limit + 1
+    (log, stored timestamp) pairs, the stored timestamp None for live rows.
+    """
+    after = decode_audit_cursor(cursor) if cursor else None
+    if after and after[2]:
+        return []
+    query = build_audit_logs_query(group_id, db.bind.dialect.name, cursor=cursor, limit=limit, page=page, **filters)
+    items = [(log, None) for log in db.execute(query).scalars().all()]
+    if len(items) <= limit and not page:
+        items += audit_partitions.read_shards(db, group_id, after and after[:2], limit + 1 - len(items), **filters)
+    return items
+
+
+def audit_archive_page_items(group_id: int, limit: int, count: int, cursor: Optional[str] = None,
+                             page: Optional[int] = None, archived: bool = False, **filters):
+    """
+    The archive part of audit_page_items: the (log, _ARCHIVED) pairs that follow
+    `count` live / shard items. Reads files only, no session.
+    """
+    after = decode_audit_cursor(cursor) if cursor else None
+    if not (archived or (after and after[2])) or count > limit or page:
+        return []
+    archived_logs = audit_partitions.read_archives(group_id, after and after[:2], limit + 1 - count, **filters)
+    return [(log, _ARCHIVED) for log in archived_logs]
+
+
+def audit_page_items(db: Session, group_id: int, limit: int, cursor: Optional[str] = None,
+                     page: Optional[int] = None, archived: bool = False, **filters):
+    """
+    Up to limit + 1 (log, stored timestamp) pairs, newest first: the live table,
+    then SQLite shards, then (with `archived`) the archive files. The stored
+    timestamp is None for live rows and _ARCHIVED for archived ones. OFFSET
+    paging (`page`) only covers the live table.
+    """
+    items = audit_live_page_items(db, group_id, limit, cursor=cursor, page=page, **filters)
+    return items + audit_archive_page_items(group_id, limit, len(items), cursor=cursor, page=page,
+                                            archived=archived, **filters)
+
+
+def audit_page_cursor(log, stored) -> str:
+    """Cursor continuing after `log`; `stored` is its stored timestamp (see audit_page_items)."""
+    if stored is _ARCHIVED:
+        return encode_audit_cursor(log.timestamp.isoformat(), log.id, archived=True)
+    return encode_audit_cursor(stored if isinstance(stored, str) else stored.isoformat(), log.id)
+
+
+def get_audit_logs_page(db: Session, group_id: int, limit: Optional[int] = None, **filters):
+    """
+    One page of a group's audit trail; returns (logs, next_cursor). next_cursor
+    is None on the last page.
+    """
+    limit = limit or AUDIT_PAGE_DEFAULT_LIMIT
+    if not 1 <= limit <= AUDIT_PAGE_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {AUDIT_PAGE_MAX_LIMIT}")
+    return audit_page_result(db, audit_page_items(db, group_id, limit, **filters), limit)
+
+
+def audit_page_result(db: Session, items, limit: int):
+    """(logs, next_cursor) from the limit + 1 items of audit_page_items."""
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        log, stored = items[-1]
+        if stored is None:
+            stored = db.execute(audit_cursor_timestamp_query(log.id, db.bind.dialect.name)).scalar()
+        next_cursor = audit_page_cursor(log, stored)
+    return [log for log, _ in items], next_cursor
+
+
+def iter_audit_logs_ndjson(group_id: int, archived: bool = False, **filters):
+    """
+    Streams the whole (filtered) audit trail as NDJSON lines. Rows come from a
+    server-side cursor in AUDIT_EXPORT_BATCH sized chunks, so memory stays flat
+    however large the table is; SQLite shards and (with `archived`) archive
+    files follow. Opens its own session: the request's session is closed
+    before a streaming response body is sent.
+    """
+    db = SessionLocal()
+    try:
+        query = build_audit_logs_query(group_id, db.bind.dialect.name, **filters)
+        result = db.execute(query.execution_options(yield_per=AUDIT_EXPORT_BATCH))
+        for log in result.scalars():
+            yield schemas.AuditLog.model_validate(log).model_dump_json() + "\n"
+        for log, _ in audit_partitions.iter_shards(db, group_id, AUDIT_EXPORT_BATCH, **filters):
+            yield log.model_dump_json() + "\n"
+    finally:
+        db.close()
+    if archived:
+        for log in audit_partitions.iter_archives(group_id, **filters):
+            yield log.model_dump_json() + "\n"
+
+
+# ----------- Group Member Balance Ledger -----------
+
+def _expense_balance_deltas(payer_id: int, amount: int, splits) -> Dict[int, int]:
+    """
+    Balance changes (in cents) caused by one expense.
+    The payer is owed the full amount; every split participant owes their share.
+    `splits` may be ExpenseSplit rows or (user_id, amount) tuples.
+    """
+    deltas: Dict[int, int] = defaultdict(int)
+    deltas[payer_id] += int(amount or 0)
+    for split in splits or []:
+        if isinstance(split, tuple):
+            user_id, split_amount = split
+        else:
+            user_id, split_amount = split.user_id, split.amount
+        deltas[user_id] -= int(split_amount or 0)
+    return dict(deltas)
+
+
+def _payment_balance_deltas(from_user_id: int, to_user_id: int, amount) -> Dict[int, int]:
+    """Balance changes (in cents) caused by one payment: the payer's debt shrinks, the payee's credit shrinks."""
+    deltas: Dict[int, int] = defaultdict(int)
+    deltas[from_user_id] += int(amount or 0)
+    deltas[to_user_id] -= int(amount or 0)
+    return dict(deltas)
+
+
+def _negate_deltas(deltas: Dict[int, int]) -> Dict[int, int]:
+    return {user_id: -delta for user_id, delta in deltas.items()}
+
+
+def _merge_deltas(*deltas_list: Dict[int, int]) -> Dict[int, int]:
+    merged: Dict[int, int] = defaultdict(int)
+    for deltas in deltas_list:
+        for user_id, delta in deltas.items():
+            merged[user_id] += delta
+    return dict(merged)
+
+
+def _apply_balance_deltas(db: Session, group_id: int, deltas: Dict[int, int]):
+    """
+    Adds `deltas` to the group's balance ledger inside the caller's transaction.
+    The caller is responsible for commit/rollback.
+    """
+    for user_id, delta in deltas.items():
+        if not delta:
+            continue
+        updated = db.query(models.GroupMemberBalance).filter(
+            models.GroupMemberBalance.group_id == group_id,
+            models.GroupMemberBalance.user_id == user_id
+        ).update({
+            models.GroupMemberBalance.balance: models.GroupMemberBalance.balance + delta,
+            models.GroupMemberBalance.updated_at: datetime.now()
+        }, synchronize_session=False)
+
+        if not updated:
+            db.add(models.GroupMemberBalance(group_id=group_id, user_id=user_id, balance=delta))
+            db.flush()
+
+
+def rebuild_group_member_balances(db: Session, group_id: int) -> Dict[int, int]:
+    """
+    Recomputes the balance ledger of a group from its full history.
+    Every current member gets a row (zero if they have no activity).
+    Does not commit.
+    """
+    balances = _calculate_balances_sql(db, group_id)
+    member_ids = [
+        user_id for (user_id,) in db.query(models.GroupMember.user_id)
+        .filter(models.GroupMember.group_id == group_id).all()
+    ]
+    for user_id in member_ids:
+        balances.setdefault(user_id, 0)
+
+    db.query(models.GroupMemberBalance).filter(
+        models.GroupMemberBalance.group_id == group_id
+    ).delete(synchronize_session=False)
+
+    db.add_all([
+        models.GroupMemberBalance(group_id=group_id, user_id=user_id, balance=balance)
+        for user_id, balance in balances.items()
+    ])
+    db.flush()
+    logging.info(f"Ledger: Rebuilt balances for group {group_id} ({len(balances)} users)")
+    return balances
+
+
+def _lock_group(db: Session, group_id: int):
+    """
+    Serializes the writers of a group's expenses, payments, ledger and
+    checkpoints until the caller commits: the group row is locked FOR UPDATE
+    on Postgres; SQLite has no row locks, so a no-op UPDATE takes the database
+    write lock now instead of at the first insert.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(models.Group.id).where(models.Group.id == group_id).with_for_update())
+    else:
+        db.execute(
+            update(models.Group).where(models.Group.id == group_id).values(id=models.Group.id)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _ensure_group_balance_ledger(db: Session, group_id: int) -> bool:
+    """
+    Locks the group (_lock_group) and backfills the ledger of groups that
+    predate it (migration 0009 does this for existing databases). Must run
+    BEFORE the caller writes any expense / payment rows, otherwise those rows
+    are counted twice. Returns True if a rebuild happened.
+    """
+    _lock_group(db, group_id)
+    has_rows = db.query(models.GroupMemberBalance.id).filter(
+        models.GroupMemberBalance.group_id == group_id
+    ).first() is not None
+    if has_rows:
+        return False
+    rebuild_group_member_balances(db, group_id)
+    return True
+
+
+def get_group_member_balances(db: Session, group_id: int) -> Dict[int, int]:
+    """Returns {user_id: balance_cents} straight from the ledger."""
+    rows = db.query(
+        models.GroupMemberBalance.user_id, models.GroupMemberBalance.balance
+    ).filter(models.GroupMemberBalance.group_id == group_id).all()
+    return {user_id: balance for user_id, balance in rows}
+
+
+# ----------- Settlement Checkpoints -----------
+
+# Number of checkpoints kept per group; older ones are pruned on write
+SETTLEMENT_CHECKPOINT_KEEP = int(os.getenv("SETTLEMENT_CHECKPOINT_KEEP", "3"))
+
+
+def get_latest_settlement_checkpoint(db: Session, group_id: int) -> Optional[models.SettlementCheckpoint]:
+    return db.query(models.SettlementCheckpoint).filter(
+        models.SettlementCheckpoint.group_id == group_id
+    ).order_by(models.SettlementCheckpoint.id.desc()).first()
+
+
+def _write_settlement_checkpoint(db: Session, group_id: int, created_by: Optional[int] = None) -> models.SettlementCheckpoint:
+    """
+    Records every user's balance as of the current expense / payment
+    high-water marks. Only activity since the previous checkpoint is scanned.
+    The marks are read under the group lock that every expense / payment
+    writer takes before inserting, so no uncommitted row can later appear
+    below them (Postgres hands out sequence ids before commit).
+    Does not commit.
+    """
+    _lock_group(db, group_id)
+    previous = get_latest_settlement_checkpoint(db, group_id)
+
+    last_expense_id = db.query(func.max(models.Expense.id)).filter(
+        models.Expense.group_id == group_id
+    ).scalar() or 0
+    last_payment_id = db.query(func.max(models.Payment.id))\
+        .join(models.Expense, models.Payment.expense_id == models.Expense.id)\
+        .filter(models.Expense.group_id == group_id).scalar() or 0
+    if previous:
+        # the newest rows may have been deleted since; never move the marks backwards
+        last_expense_id = max(last_expense_id, previous.last_expense_id)
+        last_payment_id = max(last_payment_id, previous.last_payment_id)
+
+    balances = _calculate_balances_sql(
+        db, group_id, upto_expense_id=last_expense_id, upto_payment_id=last_payment_id
+    )
+
+    checkpoint = models.SettlementCheckpoint(
+        group_id=group_id,
+        last_expense_id=last_expense_id,
+        last_payment_id=last_payment_id,
+        balances={str(user_id): balance for user_id, balance in balances.items() if balance},
+        created_by=created_by
+    )
+    db.add(checkpoint)
+    db.flush()
+
+    stale_ids = [
+        checkpoint_id for (checkpoint_id,) in db.query(models.SettlementCheckpoint.id)
+        .filter(models.SettlementCheckpoint.group_id == group_id)
+        .order_by(models.SettlementCheckpoint.id.desc())
+        .offset(SETTLEMENT_CHECKPOINT_KEEP).all()
+    ]
+    if stale_ids:
+        db.query(models.SettlementCheckpoint).filter(
+            models.SettlementCheckpoint.id.in_(stale_ids)
+        ).delete(synchronize_session=False)
+
+    logging.info(f"Checkpoint: group {group_id} at expense {last_expense_id} / payment {last_payment_id}")
+    return checkpoint
+
+
+def create_settlement_checkpoint(db: Session, group_id: int, created_by: Optional[int] = None) -> models.SettlementCheckpoint:
+    """Writes a settlement checkpoint on demand."""
+    checkpoint = _write_settlement_checkpoint(db, group_id, created_by=created_by)
+    create_audit_log(
+        db=db,
+        group_id=group_id,
+        user_id=created_by,
+        action="CREATE_SETTLEMENT_CHECKPOINT",
+        details={
+            "checkpoint_id": checkpoint.id,
+            "last_expense_id": checkpoint.last_expense_id,
+            "last_payment_id": checkpoint.last_payment_id
+        }
+    )
+    db.commit()
+    db.refresh(checkpoint)
+    return checkpoint
+
+
+def _patch_settlement_checkpoints(
+    db: Session,
+    group_id: int,
+    deltas: Dict[int, int],
+    expense_id: Optional[int] = None,
+    payment_id: Optional[int] = None
+):
+    """
+    Keeps checkpoints valid when an expense / payment they already include is
+    updated or deleted: `deltas` is added to every checkpoint whose high-water
+    mark covers the changed row. Rows created after a checkpoint need nothing.
+    """
+    if not any(deltas.values()):
+        return
+    query = db.query(models.SettlementCheckpoint).filter(models.SettlementCheckpoint.group_id == group_id)
+    if expense_id is not None:
+        query = query.filter(models.SettlementCheckpoint.last_expense_id >= expense_id)
+    else:
+        query = query.filter(models.SettlementCheckpoint.last_payment_id >= payment_id)
+
+    for checkpoint in query.all():
+        balances = {int(user_id): balance for user_id, balance in checkpoint.balances.items()}
+        for user_id, delta in deltas.items():
+            balances[user_id] = balances.get(user_id, 0) + delta
+        # assign a new dict so the JSON column is flagged as modified
+        checkpoint.balances = {str(user_id): balance for user_id, balance in balances.items() if balance}
 
 
 # ----------- Settlement CRUD (🔴 修复版本) -----------
@@ -1162,290 +1916,626 @@ def get_all_group_payments(db: Session, group_id: int) -> List[models.Payment]:
              .filter(models.Expense.group_id == group_id)\
              .all()
 
-def calculate_group_settlement_balance(db: Session, group_id: int) -> (Dict[int, Dict], Dict[int, Any]):
+def _calculate_balances_from_history(db: Session, group_id: int) -> Dict[int, int]:
+    """
+    Rebuilds every user's net balance (in cents) from the full expense / payment
+    history of a group by hydrating ORM objects. Reference implementation used
+    by the "python" mode and to cross-check the other modes.
+    """
+    balances: Dict[int, int] = defaultdict(int)
+
+    # 1. 累加费用
+    expenses = get_group_expenses(db, group_id)
+    logging.info(f"DEBUG: Found {len(expenses)} expenses for group {group_id}")
+
+    for expense in expenses:
+        for user_id, delta in _expense_balance_deltas(expense.payer_id, expense.amount, expense.splits).items():
+            balances[user_id] += delta
+
+    # 2. 累加支付 (结算)
+    payments = get_all_group_payments(db, group_id)
+    logging.info(f"DEBUG: Found {len(payments)} total payments for group {group_id}")
+
+    for payment in payments:
+        for user_id, delta in _payment_balance_deltas(payment.from_user_id, payment.to_user_id, payment.amount).items():
+            balances[user_id] += delta
+
+    return dict(balances)
+
+
+def _balance_flows(
+    db: Session,
+    group_id: int,
+    upto_expense_id: Optional[int] = None,
+    upto_payment_id: Optional[int] = None
+):
+    """
+    Returns (base_balances, flows) where base_balances comes from the latest
+    settlement checkpoint and `flows` is a subquery of (user_id, amount) rows:
+    the UNION of payer credits, split debits and payment flows created after
+    that checkpoint (optionally bounded by the `upto_*` ids).
+    """
+    checkpoint = get_latest_settlement_checkpoint(db, group_id)
+    balances: Dict[int, int] = defaultdict(int)
+    after_expense_id, after_payment_id = 0, 0
+    if checkpoint:
+        after_expense_id, after_payment_id = checkpoint.last_expense_id, checkpoint.last_payment_id
+        for user_id, balance in checkpoint.balances.items():
+            balances[int(user_id)] += int(balance)
+
+    expense_filters = [models.Expense.group_id == group_id, models.Expense.id > after_expense_id]
+    if upto_expense_id is not None:
+        expense_filters.append(models.Expense.id <= upto_expense_id)
+    payment_filters = [models.Expense.group_id == group_id, models.Payment.id > after_payment_id]
+    if upto_payment_id is not None:
+        payment_filters.append(models.Payment.id <= upto_payment_id)
+
+    payer_credits = db.query(
+        models.Expense.payer_id.label("user_id"),
+        models.Expense.amount.label("amount")
+    ).filter(*expense_filters)
+
+    split_debits = db.query(
+        models.ExpenseSplit.user_id,
+        -models.ExpenseSplit.amount
+    ).join(models.Expense, models.ExpenseSplit.expense_id == models.Expense.id)\
+     .filter(*expense_filters)
+
+    payments_made = db.query(
+        models.Payment.from_user_id,
+        models.Payment.amount
+    ).join(models.Expense, models.Payment.expense_id == models.Expense.id)\
+     .filter(*payment_filters)
+
+    payments_received = db.query(
+        models.Payment.to_user_id,
+        -models.Payment.amount
+    ).join(models.Expense, models.Payment.expense_id == models.Expense.id)\
+     .filter(*payment_filters)
+
+    flows = payer_credits.union_all(split_debits, payments_made, payments_received).subquery()
+    return balances, flows
+
+
+def _calculate_balances_sql(
+    db: Session,
+    group_id: int,
+    upto_expense_id: Optional[int] = None,
+    upto_payment_id: Optional[int] = None
+) -> Dict[int, int]:
+    """
+    Net balance (in cents) per user_id computed by the database in a single
+    grouped statement over the balance flows. No ORM objects are built.
+    Starts from the latest settlement checkpoint.
+    """
+    balances, flows = _balance_flows(db, group_id, upto_expense_id, upto_payment_id)
+
+    rows = db.query(
+        flows.c.user_id, func.sum(flows.c.amount)
+    ).group_by(flows.c.user_id).all()
+
+    for user_id, total in rows:
+        balances[user_id] += int(total or 0)
+    return dict(balances)
+
+
+def _calculate_balances_numpy(db: Session, group_id: int) -> Dict[int, int]:
+    """
+    Net balance (in cents) per user_id: streams the raw (user_id, amount)
+    flow columns and sums them with the NumPy engine.
+    Starts from the latest settlement checkpoint.
+    """
+    if settlement_numpy is None:
+        raise ValueError("Settlement mode 'numpy' requires numpy to be installed")
+
+    balances, flows = _balance_flows(db, group_id)
+    rows = db.execute(select(flows.c.user_id, flows.c.amount)).all()
+    for user_id, total in settlement_numpy.net_balances_from_rows(rows).items():
+        balances[user_id] += total
+    return dict(balances)
+
+
+def _crosscheck_balances(db: Session, group_id: int, mode: str, balances: Dict[int, int]):
+    """Logs every user whose balance differs from the reference Python path."""
+    reference = _calculate_balances_from_history(db, group_id)
+    mismatches = {
+        user_id: (balances.get(user_id, 0), reference.get(user_id, 0))
+        for user_id in set(balances) | set(reference)
+        if balances.get(user_id, 0) != reference.get(user_id, 0)
+    }
+    if mismatches:
+        logging.error(f"Settlement cross-check: mode '{mode}' disagrees with python path for group {group_id}: {mismatches}")
+    return not mismatches
+
+
+def calculate_group_settlement_balance(
+    db: Session,
+    group_id: int,
+    mode: Optional[str] = None,
+    members: Optional[List[models.GroupMember]] = None
+) -> (Dict[int, Dict], Dict[int, Any]):
     """
     (🔴 修复) 计算群组所有成员的结算余额
+    `mode` selects the computation ("ledger", "sql" or "python");
+    defaults to SETTLEMENT_BALANCE_MODE.
+    `members` can be passed in when the caller has already loaded them.
     返回：(member_balances, member_data)
     """
+    mode = mode or SETTLEMENT_BALANCE_MODE
+    if mode not in SETTLEMENT_BALANCE_MODES:
+        raise ValueError(f"Unknown settlement balance mode '{mode}'")
+
     try:
         # 1. 获取群组所有成员
-        members = get_group_members(db, group_id)
-        member_data = {member.user_id: {
-            'user': member.user,
-            'nickname': member.nickname,
-            'is_admin': member.is_admin
-        } for member in members}
-        
-        # 2. 初始化每个成员的余额 (单位：分)
-        member_balances = {member_id: 0 for member_id in member_data}
-        
-        # 3. 获取群组所有费用
-        expenses = get_group_expenses(db, group_id)
-        logging.info(f"DEBUG: Found {len(expenses)} expenses for group {group_id}")
-        
-        # 4. 累加费用
-        for expense in expenses:
-            if expense.payer_id in member_balances:
-                # 付款人 "增加" 余额 (别人欠他的)
-                member_balances[expense.payer_id] += expense.amount
-            
-            if hasattr(expense, 'splits') and expense.splits:
-                for split in expense.splits:
-                    if split.user_id in member_balances:
-                        # 参与人 "减少" 余额 (他欠别人的)
-                        member_balances[split.user_id] -= split.amount
-        
-        # 5. 累加支付 (结算)
-        payments = get_all_group_payments(db, group_id)
-        logging.info(f"DEBUG: Found {len(payments)} total payments for group {group_id}")
-        
-        for payment in payments:
-            if payment.from_user_id in member_balances:
-                # 付款人 "增加" 余额 (还钱)
-                member_balances[payment.from_user_id] += payment.amount
-            if payment.to_user_id in member_balances:
-                # 收款人 "减少" 余额 (收钱)
-                member_balances[payment.to_user_id] -= payment.amount
-
-        # 6. 准备返回数据 (包含详细信息，仍然使用分)
+        if members is None:
+            members = get_group_members(db, group_id)
+        member_data = _build_member_data(members)
+
+        # 2. 计算余额 (单位：分)
+        if mode == "ledger":
+            # read only: a group without ledger rows (not yet backfilled) is aggregated instead
+            balances = get_group_member_balances(db, group_id) or _calculate_balances_sql(db, group_id)
+        elif mode == "sql":
+            balances = _calculate_balances_sql(db, group_id)
+        elif mode == "numpy":
+            balances = _calculate_balances_numpy(db, group_id)
+        else:
+            balances = _calculate_balances_from_history(db, group_id)
+
+        if SETTLEMENT_BALANCE_CROSSCHECK and mode != "python":
+            _crosscheck_balances(db, group_id, mode, balances)
+
+        # 3. 准备返回数据 (只包含当前成员，仍然使用分)
         final_balances_info = {}
-        for member_id, final_balance_cents in member_balances.items():
+        for member_id in member_data:
             final_balances_info[member_id] = {
-                'final_balance': final_balance_cents
-                # 注意：这里不再计算 total_expenses 等，因为它们在旧逻辑中是错误的
+                'final_balance': balances.get(member_id, 0)
             }
 
-        logging.info(f"DEBUG: Calculated final balances (in cents) for {len(final_balances_info)} members")
+        logging.info(f"DEBUG: Calculated final balances (in cents, mode={mode}) for {len(final_balances_info)} members")
         return final_balances_info, member_data
-    
+
     except Exception as e:
         logging.error(f"Error in calculate_group_settlement_balance for group {group_id}: {e}")
         logging.error(traceback.format_exc())
         raise
 
 
-def get_group_settlement_summary(db: Session, group_id: int) -> Dict:
+def _build_member_data(members: List[models.GroupMember]) -> Dict[int, Dict]:
+    return {member.user_id: {
+        'user': member.user,
+        'nickname': member.nickname,
+        'is_admin': member.is_admin
+    } for member in members}
+
+
+def load_settlement_context(
+    db: Session,
+    group_id: int,
+    group: Optional[models.Group] = None,
+    mode: Optional[str] = None
+) -> Dict:
+    """
+    Loads everything a settlement request needs exactly once:
+    the group, its members, every member's balance (in cents) and the group's
+    total spend. Summaries, transactions and execution are all derived from
+    this in-memory context instead of going back to the database.
+    """
+    if group is None:
+        group = get_group_by_id(db, group_id)
+    if not group:
+        raise ValueError(f"群组 {group_id} 不存在")
+
+    members = get_group_members(db, group_id)
+    logging.info(f"DEBUG: Found {len(members)} members for group {group_id}")
+
+    member_balances_cents, _ = calculate_group_settlement_balance(
+        db, group_id, mode=mode, members=members
+    )
+
+    total_amount_cents = db.query(
+        func.coalesce(func.sum(models.Expense.amount), 0)
+    ).filter(models.Expense.group_id == group_id).scalar()
+
+    # Snapshot plain values so the context stays usable after commits expire the ORM objects
+    return {
+        'group_id': group.id,
+        'group_name': group.name,
+        'member_count': len(members),
+        'usernames': {member.user_id: member.user.username for member in members},
+        'balances': {
+            member_id: balance_info.get('final_balance', 0)
+            for member_id, balance_info in member_balances_cents.items()
+        },
+        'total_amount': int(total_amount_cents or 0),
+    }
+
+
+def build_settlement_summary(context: Dict, strategy: Optional[str] = None) -> Dict:
+    """
+    (🔴 修复) Builds the settlement summary (balances + recommended
+    transactions) from a context returned by load_settlement_context.
+    No database access.
+    """
+    # 生成结算平衡列表
+    balances = []
+    for member_id, final_balance_cents in context['balances'].items():
+        try:
+            username = context['usernames'][member_id]
+
+            # 确定状态
+            if final_balance_cents > 1:  # 应收钱 (使用 1 分作为阈值)
+                status = 'creditor'
+            elif final_balance_cents < -1:  # 应付钱
+                status = 'debtor'
+            else:  # 基本平衡
+                status = 'settled'
+
+            balance_obj = {
+                'user_id': member_id,
+                'username': username,
+                'final_balance': final_balance_cents, # 🔴 修复：使用正确的键名
+                'balance': final_balance_cents, # 🔴 修复：也保留 'balance' 键以防万一
+                'status': status,
+            }
+            balances.append(balance_obj)
+        except Exception as e:
+            logging.error(f"Error processing balance for member {member_id}: {e}")
+            continue
+
+    logging.info(f"DEBUG: Total amount calculated (in cents): {context['total_amount']}")
+
+    return {
+        'group_id': context['group_id'],
+        'group_name': context['group_name'],
+        'total_amount': context['total_amount'], # 保持分为单位
+        'member_count': context['member_count'],
+        'balances': balances, # 包含分为单位的余额
+        'transactions': generate_settlement_transactions(balances, strategy=strategy), # 推荐的支付路径
+        'last_updated': datetime.now()
+    }
+
+
+def get_group_settlement_summary(
+    db: Session,
+    group_id: int,
+    group: Optional[models.Group] = None,
+    mode: Optional[str] = None,
+    strategy: Optional[str] = None
+) -> Dict:
     """
     (🔴 修复) 获取群组结算汇总信息
+    Pass `group` when the caller already loaded it (e.g. from a dependency).
     """
     try:
-        # 获取群组信息
-        group = get_group_by_id(db, group_id)
-        if not group:
-            raise ValueError(f"群组 {group_id} 不存在")
-        
-        # 获取群组所有成员
-        members = get_group_members(db, group_id)
-        logging.info(f"DEBUG: Found {len(members)} members for group {group_id}")
-        
-        # 计算结算余额 (使用 🔴 修复后 的函数)
-        member_balances_cents, member_data = calculate_group_settlement_balance(db, group_id)
-        
-        # 调试信息
-        logging.info(f"DEBUG: member_balances_cents keys: {list(member_balances_cents.keys())}")
-        
-        # 生成结算平衡列表
-        balances = []
-        for member_id, balance_info in member_balances_cents.items():
-            try:
-                user_info = member_data[member_id]
-                final_balance_cents = balance_info.get('final_balance', 0)
-                
-                # 确定状态
-                if final_balance_cents > 1:  # 应收钱 (使用 1 分作为阈值)
-                    status = 'creditor'
-                elif final_balance_cents < -1:  # 应付钱
-                    status = 'debtor'
-                else:  # 基本平衡
-                    status = 'settled'
-                
-                balance_obj = {
-                    'user_id': member_id,
-                    'username': user_info['user'].username,
-                    'final_balance': final_balance_cents, # 🔴 修复：使用正确的键名
-                    'balance': final_balance_cents, # 🔴 修复：也保留 'balance' 键以防万一
-                    'status': status,
-                }
-                balances.append(balance_obj)
-            except Exception as e:
-                logging.error(f"Error processing balance for member {member_id}: {e}")
-                continue
-        
-        # 计算群组总支出
-        expenses = get_group_expenses(db, group_id)
-        total_amount_cents = 0
-        for expense in expenses:
-            try:
-                total_amount_cents += int(expense.amount)
-            except (ValueError, TypeError) as e:
-                logging.warning(f"Invalid expense amount for expense {expense.id}: {e}")
-                continue
-        
-        logging.info(f"DEBUG: Total amount calculated (in cents): {total_amount_cents}")
-        
-        return {
-            'group_id': group_id,
-            'group_name': group.name,
-            'total_amount': total_amount_cents, # 保持分为单位
-            'member_count': len(members),
-            'balances': balances, # 包含分为单位的余额
-            'last_updated': datetime.now()
-        }
-    
+        context = load_settlement_context(db, group_id, group=group, mode=mode)
+        return build_settlement_summary(context, strategy=strategy)
+
     except Exception as e:
         logging.error(f"Error in get_group_settlement_summary for group {group_id}: {e}")
         logging.error(traceback.format_exc())
         raise
 
 
-def generate_settlement_transactions(balances_list: List[Dict], member_data: Dict = None) -> List[Dict]:
+def _settle_greedy(nets: List[tuple]) -> List[tuple]:
     """
-    (🔴 修复) 生成推荐的结算交易路径
-    使用贪心算法最小化交易次数
-    - 传入的 balances_list 是 [{'user_id': ..., 'final_balance': <cents>, ...}]
+    贪心匹配: largest creditor against largest debtor, O(n log n).
+    `nets` is [(user_id, balance_cents)]; returns [(from_user_id, to_user_id, amount_cents)].
     """
     # 分离债权人和债务人
-    creditors = []  # 应收钱的人
-    debtors = []    # 应付钱的人
-    
-    for balance_info in balances_list:
-        final_balance_cents = balance_info['final_balance']
-        member_id = balance_info['user_id']
+    creditors = [[user_id, amount] for user_id, amount in nets if amount > 1]    # 应收钱的人
+    debtors = [[user_id, -amount] for user_id, amount in nets if amount < -1]    # 应付钱的人
 
-        # 获取用户名
-        username = balance_info.get('username', f"User{member_id}")
-        if member_data and member_id in member_data and 'user' in member_data[member_id]:
-             username = member_data[member_id]['user'].username or username
-        
-        if final_balance_cents > 1:  # 应收
-            creditors.append({
-                'user_id': member_id,
-                'amount': final_balance_cents,
-                'username': username
-            })
-        elif final_balance_cents < -1:  # 应付
-            debtors.append({
-                'user_id': member_id,
-                'amount': abs(final_balance_cents),
-                'username': username
-            })
-    
     # 按金额排序
-    creditors.sort(key=lambda x: x['amount'], reverse=True)
-    debtors.sort(key=lambda x: x['amount'], reverse=True)
-    
-    transactions = []
-    
-    # 贪心匹配
+    creditors.sort(key=lambda x: x[1], reverse=True)
+    debtors.sort(key=lambda x: x[1], reverse=True)
+
+    transfers = []
     i, j = 0, 0
     while i < len(creditors) and j < len(debtors):
         creditor = creditors[i]
         debtor = debtors[j]
-        
+
         # 计算交易金额 (分)
-        transaction_amount_cents = min(creditor['amount'], debtor['amount'])
-        
-        if transaction_amount_cents > 1:  # 忽略很小的金额
-            transactions.append({
-                'from_user_id': debtor['user_id'],  # 债务人付钱
-                'to_user_id': creditor['user_id'],   # 债权人收钱
-                'amount': transaction_amount_cents, # 保持分为单位
-                'description': f"结算付款：{debtor['username']} 支付给 {creditor['username']}"
-            })
-        
+        amount = min(creditor[1], debtor[1])
+        if amount > 1:  # 忽略很小的金额
+            transfers.append((debtor[0], creditor[0], amount))
+
         # 更新余额
-        creditor['amount'] -= transaction_amount_cents
-        debtor['amount'] -= transaction_amount_cents
-        
+        creditor[1] -= amount
+        debtor[1] -= amount
+
         # 移动到下一个
-        if creditor['amount'] <= 1:
+        if creditor[1] <= 1:
             i += 1
-        if debtor['amount'] <= 1:
+        if debtor[1] <= 1:
             j += 1
-    
-    return transactions
 
+    return transfers
+
+
+def _settle_exact(nets: List[tuple]) -> List[tuple]:
+    """
+    Minimum number of transfers: partitions the unsettled members into the
+    largest possible number of zero-sum groups (each group of k members needs
+    k - 1 transfers) with a DP over subsets, O(2^n * n).
+    Falls back to the heuristic above SETTLEMENT_EXACT_MAX_MEMBERS members.
+    """
+    nets = [(user_id, amount) for user_id, amount in nets if abs(amount) > 1]
+    n = len(nets)
+    if n == 0:
+        return []
+    if n > SETTLEMENT_EXACT_MAX_MEMBERS:
+        logging.warning(f"Settlement: {n} unsettled members exceeds exact limit {SETTLEMENT_EXACT_MAX_MEMBERS}, using heuristic")
+        return _settle_heuristic(nets)
+
+    size = 1 << n
+    subset_sum = [0] * size
+    for mask in range(1, size):
+        low = mask & -mask
+        subset_sum[mask] = subset_sum[mask ^ low] + nets[low.bit_length() - 1][1]
+
+    # best[mask] = max number of zero-sum groups the members of mask can be split into
+    best = [0] * size
+    for mask in range(1, size):
+        most = 0
+        rest = mask
+        while rest:
+            low = rest & -rest
+            if best[mask ^ low] > most:
+                most = best[mask ^ low]
+            rest ^= low
+        best[mask] = most + (1 if subset_sum[mask] == 0 else 0)
+
+    # Walk back from the full set; every zero-sum mask on the path closes a group
+    groups, current, mask = [], [], size - 1
+    while mask:
+        target = best[mask] - (1 if subset_sum[mask] == 0 else 0)
+        rest = mask
+        while rest:
+            low = rest & -rest
+            if best[mask ^ low] == target:
+                break
+            rest ^= low
+        current.append(nets[low.bit_length() - 1])
+        mask ^= low
+        if subset_sum[mask] == 0:
+            groups.append(current)
+            current = []
+
+    transfers = []
+    for group in groups:
+        transfers.extend(_settle_greedy(group))
+    return transfers
+
+
+def _settle_heuristic(nets: List[tuple], time_budget_ms: Optional[int] = None) -> List[tuple]:
+    """
+    Time-budgeted heuristic for large groups: settles exactly matching
+    debtor/creditor pairs first (one transfer for two members), then
+    one-against-two triples (two transfers for three members) until the time
+    budget runs out, and finishes the remainder greedily.
+    """
+    budget_ms = SETTLEMENT_HEURISTIC_TIME_BUDGET_MS if time_budget_ms is None else time_budget_ms
+    deadline = time.monotonic() + budget_ms / 1000.0
+    remaining = {user_id: amount for user_id, amount in nets if abs(amount) > 1}
+    transfers = []
+
+    def settle(from_user_id, to_user_id, amount):
+        transfers.append((from_user_id, to_user_id, amount))
+        remaining[from_user_id] += amount
+        remaining[to_user_id] -= amount
+        for user_id in (from_user_id, to_user_id):
+            if remaining[user_id] == 0:
+                del remaining[user_id]
+
+    # 1. exact pairs
+    debtors_by_amount = defaultdict(list)
+    for user_id, amount in remaining.items():
+        if amount < 0:
+            debtors_by_amount[-amount].append(user_id)
+    for user_id, amount in list(remaining.items()):
+        if amount > 0 and debtors_by_amount.get(amount):
+            settle(debtors_by_amount[amount].pop(), user_id, amount)
+
+    # 2. triples: one member settled by exactly two members on the other side
+    found = True
+    while found and time.monotonic() < deadline:
+        found = False
+        for sign in (1, -1):
+            singles = [(u, a) for u, a in remaining.items() if a * sign > 0]
+            others = [(u, -a) for u, a in remaining.items() if a * sign < 0]
+            by_amount = defaultdict(list)
+            for u, a in others:
+                by_amount[a].append(u)
+            for single, amount in sorted(singles, key=lambda x: abs(x[1]), reverse=True):
+                if time.monotonic() >= deadline:
+                    break
+                for first, first_amount in others:
+                    if first not in remaining or first_amount * sign >= amount * sign:
+                        continue
+                    second = next(
+                        (u for u in by_amount.get(amount - first_amount, []) if u != first and u in remaining),
+                        None
+                    )
+                    if second is None:
+                        continue
+                    for other in (first, second):
+                        other_amount = remaining[other]
+                        if sign > 0:
+                            settle(other, single, -other_amount)
+                        else:
+                            settle(single, other, other_amount)
+                    found = True
+                    break
+                if found:
+                    break
+            if found:
+                break
+
+    # 3. 其余使用贪心匹配
+    transfers.extend(_settle_greedy(list(remaining.items())))
+    return transfers
+
+
+def _settle_numpy(nets: List[tuple]) -> List[tuple]:
+    """Same transfers as the greedy strategy, matched on sorted NumPy arrays."""
+    if settlement_numpy is None:
+        raise ValueError("Settlement strategy 'numpy' requires numpy to be installed")
+    transfers = settlement_numpy.greedy_transfers(nets)
+    if transfers is None:
+        # too many 1-cent remainders to resolve vectorized
+        return _settle_greedy(nets)
+    return transfers
+
+
+# strategy name -> function([(user_id, balance_cents)]) -> [(from_user_id, to_user_id, amount_cents)]
+SETTLEMENT_STRATEGIES = {
+    "greedy": _settle_greedy,
+    "exact": _settle_exact,
+    "heuristic": _settle_heuristic,
+    "numpy": _settle_numpy,
+}
+
+
+def generate_settlement_transactions(balances_list: List[Dict], member_data: Dict = None, strategy: Optional[str] = None) -> List[Dict]:
+    """
+    (🔴 修复) 生成推荐的结算交易路径
+    - 传入的 balances_list 是 [{'user_id': ..., 'final_balance': <cents>, ...}]
+    - `strategy` 选择算法 (见 SETTLEMENT_STRATEGIES)，默认 SETTLEMENT_STRATEGY
+    """
+    strategy = strategy or SETTLEMENT_STRATEGY
+    settle = SETTLEMENT_STRATEGIES.get(strategy)
+    if settle is None:
+        raise ValueError(f"Unknown settlement strategy '{strategy}'. Choose one of: {', '.join(SETTLEMENT_STRATEGIES)}")
+
+    usernames = {}
+    nets = []
+    for balance_info in balances_list:
+        member_id = balance_info['user_id']
+
+        # 获取用户名
+        username = balance_info.get('username', f"User{member_id}")
+        if member_data and member_id in member_data and 'user' in member_data[member_id]:
+             username = member_data[member_id]['user'].username or username
+        usernames[member_id] = username
+        nets.append((member_id, balance_info['final_balance']))
 
-def execute_settlement(db: Session, group_id: int, creator_id: int, description: Optional[str] = None) -> Dict:
+    return [{
+        'from_user_id': from_user_id,  # 债务人付钱
+        'to_user_id': to_user_id,      # 债权人收钱
+        'amount': amount,              # 保持分为单位
+        'description': f"结算付款：{usernames[from_user_id]} 支付给 {usernames[to_user_id]}"
+    } for from_user_id, to_user_id, amount in settle(nets)]
+
+
+def execute_settlement(db: Session, group_id: int, creator_id: int, description: Optional[str] = None, strategy: Optional[str] = None) -> Dict:
     """
     (🔴 修复) 执行群组结算操作
     创建结算交易的支付记录
     """
-    # 1. 获取结算汇总 (使用 🔴 修复后 的函数)
-    settlement_summary = get_group_settlement_summary(db, group_id)
-    
-    # 2. 准备 member_data (用于获取用户名)
-    members = get_group_members(db, group_id)
-    member_data = {member.user_id: {
-        'user': member.user,
-        'nickname': member.nickname,
-        'is_admin': member.is_admin
-    } for member in members}
-    
-    # 3. 生成推荐交易 (以分为单位) (🔴 修复：传递 'balances' 列表)
-    transactions = generate_settlement_transactions(settlement_summary['balances'], member_data)
-    
-    if not transactions:
-        raise ValueError("没有需要结算的款项")
-
-    # 4. 获取群组的 *第一个* 费用ID，用于关联支付
-    first_expense = db.query(models.Expense).filter(models.Expense.group_id == group_id).first()
-    if not first_expense:
-        raise ValueError("群组中没有任何费用，无法创建结算支付")
-    
+    # 1. 先锁定群组 (并补齐账本)：读取余额、计算交易和写入支付都在这一把锁内，
+    #    两个并发的结算请求不会读到同一份余额而重复结算
+    try:
+        _ensure_group_balance_ledger(db, group_id)
+
+        # 一次性加载结算上下文 (群组、成员、余额、总额)
+        context = load_settlement_context(db, group_id)
+        settlement_summary = build_settlement_summary(context, strategy=strategy)
+
+        # 2. 推荐交易 (以分为单位)，已由汇总生成
+        transactions = settlement_summary['transactions']
+
+        if not transactions:
+            raise ValueError("没有需要结算的款项")
+
+        # 3. 使用预加载的成员表一次性校验所有交易
+        member_ids = context['usernames']
+        for transaction in transactions:
+            if transaction['from_user_id'] not in member_ids:
+                raise ValueError(f"Payer (User {transaction['from_user_id']}) is not a member of group {group_id}")
+            if transaction['to_user_id'] not in member_ids:
+                raise ValueError(f"Payee (User {transaction['to_user_id']}) is not a member of group {group_id}")
+            if transaction['amount'] <= 0:
+                raise ValueError("Payment amount must be positive")
+
+        # 4. 获取群组的 *第一个* 费用ID，用于关联支付
+        first_expense = db.query(models.Expense.id).filter(models.Expense.group_id == group_id).order_by(models.Expense.id).first()
+        if not first_expense:
+            raise ValueError("群组中没有任何费用，无法创建结算支付")
+    except Exception:
+        db.rollback()  # 释放群组锁
+        raise
+
     reference_expense_id = first_expense.id
 
-    # 5. 创建支付记录
-    created_payments = []
-    for transaction in transactions:
-        payment_data = schemas.PaymentCreate(
-            from_user_id=transaction['from_user_id'],
-            to_user_id=transaction['to_user_id'],
-            amount=transaction['amount'],  # 已经是分
-            description=transaction.get('description', description or f'群组 {settlement_summary["group_name"]} 结算')
-        )
-        
-        try:
-            payment = create_payment(
-                db=db,
-                expense_id=reference_expense_id, # 关联到第一个费用
-                creator_id=creator_id,
-                payment=payment_data,
-                image_file=None # 🔴 修复：结算支付没有图片
-            )
-            created_payments.append(payment)
-        except Exception as e:
-            logging.error(f"创建支付记录失败: {e}")
-            db.rollback() # 回滚单次支付创建
-            continue # 继续尝试下一笔
-    
-    # 6. 创建结算审计日志
-    create_audit_log(
-        db=db,
-        group_id=group_id,
-        user_id=creator_id,
-        action="EXECUTE_SETTLEMENT",
-        details={
-            "description": description or "群组结算",
-            "transactions_created": [jsonable_encoder(p) for p in created_payments],
-            "reference_expense_id": reference_expense_id
-        }
-    )
-    
-    # 7. 提交事务 (create_payment 内部已提交，这里多提交一次以保存审计日志)
+    # 5. 一条多行 INSERT 写入所有支付记录，账本、审计日志在同一事务内原子提交
+    now = datetime.now()
+    payment_rows = [{
+        'expense_id': reference_expense_id, # 关联到第一个费用
+        'from_user_id': transaction['from_user_id'],
+        'to_user_id': transaction['to_user_id'],
+        'amount': transaction['amount'],  # 已经是分
+        'description': transaction.get('description', description or f'群组 {settlement_summary["group_name"]} 结算'),
+        'payment_date': now.date(),
+        'created_at': now,
+        'creator_id': creator_id,
+        'image_url': None, # 结算支付没有图片
+    } for transaction in transactions]
+
     try:
+        created_rows = db.execute(
+            insert(models.Payment).values(payment_rows).returning(
+                models.Payment.id, models.Payment.from_user_id, models.Payment.to_user_id, models.Payment.amount
+            )
+        ).all()
+        created_payment_ids = [row.id for row in created_rows]
+
+        _apply_balance_deltas(db, group_id, _merge_deltas(*[
+            _payment_balance_deltas(row['from_user_id'], row['to_user_id'], row['amount'])
+            for row in payment_rows
+        ]))
+
+        # 6. 创建一条汇总的结算审计日志
+        create_audit_log(
+            db=db,
+            group_id=group_id,
+            user_id=creator_id,
+            action="EXECUTE_SETTLEMENT",
+            details={
+                "description": description or "群组结算",
+                "strategy": strategy or SETTLEMENT_STRATEGY,
+                "transactions_created": [{
+                    "payment_id": row.id,
+                    "from_user_id": row.from_user_id,
+                    "to_user_id": row.to_user_id,
+                    "amount": row.amount
+                } for row in created_rows],
+                "reference_expense_id": reference_expense_id
+            }
+        )
+
+        # 7. 记录结算检查点，之后的余额计算只需扫描此后的记录
+        _write_settlement_checkpoint(db, group_id, created_by=creator_id)
+
+        # 8. 一次提交：要么全部成功，要么全部回滚
         db.commit()
     except Exception as e:
         db.rollback()
-        logging.error(f"提交结算审计日志失败: {e}")
+        logging.error(f"结算写入失败，已回滚 group {group_id}: {e}")
+        raise
 
-    # 8. 获取 *新* 的结算汇总
-    new_settlement_summary = get_group_settlement_summary(db, group_id)
+    # 9. 在内存中应用已创建的支付，得到 *新* 的结算汇总 (无需重新查询)
+    for transaction in transactions:
+        for user_id, delta in _payment_balance_deltas(transaction['from_user_id'], transaction['to_user_id'], transaction['amount']).items():
+            if user_id in context['balances']:
+                context['balances'][user_id] += delta
+    new_settlement_summary = build_settlement_summary(context, strategy=strategy)
 
     return {
         'success': True,
-        'message': f'结算成功完成，创建了 {len(created_payments)} 笔支付记录',
+        'message': f'结算成功完成，创建了 {len(created_payment_ids)} 笔支付记录',
         'settlement_summary': new_settlement_summary, # 返回最新的汇总
         'transactions': transactions,
-        'created_payments': [p.id for p in created_payments]
+        'created_payments': created_payment_ids
     }
\ No newline at end of file
@@ -0,0 +1,135 @@
+# crud_async.py  async (AsyncSession) variants of the hot read paths in crud.py
+# Used by app/async_routes.py when ASYNC_READS is enabled. Results match the
+# sync functions of the same name; relationships the response models need are
+# eager loaded because an AsyncSession cannot lazy load.
+import asyncio
+from itertools import islice
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from app import audit_partitions, crud, database, models, schemas
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+
+async def get_group_by_id(db: AsyncSession, group_id: int) -> Optional[models.Group]:
+    return await db.get(models.Group, group_id)
+
+
+async def get_group_member(db: AsyncSession, group_id: int, user_id: int) -> Optional[models.GroupMember]:
+    result = await db.execute(
+        select(models.GroupMember).where(
+            models.GroupMember.group_id == group_id,
+            models.GroupMember.user_id == user_id,
+        )
+    )
+    return result.scalars().first()
+
+
+async def get_group_members(db: AsyncSession, group_id: int) -> List[models.GroupMember]:
+    """Return all members in a group"""
+    result = await db.execute(
+        select(models.GroupMember)
+        .where(models.GroupMember.group_id == group_id)
+        .options(joinedload(models.GroupMember.user))
+    )
+    return result.scalars().all()
+
+
+async def get_group_expenses_page(db: AsyncSession, group_id: int, fields: Optional[str] = None, limit: Optional[int] = None, **filters):
+    """Async crud.get_group_expenses_page; returns (items, next_cursor)."""
+    if limit is not None and not 1 <= limit <= crud.EXPENSE_PAGE_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {crud.EXPENSE_PAGE_MAX_LIMIT}")
+    field_list = crud._parse_expense_fields(fields)
+    query = crud.build_group_expenses_query(
+        group_id, limit=limit, fields=field_list,
+        nulls_first=db.bind.dialect.name == "postgresql", **filters
+    )
+    expenses = (await db.execute(query)).scalars().all()
+    return crud.paginate_expenses(expenses, limit, field_list)
+
+
+async def get_audit_logs(db: AsyncSession, group_id: int) -> List[models.AuditLog]:
+    """Retrieve all audit logs for a specific group, ordered by most recent."""
+    result = await db.execute(
+        select(models.AuditLog)
+        .options(joinedload(models.AuditLog.user))
+        .where(models.AuditLog.group_id == group_id)
+        .order_by(models.AuditLog.timestamp.desc(), models.AuditLog.id.desc())
+    )
+    return result.scalars().all()
+
+
+async def get_audit_logs_page(db: AsyncSession, group_id: int, limit: Optional[int] = None,
+                              cursor: Optional[str] = None, page: Optional[int] = None,
+                              archived: bool = False, **filters):
+    """Async crud.get_audit_logs_page; returns (logs, next_cursor)."""
+    limit = limit or crud.AUDIT_PAGE_DEFAULT_LIMIT
+    if not 1 <= limit <= crud.AUDIT_PAGE_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {crud.AUDIT_PAGE_MAX_LIMIT}")
+    # the sync page assembly of crud.get_audit_logs_page; archive files are read off the event loop
+    items = await db.run_sync(lambda session: crud.audit_live_page_items(
+        session, group_id, limit, cursor=cursor, page=page, **filters
+    ))
+    items += await asyncio.to_thread(
+        crud.audit_archive_page_items, group_id, limit, len(items),
+        cursor=cursor, page=page, archived=archived, **filters
+    )
+    return await db.run_sync(lambda session: crud.audit_page_result(session, items, limit))
+
+
+async def iter_audit_logs_ndjson(group_id: int, archived: bool = False, **filters):
+    """
+    Async crud.iter_audit_logs_ndjson, streaming from a server-side cursor on its
+    own session; shards and archive files follow in AUDIT_EXPORT_BATCH sized reads.
+    """
+    batch = crud.AUDIT_EXPORT_BATCH
+    async with database.AsyncSessionLocal() as db:
+        query = crud.build_audit_logs_query(group_id, db.bind.dialect.name, **filters)
+        result = await db.stream(query.execution_options(yield_per=batch))
+        async for log in result.scalars():
+            yield schemas.AuditLog.model_validate(log).model_dump_json() + "\n"
+        # the sync shard generator, advanced one batch per run_sync call
+        shards = audit_partitions.iter_shards(db.sync_session, group_id, batch, **filters)
+        while True:
+            shard_items = await db.run_sync(lambda session: list(islice(shards, batch)))
+            for log, _ in shard_items:
+                yield log.model_dump_json() + "\n"
+            if len(shard_items) < batch:
+                break
+    if archived:
+        # the archive files are read in a worker thread, one batch at a time
+        archive = audit_partitions.iter_archives(group_id, **filters)
+        try:
+            while True:
+                logs = await asyncio.to_thread(lambda: list(islice(archive, batch)))
+                for log in logs:
+                    yield log.model_dump_json() + "\n"
+                if len(logs) < batch:
+                    break
+        finally:
+            archive.close()
+
+
+async def get_group_settlement_summary(
+    db: AsyncSession,
+    group_id: int,
+    mode: Optional[str] = None,
+    strategy: Optional[str] = None
+) -> Dict:
+    """
+    Settlement summary over the async connection. Balances are loaded with the
+    sync crud.load_settlement_context through run_sync (reads only: the ledger
+    is backfilled by migration 0009 / the write paths, never here). Matching
+    the transactions is CPU bound (the exact strategy's subset search, the
+    heuristic's time budget), so build_settlement_summary runs in a worker
+    thread instead of on the event loop.
+    """
+    context = await db.run_sync(lambda session: crud.load_settlement_context(session, group_id, mode=mode))
+    return await asyncio.to_thread(crud.build_settlement_summary, context, strategy)
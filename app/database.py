@@ -3,12 +3,36 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 
+from app.pool_metrics import InstrumentedQueuePool
+
 
 DATABASE_URL = os.getenv(
     "DATABASE_URL", "postgresql+psycopg2://postgres:postgres@db:5432/project_pg12"
 )
 
-engine = create_engine(DATABASE_URL)
+# connection pool, sized per deployment (defaults match SQLAlchemy's QueuePool,
+# plus pre-ping and a 30 min recycle so stale Postgres connections are replaced)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, -1 disables
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+
+def _engine_options(url: str) -> dict:
+    if url.startswith("sqlite") and (":memory:" in url or url.rstrip("/") == "sqlite:"):
+        return {}  # in-memory SQLite needs its single-connection pool
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -19,3 +43,42 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# ----------- async engine (opt-in per deployment) -----------
+# ASYNC_READS=true serves the hot read endpoints (members, expenses, audit
+# trail, settlement reads) from async routes on asyncpg / aiosqlite instead of
+# sync routes on Starlette's 40-thread pool. Writes stay on the sync engine.
+ASYNC_READS = os.getenv("ASYNC_READS", "false").lower() in ("1", "true", "yes")
+
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return _ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_database_url(DATABASE_URL))
+
+async_engine = None
+AsyncSessionLocal = None
+
+if ASYNC_READS:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    _async_options = {}
+    if not ASYNC_DATABASE_URL.startswith("sqlite"):  # aiosqlite manages its own connections
+        _async_options = _engine_options(ASYNC_DATABASE_URL)
+        _async_options.pop("poolclass", None)  # async engines bring their own adapted pool
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **_async_options)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,51 +1,105 @@
-from fastapi import Depends, HTTPException, status, Path
+from fastapi import Depends, HTTPException, status, Path, Header
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
-from typing import Annotated, List
+from typing import Annotated, List, Optional
 from datetime import timedelta
+import os
 
-from app import crud, auth, database, schemas, models
+from app import crud, crud_async, auth, database, schemas, models, user_cache
 from app.models import User, Group, GroupMember
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+_MISSING = object()
 
-def get_current_user(
-    db: Session = Depends(database.get_db), token: str = Depends(oauth2_scheme)
-) -> User:
 
-    credentials_exception = HTTPException(
+class RequestContext:
+    """
+    Request-scoped memo of the identity rows every authenticated route needs.
+
+    FastAPI resolves `get_request_context` once per request, so the auth
+    dependencies and the route body all share one instance: the user, group
+    and membership rows are loaded at most once each, misses included.
+    Nothing survives past the request.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._groups = {}
+        self._members = {}
+
+    def get_group(self, group_id: int):
+        group = self._groups.get(group_id, _MISSING)
+        if group is _MISSING:
+            group = crud.get_group_by_id(self.db, group_id=group_id)
+            self._groups[group_id] = group
+        return group
+
+    def get_member(self, group_id: int, user_id: int):
+        key = (group_id, user_id)
+        member = self._members.get(key, _MISSING)
+        if member is _MISSING:
+            member = crud.get_group_member(self.db, group_id=group_id, user_id=user_id)
+            self._members[key] = member
+        return member
+
+    def forget_member(self, group_id: int, user_id: int):
+        """Drop a memoized membership after the route adds / removes it."""
+        self._members.pop((group_id, user_id), None)
+
+
+def get_request_context(db: Session = Depends(database.get_db)) -> RequestContext:
+    return RequestContext(db)
+
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+
+def _token_subject(token: str) -> str:
+    """Decodes the JWT and returns its subject (the user's email)."""
     try:
         payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
         user_email: str = payload.get("sub")
 
         if user_email is None:
-            raise credentials_exception
+            raise _credentials_exception()
 
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+
+    return user_email
 
-    user = crud.get_user_by_email(db, email=user_email)
 
+def get_current_user(
+    ctx: RequestContext = Depends(get_request_context), token: str = Depends(oauth2_scheme)
+) -> user_cache.UserSnapshot:
+    user_email = _token_subject(token)
+    user = user_cache.get_cached_user(user_email)
     if user is None:
-        raise credentials_exception
+        db_user = crud.get_user_by_email(ctx.db, email=user_email)
+
+        if db_user is None:
+            raise _credentials_exception()
+
+        user = user_cache.UserSnapshot.from_user(db_user)
+        user_cache.cache_user(user_email, user)
 
     return user
 
 
 def verify_group_owner(
     group_id: int,
-    db: Session = Depends(database.get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: User = Depends(get_current_user),
 ):
-    group = db.query(Group).filter(Group.id == group_id).first()
+    group = ctx.get_group(group_id)
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     if group.admin_id != current_user.id:
@@ -57,18 +111,14 @@ def verify_group_owner(
 
 def get_group_with_access_check(
     group_id: int,
-    db: Session = Depends(database.get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: User = Depends(get_current_user),
 ):
-    group = db.query(Group).filter(Group.id == group_id).first()
+    group = ctx.get_group(group_id)
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
 
-    member = (
-        db.query(GroupMember)
-        .filter_by(group_id=group_id, user_id=current_user.id)
-        .first()
-    )
+    member = ctx.get_member(group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=403, detail="You are not a member of this group"
@@ -79,11 +129,11 @@ def get_group_with_access_check(
 ### add by sunzhe for US 5 20 Oct###################
 def verify_group_admin(
     group: models.Group = Depends(get_group_with_access_check),
-    db: Session = Depends(database.get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: User = Depends(get_current_user),
 ):
     """Dependency that checks if the current user is an admin of the group."""
-    member = crud.get_group_member(db, group_id=group.id, user_id=current_user.id)
+    member = ctx.get_member(group.id, current_user.id)
     if not member or not member.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -92,6 +142,85 @@ def verify_group_admin(
     return group
 #######################################################
 
+# ----------- async variants (ASYNC_READS) -----------
+
+class AsyncRequestContext:
+    """RequestContext for async routes: same per-request memo over an AsyncSession."""
+
+    def __init__(self, db):
+        self.db = db
+        self._groups = {}
+        self._members = {}
+
+    async def get_group(self, group_id: int):
+        group = self._groups.get(group_id, _MISSING)
+        if group is _MISSING:
+            group = await crud_async.get_group_by_id(self.db, group_id)
+            self._groups[group_id] = group
+        return group
+
+    async def get_member(self, group_id: int, user_id: int):
+        key = (group_id, user_id)
+        member = self._members.get(key, _MISSING)
+        if member is _MISSING:
+            member = await crud_async.get_group_member(self.db, group_id, user_id)
+            self._members[key] = member
+        return member
+
+
+async def get_async_request_context(db=Depends(database.get_async_db)) -> AsyncRequestContext:
+    return AsyncRequestContext(db)
+
+
+async def get_current_user_async(
+    ctx: AsyncRequestContext = Depends(get_async_request_context), token: str = Depends(oauth2_scheme)
+) -> user_cache.UserSnapshot:
+    user_email = _token_subject(token)
+    user = user_cache.get_cached_user(user_email)
+    if user is None:
+        db_user = await crud_async.get_user_by_email(ctx.db, email=user_email)
+
+        if db_user is None:
+            raise _credentials_exception()
+
+        user = user_cache.UserSnapshot.from_user(db_user)
+        user_cache.cache_user(user_email, user)
+
+    return user
+
+
+async def get_group_with_access_check_async(
+    group_id: int,
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+    current_user: user_cache.UserSnapshot = Depends(get_current_user_async),
+):
+    group = await ctx.get_group(group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+
+    member = await ctx.get_member(group_id, current_user.id)
+    if not member:
+        raise HTTPException(
+            status_code=403, detail="You are not a member of this group"
+        )
+
+    return group
+
+
+async def verify_group_admin_async(
+    group: models.Group = Depends(get_group_with_access_check_async),
+    ctx: AsyncRequestContext = Depends(get_async_request_context),
+    current_user: user_cache.UserSnapshot = Depends(get_current_user_async),
+):
+    """Dependency that checks if the current user is an admin of the group."""
+    member = await ctx.get_member(group.id, current_user.id)
+    if not member or not member.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You must be an admin to perform this action.",
+        )
+    return group
+
 # ----------- invite -----------
 
 def get_pending_invitation_as_invitee(
@@ -125,3 +254,18 @@ def get_pending_invitation_as_invitee(
 
     return db_invitation
 
+
+# ----------- internal endpoints -----------
+
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN")
+
+
+def verify_internal_token(x_internal_token: Optional[str] = Header(None)):
+    """
+    Guards /internal/* routes. They are disabled (404) unless INTERNAL_API_TOKEN
+    is set, and then require it in the X-Internal-Token header.
+    """
+    if not INTERNAL_API_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if x_internal_token != INTERNAL_API_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid internal token")
@@ -0,0 +1,218 @@
+# images.py  receipt image variants: thumbnail + capped "display" copy
+#
+# When a session commits an Expense / Payment whose image_url is an uploaded
+# image, the variants are rendered in a process pool (Pillow decoding and
+# resizing is CPU bound and holds the GIL) and stored next to the original:
+#
+#   <key>.thumb.webp     IMAGE_THUMBNAIL_SIZE px box, for lists
+#   <key>.display.jpg    IMAGE_DISPLAY_SIZE px box, for the detail view
+#
+# Both are re-encoded from the pixels only, so EXIF (GPS position, camera,
+# ...) is dropped; the orientation tag is applied first. When a render
+# finishes, thumbnail_url / display_url (storage keys, like image_url) are set
+# on every row with that image_url. Until then (and for PDFs / HEIC) they stay
+# NULL and clients fall back to image_url. Rows reusing content whose variants
+# already exist get them right after the commit: the render finds them stored
+# and only records them.
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+from PIL import Image, ImageOps
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session, object_session
+
+from app import models, storage
+from app.database import engine
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))  # 0 disables variants
+IMAGE_THUMBNAIL_SIZE = int(os.getenv("IMAGE_THUMBNAIL_SIZE", "320"))
+IMAGE_DISPLAY_SIZE = int(os.getenv("IMAGE_DISPLAY_SIZE", "1600"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+# refuse to decode anything bigger (decompression bombs); ~50 MP covers phone cameras
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+
+# variant -> (suffix, Pillow format, content type, box size)
+VARIANTS = {
+    "thumb": (".thumb.webp", "WEBP", "image/webp", IMAGE_THUMBNAIL_SIZE),
+    "display": (".display.jpg", "JPEG", "image/jpeg", IMAGE_DISPLAY_SIZE),
+}
+_SOURCE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+_PENDING_KEY = "pending_image_variants"
+
+logger = logging.getLogger("images")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _source_key(image_url: Optional[str]) -> Optional[str]:
+    """Storage key behind `image_url` if it is an upload Pillow can render, else None."""
+    key = storage.key_from_value(image_url)
+    if not key or os.path.splitext(key)[1].lower() not in _SOURCE_EXTENSIONS:
+        return None
+    return key
+
+
+def variant_key(key: str, variant: str) -> str:
+    return os.path.splitext(key)[0] + VARIANTS[variant][0]
+
+
+# ----------- rendering (runs in the worker processes) -----------
+
+def _render(source_path: str, work_dir: str, backend: storage.BlobStorage, key: str):
+    with Image.open(source_path) as original:
+        original.draft("RGB", (IMAGE_DISPLAY_SIZE, IMAGE_DISPLAY_SIZE))  # JPEG: decode at reduced scale
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        for variant, (_, image_format, content_type, size) in VARIANTS.items():
+            target = variant_key(key, variant)
+            if backend.exists(target):
+                continue
+            copy = image.copy()
+            copy.thumbnail((size, size), Image.LANCZOS)
+            if image_format == "JPEG" and copy.mode != "RGB":
+                background = Image.new("RGB", copy.size, "white")
+                background.paste(copy, mask=copy.getchannel("A"))
+                copy = background
+            # no exif= / icc_profile= passed: the new file carries pixels only
+            out_path = os.path.join(work_dir, variant)
+            copy.save(out_path, image_format, quality=IMAGE_QUALITY, optimize=image_format == "JPEG")
+            backend.put_file(target, out_path, content_type)
+
+
+def render_variants(key: str) -> bool:
+    """Stores every missing variant of `key`; returns False if the image can't be decoded."""
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    backend = storage.get_storage()
+    if all(backend.exists(variant_key(key, variant)) for variant in VARIANTS):
+        return True  # content uploaded again: nothing to render, only to record
+    try:
+        # work next to the uploads so local puts are renames on the same filesystem
+        os.makedirs(os.path.join(storage.UPLOAD_DIR, ".tmp"), exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=os.path.join(storage.UPLOAD_DIR, ".tmp")) as work_dir:
+            source_path = backend.local_path(key)
+            if source_path is None:
+                source_path = os.path.join(work_dir, "source")
+                backend.get_file(key, source_path)
+            _render(source_path, work_dir, backend, key)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"images: cannot render variants of {key}: {e}")
+        return False
+
+
+# ----------- scheduling -----------
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # not fork: the app process runs threads (server, schedulers, audit writer)
+            # whose locks a forked child could inherit held
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+        return _pool
+
+
+def shutdown_pool(wait: bool = False):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=wait, cancel_futures=not wait)
+            _pool = None
+
+
+def _record_variants(image_url: str, future: Future):
+    """Done callback: stores the variant keys on the rows showing `image_url`."""
+    try:
+        if not future.result():
+            return
+        key = _source_key(image_url)
+        thumbnail_url, display_url = variant_key(key, "thumb"), variant_key(key, "display")
+        with engine.begin() as connection:
+            for model in (models.Expense, models.Payment):
+                connection.execute(
+                    update(model).where(model.image_url == image_url)
+                    .values(thumbnail_url=thumbnail_url, display_url=display_url)
+                )
+    except Exception as e:
+        logger.error(f"images: could not record variants of {image_url}: {e}")
+
+
+def schedule(image_url: str) -> Optional[Future]:
+    """Queues rendering of `image_url`'s variants; None if it isn't a renderable upload."""
+    key = _source_key(image_url)
+    if key is None or IMAGE_WORKERS <= 0:
+        return None
+    future = _get_pool().submit(render_variants, key)
+    future.add_done_callback(lambda done: _record_variants(image_url, done))
+    return future
+
+
+# ----------- hooks on Expense / Payment -----------
+
+def _queue_variants(target):
+    # runs inside the flush, so no storage calls: the variant columns are set
+    # by _record_variants once the render (or the check that they exist) is done
+    target.thumbnail_url = target.display_url = None
+    if _source_key(target.image_url):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(_PENDING_KEY, set()).add(target.image_url)
+
+
+def _before_insert(mapper, connection, target):
+    _queue_variants(target)
+
+
+def _before_update(mapper, connection, target):
+    if inspect(target).attrs.image_url.history.has_changes():
+        _queue_variants(target)
+
+
+for _model in (models.Expense, models.Payment):
+    event.listen(_model, "before_insert", _before_insert)
+    event.listen(_model, "before_update", _before_update)
+
+
+@event.listens_for(Session, "after_commit")
+def _render_committed(session):
+    # uploads publishes the originals before the commit, so they are in place here
+    for image_url in session.info.pop(_PENDING_KEY, ()):
+        try:
+            schedule(image_url)
+        except Exception as e:
+            logger.error(f"images: could not queue {image_url}: {e}")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_rolled_back(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def backfill() -> int:
+    """Renders and records variants for rows that have an image but no thumbnail (e.g. older uploads)."""
+    image_urls = set()
+    with engine.connect() as connection:
+        for model in (models.Expense, models.Payment):
+            image_urls.update(connection.execute(
+                select(model.image_url).where(model.image_url.isnot(None), model.thumbnail_url.is_(None)).distinct()
+            ).scalars())
+    scheduled = sum(schedule(image_url) is not None for image_url in sorted(image_urls))
+    shutdown_pool(wait=True)  # waits for the renders and their done callbacks
+    return scheduled
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ["backfill"]:
+        print("usage: python -m app.images backfill")
+        sys.exit(2)
+    print(f"rendered variants for {backfill()} image(s)")
@@ -1,17 +1,18 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Response, Request, File, UploadFile, Form
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Request, File, UploadFile, Form, Query
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError # 03 Nov
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from sqlalchemy import func
-from typing import Annotated, List, Dict
+from typing import Annotated, List, Dict, Optional
 from datetime import timedelta, date, datetime # 🔴 修复：导入 datetime
 import logging, json
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from app.database import SessionLocal
 import traceback
 from fastapi.templating import Jinja2Templates
-from app import schemas, crud, models, database, auth
+from app import schemas, crud, models, database, auth, pool_metrics, audit_writer, audit_partitions, uploads, images, storage, recurring_scheduler
 from .database import engine, Base, get_db
 from app.dependencies import (
     get_current_user,
@@ -19,6 +20,9 @@ from app.dependencies import (
     verify_group_owner,
     verify_group_admin,
     get_pending_invitation_as_invitee,
+    get_request_context,
+    RequestContext,
+    verify_internal_token,
 )
 
 
@@ -36,17 +40,20 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 #app.include_router(pages_router)
 
+# async read endpoints must be registered before the sync routes they replace
+if database.ASYNC_READS:
+    from app.async_routes import async_read_router
+    app.include_router(async_read_router)
 
-def check_recurring_expenses_job():
-    logging.info("Scheduler: Running recurring expense check...")
-    db = SessionLocal() # Create a new session
+
+def audit_maintenance_job():
     try:
-        crud.process_due_recurring_expenses(db)
+        audit_partitions.run_maintenance()
     except Exception as e:
-        logging.error(f"Scheduler: Error in recurring expense job: {e}")
-        db.rollback() # Rollback on any unexpected error
-    finally:
-        db.close() # Always close the session
+        logging.error(f"Scheduler: Error in audit maintenance job: {e}")
+
+def uploads_gc_job():
+    uploads.collect_garbage()
 
 scheduler = AsyncIOScheduler()
 
@@ -54,19 +61,18 @@ scheduler = AsyncIOScheduler()
 def start_scheduler():
     logging.warning("--- Attempting to start scheduler... ---")
     try:
-        logging.warning("Adding job 'check_recurring_expenses_job'...")
-
         if not scheduler:
              logging.error("Scheduler instance is NOT available!")
              return
 
-        scheduler.add_job(check_recurring_expenses_job, 'interval', minutes=1)
-        logging.warning("Job added successfully.")
+        if audit_partitions.AUDIT_PARTITIONING or audit_partitions.AUDIT_RETENTION_MONTHS > 0:
+            scheduler.add_job(audit_maintenance_job, 'interval', hours=6, next_run_time=datetime.now())
+        scheduler.add_job(uploads_gc_job, 'interval', hours=1)
 
         logging.warning("Attempting to start scheduler...")
         scheduler.start()
 
-        logging.warning("Scheduler started... Job will run every MINUTES.")
+        logging.warning("Scheduler started.")
 
     except Exception as e:
         logging.error("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
@@ -85,6 +91,36 @@ def shutdown_scheduler():
             logging.warning("Scheduler was not running, no need to shut down.")
     except Exception as e:
         logging.error(f"Error during scheduler shutdown: {e}")
+    auth.shutdown_password_pool()
+    images.shutdown_pool()
+    uploads.shutdown_gc_pool()
+
+
+@app.on_event("startup")
+async def start_recurring_scheduler():
+    if recurring_scheduler.RECURRING_SCHEDULER == "embedded":
+        recurring_scheduler.scheduler.start()
+
+
+@app.on_event("shutdown")
+async def stop_recurring_scheduler():
+    await recurring_scheduler.scheduler.stop()
+
+
+@app.on_event("startup")
+def start_audit_writer():
+    audit_writer.start()
+
+
+@app.on_event("shutdown")
+def stop_audit_writer():
+    audit_writer.stop()
+
+
+@app.on_event("shutdown")
+async def dispose_async_engine():
+    if database.async_engine is not None:
+        await database.async_engine.dispose()
 
 # --- END OF SCHEDULER SETUP ---
 
@@ -93,14 +129,17 @@ def shutdown_scheduler():
 @app.post(
     "/users/signup", response_model=schemas.User, status_code=status.HTTP_201_CREATED
 )
-def create_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def create_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
+    db_user = await run_in_threadpool(crud.get_user_by_email, db, email=user.email)
 
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered"
         )
-    return crud.create_user(db=db, user=user)
+    # bcrypt runs in the bounded password pool (PASSWORD_HASH_WORKERS), without a pooled connection
+    await run_in_threadpool(db.rollback)
+    hashed_password = await auth.get_password_hash_async(user.password)
+    return await run_in_threadpool(crud.create_user, db, user, hashed_password)
 
 
 @app.post("/token", response_model=schemas.Token)
@@ -108,7 +147,7 @@ async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     db: Session = Depends(get_db),
 ):
-    user = auth.authenticate_user(
+    user = await auth.authenticate_user_async(
         db, email=form_data.username, password=form_data.password
     )
     if not user:
@@ -135,6 +174,15 @@ def read_current_user_profile(current_user: models.User = Depends(get_current_us
     return current_user
 
 
+@app.get("/internal/pool-stats", include_in_schema=False, dependencies=[Depends(verify_internal_token)])
+def read_pool_stats():
+    """Live DB connection pool gauges and checkout wait histogram."""
+    stats = pool_metrics.pool_status(engine)
+    if database.async_engine is not None:
+        stats["async_pool"] = pool_metrics.pool_status(database.async_engine.sync_engine)
+    return stats
+
+
 @app.get("/users/{user_id}", response_model=schemas.User)
 def read_user(user_id: int, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_id(db, user_id=user_id)
@@ -168,6 +216,7 @@ def read_user_groups(
 def read_group(
     group_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
     """
@@ -179,13 +228,13 @@ def read_group(
     print(f"当前用户: {current_user.id} - {current_user.username}")
 
     # 1. 检查群组是否存在
-    group = crud.get_group_by_id(db=db, group_id=group_id)
+    group = ctx.get_group(group_id)
     if not group:
         print("错误: 群组不存在")
         raise HTTPException(status_code=404, detail="Group not found")
 
     # 2. 检查用户是否是群组成员
-    member = crud.get_group_member(db=db, user_id=current_user.id, group_id=group_id)
+    member = ctx.get_member(group_id, current_user.id)
     if not member:
         print("错误: 用户不是群组成员")
         raise HTTPException(status_code=403, detail="Not a member of this group")
@@ -194,7 +243,7 @@ def read_group(
     try:
         # 3. 调用结算逻辑获取整个群组的余额
         # 注意：这里我们复用结算API的逻辑，而不是重新计算
-        settlement_summary = crud.get_group_settlement_summary(db, group_id)
+        settlement_summary = crud.get_group_settlement_summary(db, group_id, group=group)
         
         user_balance_owed = 0.0
         user_balance_owing = 0.0
@@ -308,6 +357,7 @@ def add_member_to_group(
     group_id: int,
     user_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     #change back to only admin can add member 28 oct
     group: models.Group = Depends(verify_group_admin),
@@ -323,6 +373,7 @@ def add_member_to_group(
     db_member = crud.add_group_member(
         db, group_id=group_id, user_id=user_id, inviter_username=current_user.username
     )
+    ctx.forget_member(group_id, user_id)
     if db_member is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -336,6 +387,7 @@ def remove_member_from_group(
     group_id: int,
     user_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     group: models.Group = Depends(verify_group_owner),
 ):
     """Remove a member from a group (requires group admin)."""
@@ -346,6 +398,7 @@ def remove_member_from_group(
         )
 
     success = crud.remove_group_member(db, group_id=group_id, user_id=user_id)
+    ctx.forget_member(group_id, user_id)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -360,12 +413,13 @@ def update_member_nickname(
     user_id: int,
     nickname_update: schemas.GroupMemberUpdate,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
     """Update a member's nickname (member can change own nickname; any admin can change anyone's)."""
 
-    db_member = crud.get_group_member(db, group_id=group_id, user_id=user_id)
+    db_member = ctx.get_member(group_id, user_id)
     if db_member is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -373,7 +427,7 @@ def update_member_nickname(
         )
 
     if current_user.id != user_id:
-        current_member = crud.get_group_member(db, group_id=group_id, user_id=current_user.id)
+        current_member = ctx.get_member(group_id, current_user.id)
         if not current_member or not current_member.is_admin:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -395,11 +449,12 @@ def update_member_admin_status(
     user_id: int,
     admin_update: schemas.GroupMemberAdminUpdate,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(verify_group_owner),
 ):
     """Update a member's admin status (requires group admin)."""
-    db_member = crud.get_group_member(db, group_id=group_id, user_id=user_id)
+    db_member = ctx.get_member(group_id, user_id)
     if db_member is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -436,6 +491,7 @@ def invite_member_to_group(
     invitation_data: schemas.GroupInvitationCreate,
     group: models.Group = Depends(get_group_with_access_check),
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
 ):
     """
@@ -449,7 +505,7 @@ def invite_member_to_group(
             detail="User with this email not found"
         )
 
-    existing_member = crud.get_group_member(db, group_id=group.id, user_id=invitee.id)
+    existing_member = ctx.get_member(group.id, invitee.id)
     if existing_member:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -502,6 +558,7 @@ def respond_to_invitation(
     action_data: schemas.InvitationAction,
     invitation: models.GroupInvitation = Depends(get_pending_invitation_as_invitee),
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
 ):
     """
@@ -515,6 +572,7 @@ def respond_to_invitation(
             user_id=current_user.id,
             inviter_username=invitation.inviter.username
         )
+        ctx.forget_member(invitation.group_id, current_user.id)
         if db_member is None:
             invitation.status = models.InvitationStatus.REJECTED
             db.commit()
@@ -545,8 +603,74 @@ def respond_to_invitation(
 # -------------- END 28 Oct --------------------------------- #
 
 # ----------- Expense Routes (US7, US9) -----------
+
+async def _stage_upload_without_connection(db: Session, image_file: Optional[UploadFile], image_key: Optional[str] = None):
+    """
+    Streams an uploaded receipt to a temp file (app/uploads.py), or checks the
+    direct upload named by `image_key`, and publishes it to storage. The reads
+    done by the dependencies are finished, so their pooled connection is handed
+    back first instead of being held while the disk write / storage request runs;
+    the transaction that follows only references the key.
+    """
+    has_file = image_file is not None and bool(image_file.filename)
+    if has_file and image_key:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Send either image_file or image_key, not both")
+    if not has_file and not image_key:
+        return None
+    await run_in_threadpool(db.rollback)
+    try:
+        if image_key:
+            upload = await run_in_threadpool(uploads.check_stored, image_key)
+        else:
+            upload = await uploads.stage_upload(image_file)
+    except uploads.UploadTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except uploads.UploadRejected as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        return await run_in_threadpool(uploads.publish, upload)
+    finally:
+        upload.discard()  # the staged temp file, if it wasn't moved into storage
+
+@app.post("/uploads/presign", response_model=schemas.UploadPresignResponse)
+def presign_upload(
+    request: schemas.UploadPresignRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    """
+    Direct receipt upload, step 1: where to send the file's bytes. The client
+    sends them there (skipped when `upload` is null: the content is stored
+    already), then passes `key` as image_key when creating the expense / payment.
+    404 when direct uploads are disabled (local storage without STORAGE_SIGNING_KEY).
+    """
+    if not storage.DIRECT_UPLOADS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Direct uploads are disabled")
+    try:
+        return uploads.presign(db, request.sha256, request.size, request.content_type)
+    except uploads.UploadTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except uploads.UploadRejected as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@app.put(storage.DIRECT_UPLOAD_PATH + "/{key:path}", status_code=status.HTTP_204_NO_CONTENT)
+async def put_direct_upload(key: str, expires: int, size: int, signature: str, request: Request):
+    """Target of local-backend upload URLs (the signed URL is the authorization)."""
+    if storage.STORAGE_BACKEND != "local" or not storage.DIRECT_UPLOADS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    if not storage.verify_direct_upload(key, expires, size, signature):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Upload URL is invalid or expired")
+    try:
+        await uploads.receive_direct_upload(key, size, request.stream())
+    except uploads.UploadTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except uploads.UploadRejected as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 @app.post("/groups/{group_id}/expenses", response_model=schemas.ExpenseWithSplits, status_code=status.HTTP_201_CREATED)
-def create_expense_in_group(
+async def create_expense_in_group(
     group_id: int,
     # 🚨 关键修改 1: 将 Pydantic Body 替换为 Form 字段
     description: str = Form(...),
@@ -558,6 +682,7 @@ def create_expense_in_group(
     
     # 🚨 关键修改 2: 新增 UploadFile 字段用于接收文件
     image_file: UploadFile = File(None), 
+    image_key: Optional[str] = Form(None),  # 直传存储后的 key (POST /uploads/presign)
     
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
@@ -588,14 +713,19 @@ def create_expense_in_group(
         image_url=None 
     )
 
-    # 🚨 关键修改 3: 调用 CRUD 函数，并传递 image_file 对象
-    result = crud.create_expense(
-        db=db,
-        group_id=group_id,
-        creator_id=current_user.id,
-        expense=expense_data,
-        image_file=image_file # 传递 UploadFile 对象
-    )
+    # 🚨 关键修改 3: 先把上传文件流式写入并发布到存储 (事务开始之前), 再调用 CRUD 函数
+    upload = await _stage_upload_without_connection(db, image_file, image_key)
+    try:
+        result = await run_in_threadpool(
+            crud.create_expense,
+            db=db,
+            group_id=group_id,
+            creator_id=current_user.id,
+            expense=expense_data,
+            upload=upload, # 事务内只引用已发布文件的 key
+        )
+    except uploads.UploadRejected as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     return result["expense"]
 
 # ------------------- [END MODIFIED BLOCK: create_expense_in_group] -------------------
@@ -655,16 +785,47 @@ def create_expense_in_group(
     )
     return result["expense"]
 
-@app.get("/groups/{group_id}/expenses", response_model=List[schemas.ExpenseWithSplits])
+@app.get(
+    "/groups/{group_id}/expenses",
+    response_model=List[schemas.ExpenseListItem],
+    response_model_exclude_unset=True,
+)
 def read_group_expenses(
     group_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=crud.EXPENSE_PAGE_MAX_LIMIT),
+    payer_id: Optional[int] = None,
+    participant_id: Optional[int] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    min_amount: Optional[int] = None,
+    max_amount: Optional[int] = None,
+    has_image: Optional[bool] = None,
+    fields: Optional[str] = None,
     db: Session = Depends(get_db),
     group: models.Group = Depends(get_group_with_access_check),
 ):
     """
-    (US9) Retrieve all expenses for a specific group. Requires group membership.
+    (US9) Retrieve the expenses of a group, newest first. Requires group membership.
+    - `limit` / `cursor`: keyset pagination; the next page's cursor is returned in
+      the X-Next-Cursor header (absent on the last page). No limit returns everything.
+    - filters: payer_id, participant_id, date_from / date_to, min_amount / max_amount (cents), has_image
+    - `fields`: comma separated projection, e.g. `id,amount,date`; splits are only loaded
+      when requested (or when no projection is given)
     """
-    return crud.get_group_expenses(db, group_id=group_id)
+    try:
+        items, next_cursor = crud.get_group_expenses_page(
+            db, group_id, cursor=cursor, limit=limit, fields=fields,
+            payer_id=payer_id, participant_id=participant_id,
+            date_from=date_from, date_to=date_to,
+            min_amount=min_amount, max_amount=max_amount, has_image=has_image,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
 
 
 @app.patch("/groups/{group_id}/expenses/{expense_id}", response_model=schemas.Expense)
@@ -673,6 +834,7 @@ def update_expense_in_group(
     expense_id: int,
     expense_update: schemas.ExpenseUpdate,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
@@ -685,7 +847,7 @@ def update_expense_in_group(
     if not db_expense or db_expense.group_id != group_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found in this group")
 
-    current_member = crud.get_group_member(db, group_id=group_id, user_id=current_user.id)
+    current_member = ctx.get_member(group_id, current_user.id)
 
     is_admin = current_member and current_member.is_admin
     is_creator = db_expense.creator_id == current_user.id
@@ -704,7 +866,7 @@ def update_expense_in_group(
             )
 
         for split in expense_update.splits:
-            split_member = crud.get_group_member(db, group_id=group_id, user_id=split.user_id)
+            split_member = ctx.get_member(group_id, split.user_id)
             if not split_member:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
@@ -747,6 +909,7 @@ def delete_expense_from_group(
     group_id: int,
     expense_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
@@ -759,7 +922,7 @@ def delete_expense_from_group(
     if not db_expense or db_expense.group_id != group_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found in this group")
 
-    current_member = crud.get_group_member(db, group_id=group_id, user_id=current_user.id)
+    current_member = ctx.get_member(group_id, current_user.id)
 
     is_admin = current_member and current_member.is_admin
     is_creator = db_expense.creator_id == current_user.id
@@ -796,13 +959,14 @@ def create_new_recurring_expense(
     group_id: int,
     recurring_expense: schemas.RecurringExpenseCreate,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
     """
     (US8) Create a recurring expense definition. Any group member can create one.
     """
-    payer_member = crud.get_group_member(db, group_id=group_id, user_id=recurring_expense.payer_id)
+    payer_member = ctx.get_member(group_id, recurring_expense.payer_id)
     if not payer_member:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -810,7 +974,7 @@ def create_new_recurring_expense(
         )
 
     for split in recurring_expense.splits:
-        split_member = crud.get_group_member(db, group_id=group_id, user_id=split.user_id)
+        split_member = ctx.get_member(group_id, split.user_id)
         if not split_member:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -848,6 +1012,7 @@ def update_existing_recurring_expense(
     recurring_expense_id: int,
     expense_update: schemas.RecurringExpenseUpdate,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
@@ -856,7 +1021,7 @@ def update_existing_recurring_expense(
     if not db_recurring_expense or db_recurring_expense.group_id != group_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Recurring expense not found")
 
-    current_member = crud.get_group_member(db, group_id=group_id, user_id=current_user.id)
+    current_member = ctx.get_member(group_id, current_user.id)
     if not (current_member and current_member.is_admin) and db_recurring_expense.creator_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -864,7 +1029,7 @@ def update_existing_recurring_expense(
         )
 
     if expense_update.payer_id is not None:
-        payer_member = crud.get_group_member(db, group_id=group_id, user_id=expense_update.payer_id)
+        payer_member = ctx.get_member(group_id, expense_update.payer_id)
         if not payer_member:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -875,7 +1040,7 @@ def update_existing_recurring_expense(
         split_type = expense_update.split_type or db_recurring_expense.split_type
 
         for split in expense_update.splits:
-            split_member = crud.get_group_member(db, group_id=group_id, user_id=split.user_id)
+            split_member = ctx.get_member(group_id, split.user_id)
             if not split_member:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
@@ -904,6 +1069,7 @@ def delete_existing_recurring_expense(
     group_id: int,
     recurring_expense_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
@@ -912,7 +1078,7 @@ def delete_existing_recurring_expense(
     if not db_recurring_expense or db_recurring_expense.group_id != group_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Recurring expense not found")
 
-    current_member = crud.get_group_member(db, group_id=group_id, user_id=current_user.id)
+    current_member = ctx.get_member(group_id, current_user.id)
     if not (current_member and current_member.is_admin) and db_recurring_expense.creator_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -949,7 +1115,7 @@ def get_recurring_expense(
 
 # 🔴 [START] 修复
 @app.post("/expenses/{expense_id}/payments", response_model=schemas.Payment, status_code=status.HTTP_201_CREATED)
-def create_payment_for_expense(
+async def create_payment_for_expense(
     expense_id: int,
     # 修复：将 Pydantic Body 更改为 Form 字段
     description: str = Form(...),
@@ -957,15 +1123,17 @@ def create_payment_for_expense(
     to_user_id: int = Form(...),
     from_user_id: int = Form(...),
     image_file: UploadFile = File(None),
+    image_key: Optional[str] = Form(None),
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
 # 🔴 [END] 修复
-    db_expense = crud.get_expense_by_id(db, expense_id)
+    db_expense = await run_in_threadpool(crud.get_expense_by_id, db, expense_id)
     if not db_expense:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-    member = crud.get_group_member(db, group_id=db_expense.group_id, user_id=current_user.id)
+    member = await run_in_threadpool(ctx.get_member, db_expense.group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -988,13 +1156,15 @@ def create_payment_for_expense(
     )
     # 🔴 [END] 修复
     
+    upload = await _stage_upload_without_connection(db, image_file, image_key)
     try:
-        db_payment = crud.create_payment(
+        db_payment = await run_in_threadpool(
+            crud.create_payment,
             db=db,
             expense_id=expense_id,
             creator_id=current_user.id,
             payment=payment_data, # 🔴 修复：传递 Pydantic 模型
-            image_file=image_file # 🔴 修复：传递 image_file
+            upload=upload # 🔴 已在事务开始前发布，事务内只引用 key
         )
         return db_payment
 
@@ -1008,6 +1178,7 @@ def create_payment_for_expense(
 def get_payments_for_expense(
     expense_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
     """Get all payments for a specific expense."""
@@ -1015,7 +1186,7 @@ def get_payments_for_expense(
     if not db_expense:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-    member = crud.get_group_member(db, group_id=db_expense.group_id, user_id=current_user.id)
+    member = ctx.get_member(db_expense.group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -1028,6 +1199,7 @@ def get_payments_for_expense(
 def get_payment(
     payment_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
     """Get a single payment by ID (requires group membership)."""
@@ -1037,7 +1209,7 @@ def get_payment(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Payment not found"
         )
-    member = crud.get_group_member(db, group_id=payment.expense.group_id, user_id=current_user.id)
+    member = ctx.get_member(payment.expense.group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -1051,6 +1223,7 @@ def update_payment(
     payment_id: int,
     payment_update: schemas.PaymentUpdate,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
     payment = crud.get_payment(db, payment_id=payment_id)
@@ -1060,7 +1233,7 @@ def update_payment(
             detail="Payment not found"
         )
 
-    member = crud.get_group_member(db, group_id=payment.expense.group_id, user_id=current_user.id)
+    member = ctx.get_member(payment.expense.group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -1087,6 +1260,7 @@ def update_payment(
 def delete_payment(
     payment_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
     payment = crud.get_payment(db, payment_id=payment_id)
@@ -1096,7 +1270,7 @@ def delete_payment(
             detail="Payment not found"
         )
 
-    member = crud.get_group_member(db, group_id=payment.expense.group_id, user_id=current_user.id)
+    member = ctx.get_member(payment.expense.group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -1126,20 +1300,21 @@ def get_user_expense_balance(
     expense_id: int,
     user_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user)
 ):
     db_expense = crud.get_expense_by_id(db, expense_id)
     if not db_expense:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
 
-    member = crud.get_group_member(db, group_id=db_expense.group_id, user_id=current_user.id)
+    member = ctx.get_member(db_expense.group_id, current_user.id)
     if not member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to view balances for this group"
         )
 
-    target_member = crud.get_group_member(db, group_id=db_expense.group_id, user_id=user_id)
+    target_member = ctx.get_member(db_expense.group_id, user_id)
     if not target_member:
         raise HTTPException(
             status_code=status.HTTP_44_NOT_FOUND,
@@ -1184,16 +1359,49 @@ def get_user_expense_balance(
 @app.get("/groups/{group_id}/audit-trail", response_model=List[schemas.AuditLog])
 def read_audit_trail(
     group_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=crud.AUDIT_PAGE_MAX_LIMIT),
+    page: Optional[int] = Query(None, ge=1),
+    action: Optional[str] = None,
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    archived: bool = False,
+    format: Optional[str] = None,
     db: Session = Depends(get_db),
     group: models.Group = Depends(verify_group_admin),
 ):
-    """Get the audit trail for a group (admins only)."""
-    return crud.get_audit_logs(db=db, group_id=group_id)
+    """
+    Get the audit trail for a group (admins only), newest first.
+    - `limit` (default 100) / `cursor`: keyset pagination on (timestamp, id); the next
+      page's cursor is returned in the X-Next-Cursor header. `page` still works (OFFSET).
+    - filters: action (comma separated), user_id, since / until
+    - `archived=true`: continue into months moved to archive files by the retention policy
+    - `format=ndjson`: streams the whole filtered trail, one JSON object per line
+    """
+    filters = dict(action=action, user_id=user_id, since=since, until=until)
+    if format == "ndjson":
+        return StreamingResponse(
+            crud.iter_audit_logs_ndjson(group_id, archived=archived, **filters),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="group-{group_id}-audit.ndjson"'},
+        )
+    if format not in (None, "json"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="format must be json or ndjson")
+    try:
+        logs, next_cursor = crud.get_audit_logs_page(db, group_id, cursor=cursor, limit=limit, page=page, archived=archived, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return logs
 
 # ----------- Settlement Routes (🔴 修复版本) -----------
 @app.get("/groups/{group_id}/settlement", response_model=schemas.SettlementSummary)
 def get_group_settlement(
     group_id: int,
+    strategy: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
@@ -1202,26 +1410,13 @@ def get_group_settlement(
     获取群组结算汇总信息
     - 任何群组成员都可以查看结算信息
     - 返回每个成员的余额、交易推荐等信息
+    - `strategy` 选择推荐路径算法: greedy / exact / heuristic
     """
     try:
-        # 1. 获取成员数据 (🔴 修复：这是缺失的步骤)
-        members = crud.get_group_members(db, group_id)
-        member_data = {member.user_id: {
-            'user': member.user,
-            'nickname': member.nickname,
-            'is_admin': member.is_admin
-        } for member in members}
-        
-        # 记录成员数量用于调试
-        logging.info(f"DEBUG: Group {group_id} has {len(members)} members")
-        
-        # 2. 获取结算信息 - 这里可能会有500错误
-        settlement_summary = crud.get_group_settlement_summary(db, group_id)
-        
-        # 3. 添加推荐的支付路径 (🔴 修复：传递 'balances' 列表)
-        transactions = crud.generate_settlement_transactions(settlement_summary['balances'], member_data)
-        settlement_summary['transactions'] = transactions
-        
+        # 一次加载成员、余额与总额，并生成推荐的支付路径
+        settlement_summary = crud.get_group_settlement_summary(db, group_id, group=group, strategy=strategy)
+        logging.info(f"DEBUG: Group {group_id} has {settlement_summary['member_count']} members")
+
         return settlement_summary
     
     except ValueError as e:
@@ -1253,7 +1448,8 @@ def execute_group_settlement(
             db=db,
             group_id=group_id,
             creator_id=current_user.id,
-            description=settlement_data.description
+            description=settlement_data.description,
+            strategy=settlement_data.strategy
         )
         
         return schemas.SettlementResponse(
@@ -1270,11 +1466,26 @@ def execute_group_settlement(
         raise HTTPException(status_code=500, detail="执行结算时发生错误")
 
 
+@app.post("/groups/{group_id}/settlement/checkpoints", response_model=schemas.SettlementCheckpoint, status_code=status.HTTP_201_CREATED)
+def create_settlement_checkpoint(
+    group_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+    group: models.Group = Depends(verify_group_admin),
+):
+    """
+    记录结算检查点 (仅管理员)
+    - 之后的余额计算只扫描检查点之后的费用和支付
+    """
+    return crud.create_settlement_checkpoint(db, group_id=group_id, created_by=current_user.id)
+
+
 @app.get("/groups/{group_id}/settlement/member/{user_id}", response_model=schemas.SettlementBalance)
 def get_member_settlement_balance(
     group_id: int,
     user_id: int,
     db: Session = Depends(get_db),
+    ctx: RequestContext = Depends(get_request_context),
     current_user: models.User = Depends(get_current_user),
     group: models.Group = Depends(get_group_with_access_check),
 ):
@@ -1283,7 +1494,7 @@ def get_member_settlement_balance(
     - 只能查看自己或其他群组成员的余额
     """
     # 验证目标用户是群组成员
-    member = crud.get_group_member(db, group_id=group_id, user_id=user_id)
+    member = ctx.get_member(group_id, user_id)
     if not member:
         raise HTTPException(
             status_code=404,
@@ -1292,7 +1503,7 @@ def get_member_settlement_balance(
     
     try:
         # 获取群组结算信息
-        settlement_summary = crud.get_group_settlement_summary(db, group_id)
+        settlement_summary = crud.get_group_settlement_summary(db, group_id, group=group)
         
         # 查找指定用户的余额信息
         user_balance = None
@@ -0,0 +1,234 @@
+"""
+Versioned schema migrations (replaces create_all at container start)
+
+    python -m app.migrate upgrade     apply pending migrations (default)
+    python -m app.migrate current     print the applied version
+    python -m app.migrate check       exit 1 if the database is behind head
+
+Migrations live in app/migrations/NNNN_name.py and define:
+
+    version = N                 # unique, increasing
+    transactional = True        # False for online steps (CREATE INDEX CONCURRENTLY,
+                                # batched backfills) that manage their own commits
+    def upgrade(ctx): ...       # ctx is a MigrationContext
+
+Applied versions are recorded in `schema_migrations`. At startup `upgrade`
+runs a single SELECT; when the database is already at head it returns without
+reflecting anything. A database without any tables gets the current schema via
+create_all and is stamped at head. Every step is written to be re-runnable, so
+an interrupted online migration is simply retried on the next boot.
+"""
+import importlib
+import logging
+import os
+import pkgutil
+import re
+import sys
+import time
+
+from sqlalchemy import inspect, text
+
+from app import models
+from app.database import Base, engine
+
+# Postgres: never queue behind long transactions while holding a DDL lock
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_BACKFILL_BATCH = int(os.getenv("MIGRATION_BACKFILL_BATCH", "5000"))
+# pg_advisory_lock key so concurrently booting replicas migrate one at a time
+_ADVISORY_LOCK_KEY = 7412012
+
+logger = logging.getLogger("migrate")
+
+
+class MigrationContext:
+    """Helpers handed to each migration's upgrade(); safe to re-run."""
+
+    def __init__(self, connection, transactional: bool):
+        self.connection = connection
+        self.transactional = transactional
+        self.dialect = connection.dialect.name
+
+    def execute(self, sql: str, params=None):
+        return self.connection.execute(text(sql), params or {})
+
+    def has_table(self, table: str) -> bool:
+        return inspect(self.connection).has_table(table)
+
+    def has_column(self, table: str, column: str) -> bool:
+        return any(col["name"] == column for col in inspect(self.connection).get_columns(table))
+
+    def create_tables(self, *tables):
+        """Creates the given model tables (and their indexes) if they don't exist yet."""
+        Base.metadata.create_all(bind=self.connection, tables=[t.__table__ for t in tables], checkfirst=True)
+
+    def add_column(self, table: str, column_ddl: str):
+        """
+        ALTER TABLE ADD COLUMN if missing. Keep new columns nullable without a
+        volatile default so Postgres doesn't rewrite the table; fill them with backfill().
+        """
+        name = column_ddl.split()[0]
+        if not self.has_column(table, name):
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column_ddl}")
+
+    def create_index(self, name: str, table: str, columns, unique: bool = False, where: str = None):
+        """
+        CREATE INDEX IF NOT EXISTS. On Postgres in a non-transactional migration
+        the build is CONCURRENTLY, so writes to the table continue meanwhile;
+        an invalid index left by an interrupted build is dropped and rebuilt.
+        """
+        concurrently = self.dialect == "postgresql" and not self.transactional
+        if concurrently:
+            invalid = self.execute(
+                "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE c.relname = :name AND NOT i.indisvalid", {"name": name}
+            ).first()
+            if invalid:
+                self.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        self.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {'CONCURRENTLY ' if concurrently else ''}"
+            f"IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+            + (f" WHERE {where}" if where else "")
+        )
+
+    def drop_index(self, name: str):
+        """DROP INDEX IF EXISTS (CONCURRENTLY on Postgres in a non-transactional migration)."""
+        concurrently = self.dialect == "postgresql" and not self.transactional
+        self.execute(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {name}")
+
+    def backfill(self, table: str, set_sql: str, where_sql: str, batch_size: int = None, params=None) -> int:
+        """
+        UPDATE table SET <set_sql> WHERE <where_sql> in id batches, committing
+        between batches in non-transactional migrations so row locks stay short.
+        `where_sql` must stop matching rows once they are filled. Returns rows updated.
+        """
+        batch_size = batch_size or MIGRATION_BACKFILL_BATCH
+        total = 0
+        while True:
+            result = self.execute(
+                f"UPDATE {table} SET {set_sql} WHERE id IN "
+                f"(SELECT id FROM {table} WHERE {where_sql} ORDER BY id LIMIT {int(batch_size)})",
+                params,
+            )
+            if not self.transactional:
+                self.connection.commit()
+            total += result.rowcount
+            if result.rowcount < batch_size:
+                return total
+
+
+def _load_migrations():
+    from app import migrations
+
+    loaded = []
+    for module_info in pkgutil.iter_modules(migrations.__path__):
+        if not re.match(r"^\d{4}_", module_info.name):
+            continue
+        module = importlib.import_module(f"app.migrations.{module_info.name}")
+        loaded.append(module)
+    loaded.sort(key=lambda module: module.version)
+    versions = [module.version for module in loaded]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"duplicate migration versions: {versions}")
+    return loaded
+
+
+def _ensure_version_table(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+def current_version(connection) -> int:
+    """Highest applied version; 0 if migrations never ran."""
+    try:
+        return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")).scalar()
+    except Exception:
+        connection.rollback()
+        return 0
+
+
+def _record(connection, module):
+    connection.execute(
+        text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, CURRENT_TIMESTAMP)"),
+        {"v": module.version, "n": module.__name__.rsplit(".", 1)[-1]},
+    )
+
+
+def _run(module):
+    transactional = getattr(module, "transactional", True)
+    start = time.perf_counter()
+    if transactional:
+        with engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.execute(text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+            module.upgrade(MigrationContext(connection, transactional=True))
+            _record(connection, module)
+    else:
+        with engine.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+                connection.execute(text(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+            module.upgrade(MigrationContext(connection, transactional=False))
+            _record(connection, module)
+            connection.commit()
+    logger.info(f"migrate: applied {module.__name__} in {time.perf_counter() - start:.2f}s")
+
+
+def upgrade() -> int:
+    """Applies pending migrations; returns the number applied."""
+    migrations = _load_migrations()
+    head = migrations[-1].version if migrations else 0
+
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version >= head:
+        logger.info(f"migrate: database at head ({head})")
+        return 0
+
+    with engine.connect() as lock_connection:
+        if lock_connection.dialect.name == "postgresql":
+            lock_connection.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _ADVISORY_LOCK_KEY})
+        try:
+            with engine.begin() as connection:
+                _ensure_version_table(connection)
+                version = current_version(connection)  # another replica may have finished meanwhile
+                fresh = version == 0 and not inspect(connection).has_table(models.User.__tablename__)
+                if fresh:
+                    # empty database: build the current schema directly and stamp every version
+                    Base.metadata.create_all(bind=connection)
+                    for module in migrations:
+                        _record(connection, module)
+                    logger.info(f"migrate: created schema at head ({head})")
+                    return len(migrations)
+
+            pending = [module for module in migrations if module.version > version]
+            for module in pending:
+                _run(module)
+            return len(pending)
+        finally:
+            if lock_connection.dialect.name == "postgresql":
+                lock_connection.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _ADVISORY_LOCK_KEY})
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    command = (argv if argv is not None else sys.argv[1:] or ["upgrade"])[0]
+    migrations = _load_migrations()
+    head = migrations[-1].version if migrations else 0
+
+    if command == "upgrade":
+        upgrade()
+    elif command in ("current", "check"):
+        with engine.connect() as connection:
+            version = current_version(connection)
+        print(f"current {version}, head {head}")
+        if command == "check" and version < head:
+            sys.exit(1)
+    else:
+        print(__doc__)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""Baseline: the tables as they existed before versioned migrations (create_tables.py era)."""
+from app import models
+
+version = 1
+transactional = True
+
+
+def upgrade(ctx):
+    ctx.create_tables(
+        models.User,
+        models.Group,
+        models.GroupMember,
+        models.GroupInvitation,
+        models.Expense,
+        models.RecurringExpense,
+        models.ExpenseSplit,
+        models.Payment,
+        models.GroupMemberBalance,
+        models.SettlementCheckpoint,
+        models.AuditLog,
+    )
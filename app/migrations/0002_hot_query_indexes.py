@@ -0,0 +1,23 @@
+"""Composite indexes for the hot query shapes in crud.py (built concurrently on Postgres)."""
+
+version = 2
+transactional = False
+
+INDEXES = [
+    ("ix_expenses_group_date_id", "expenses", ["group_id", "date DESC", "id DESC"]),
+    ("ix_expense_splits_expense_id", "expense_splits", ["expense_id"]),
+    ("ix_expense_splits_user_id", "expense_splits", ["user_id"]),
+    ("ix_payments_expense_id", "payments", ["expense_id", "created_at DESC"]),
+    ("ix_payments_from_user_id", "payments", ["from_user_id"]),
+    ("ix_payments_to_user_id", "payments", ["to_user_id"]),
+    ("ix_audit_logs_group_timestamp", "audit_logs", ["group_id", "timestamp DESC"]),
+    ("ix_group_members_user_id", "group_members", ["user_id"]),
+    ("ix_recurring_expenses_active_due", "recurring_expenses", ["is_active", "next_due_date"]),
+    ("ix_recurring_expenses_group_start", "recurring_expenses", ["group_id", "start_date DESC"]),
+    ("ix_group_invitations_invitee_status", "group_invitations", ["invitee_id", "status", "created_at DESC"]),
+]
+
+
+def upgrade(ctx):
+    for name, table, columns in INDEXES:
+        ctx.create_index(name, table, columns)
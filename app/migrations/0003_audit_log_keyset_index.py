@@ -0,0 +1,9 @@
+"""Audit trail keyset pagination: (group_id, timestamp DESC, id DESC) replaces the timestamp-only index."""
+
+version = 3
+transactional = False
+
+
+def upgrade(ctx):
+    ctx.create_index("ix_audit_logs_group_timestamp_id", "audit_logs", ["group_id", "timestamp DESC", "id DESC"])
+    ctx.drop_index("ix_audit_logs_group_timestamp")
@@ -0,0 +1,9 @@
+"""audit_outbox table for AUDIT_LOG_MODE=outbox (see app/audit_writer.py)."""
+from app import models
+
+version = 4
+transactional = True
+
+
+def upgrade(ctx):
+    ctx.create_tables(models.AuditOutbox)
@@ -0,0 +1,9 @@
+"""stored_files: reference counts for content-addressed uploads (see app/uploads.py)."""
+from app import models
+
+version = 5
+transactional = True
+
+
+def upgrade(ctx):
+    ctx.create_tables(models.StoredFile)
@@ -0,0 +1,10 @@
+"""thumbnail_url / display_url on expenses and payments (see app/images.py)."""
+
+version = 6
+transactional = True
+
+
+def upgrade(ctx):
+    for table in ("expenses", "payments"):
+        ctx.add_column(table, "thumbnail_url VARCHAR")
+        ctx.add_column(table, "display_url VARCHAR")
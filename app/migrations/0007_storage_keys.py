@@ -0,0 +1,22 @@
+"""Image columns store storage keys instead of /static/uploads URLs (see app/storage.py)."""
+from app.storage import UPLOAD_URL_PREFIX
+
+version = 7
+transactional = True
+
+COLUMNS = {
+    "expenses": ("image_url", "thumbnail_url", "display_url"),
+    "payments": ("image_url", "thumbnail_url", "display_url"),
+}
+
+
+def upgrade(ctx):
+    prefix = UPLOAD_URL_PREFIX + "/"
+    for table, columns in COLUMNS.items():
+        for column in columns:
+            ctx.backfill(
+                table,
+                f"{column} = substr({column}, :start)",
+                f"substr({column}, 1, :length) = :prefix",
+                params={"start": len(prefix) + 1, "length": len(prefix), "prefix": prefix},
+            )
@@ -0,0 +1,9 @@
+"""recurring_leases: per-template leases for multi-process recurring expense runs on SQLite."""
+from app import models
+
+version = 8
+transactional = True
+
+
+def upgrade(ctx):
+    ctx.create_tables(models.RecurringLease)
@@ -0,0 +1,20 @@
+"""group_member_balances: backfill the ledger of groups that predate it, so settlement reads never write."""
+version = 9
+transactional = True
+
+
+def upgrade(ctx):
+    # full history per (group, user), plus a zero row for members without activity;
+    # groups that already have ledger rows are maintained incrementally and left alone
+    ctx.execute(
+        "INSERT INTO group_member_balances (group_id, user_id, balance, updated_at) "
+        "SELECT flows.group_id, flows.user_id, SUM(flows.amount), CURRENT_TIMESTAMP FROM ("
+        "  SELECT e.group_id, e.payer_id AS user_id, e.amount FROM expenses e"
+        "  UNION ALL SELECT e.group_id, s.user_id, -s.amount FROM expense_splits s JOIN expenses e ON e.id = s.expense_id"
+        "  UNION ALL SELECT e.group_id, p.from_user_id, p.amount FROM payments p JOIN expenses e ON e.id = p.expense_id"
+        "  UNION ALL SELECT e.group_id, p.to_user_id, -p.amount FROM payments p JOIN expenses e ON e.id = p.expense_id"
+        "  UNION ALL SELECT m.group_id, m.user_id, 0 FROM group_members m"
+        ") flows "
+        "WHERE flows.group_id NOT IN (SELECT DISTINCT group_id FROM group_member_balances) "
+        "GROUP BY flows.group_id, flows.user_id"
+    )
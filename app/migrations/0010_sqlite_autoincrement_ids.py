@@ -0,0 +1,47 @@
+"""
+expenses / payments: AUTOINCREMENT ids on SQLite databases created before sqlite_autoincrement.
+
+Settlement checkpoints use ids as high-water marks, so an id must never be
+handed out again. Without AUTOINCREMENT SQLite reuses the highest id after
+its row is deleted. SQLite can't ALTER a primary key, so the tables are
+rebuilt (create, copy, drop, rename; the app never enables PRAGMA
+foreign_keys) and their indexes recreated. Postgres sequences never reuse ids.
+"""
+from sqlalchemy.schema import CreateTable
+
+from app import models
+
+version = 10
+transactional = True
+
+MODELS = (models.Expense, models.Payment)
+
+
+def _rebuild(ctx, table):
+    name = table.name
+    index_ddl = [ddl for (ddl,) in ctx.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL",
+        {"name": name},
+    )]
+    new_name = f"{name}_autoincrement"
+    create_ddl = str(CreateTable(table).compile(dialect=ctx.connection.dialect))
+    ctx.execute(create_ddl.replace(f"CREATE TABLE {name} ", f"CREATE TABLE {new_name} ", 1))
+    columns = ", ".join(column.name for column in table.columns)
+    # copying explicit ids also moves sqlite_sequence up to the current max(id)
+    ctx.execute(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {name}")
+    ctx.execute(f"DROP TABLE {name}")
+    ctx.execute(f"ALTER TABLE {new_name} RENAME TO {name}")
+    for ddl in index_ddl:
+        ctx.execute(ddl)
+
+
+def upgrade(ctx):
+    if ctx.dialect != "sqlite":
+        return
+    for model in MODELS:
+        table = model.__table__
+        ddl = ctx.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name", {"name": table.name}
+        ).scalar()
+        if ddl and "AUTOINCREMENT" not in ddl.upper():
+            _rebuild(ctx, table)
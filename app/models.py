@@ -12,6 +12,7 @@ from sqlalchemy import (
     Text,
     func,
     UniqueConstraint,
+    Index,
 )
 from sqlalchemy.orm import relationship
 from app.database import Base
@@ -55,6 +56,8 @@ class Group(Base):
     admin = relationship("User", back_populates="groups_created")
     members = relationship("GroupMember", back_populates="group", cascade="all, delete-orphan")
     invitations = relationship("GroupInvitation", back_populates="group", cascade="all, delete-orphan")
+    member_balances = relationship("GroupMemberBalance", back_populates="group", cascade="all, delete-orphan")
+    settlement_checkpoints = relationship("SettlementCheckpoint", back_populates="group", cascade="all, delete-orphan")
 
    
 
@@ -112,6 +115,9 @@ class Expense(Base):
     split_type = Column(String, default="equal") # add by sunzhe for payment update 22 oct
     
     image_url = Column(String, nullable=True)
+    # resized, EXIF-free copies of image_url, filled in by app/images.py
+    thumbnail_url = Column(String, nullable=True)
+    display_url = Column(String, nullable=True)
 
     group = relationship("Group")
     creator = relationship("User", foreign_keys=[creator_id])
@@ -119,6 +125,9 @@ class Expense(Base):
 
     splits = relationship("ExpenseSplit", back_populates="expense", cascade="all, delete-orphan") # * new added line for Expense splits
     payments = relationship("Payment", back_populates="expense", cascade="all, delete-orphan") # * new added line for Expense payments
+
+    # ids are used as settlement checkpoint high-water marks, so SQLite must never reuse them
+    __table_args__ = {"sqlite_autoincrement": True}
     
 
 
@@ -180,15 +189,61 @@ class Payment(Base):
     creator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
     image_url = Column(String, nullable=True)  
+    thumbnail_url = Column(String, nullable=True)
+    display_url = Column(String, nullable=True)
 
     expense = relationship("Expense", back_populates="payments")
     from_user = relationship("User", foreign_keys=[from_user_id], back_populates="payments_made")
     to_user = relationship("User", foreign_keys=[to_user_id], back_populates="payments_received")
 
+    # ids are used as settlement checkpoint high-water marks, so SQLite must never reuse them
+    __table_args__ = {"sqlite_autoincrement": True}
+
     
    
 # ************************************************************************ # 
 
+class GroupMemberBalance(Base):
+    """
+    Running net balance (in cents) of one user inside one group.
+    Positive: the user is owed money. Negative: the user owes money.
+    Maintained incrementally by the expense / payment CRUD functions so that
+    settlement reads touch O(members) rows instead of the whole history.
+    """
+    __tablename__ = "group_member_balances"
+
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+
+    balance = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    group = relationship("Group", back_populates="member_balances")
+    user = relationship("User")
+    __table_args__ = (UniqueConstraint('group_id', 'user_id', name='_group_member_balance_uc'),)
+
+
+class SettlementCheckpoint(Base):
+    """
+    Snapshot of every user's net balance (in cents) in a group, as of the
+    expense / payment high-water marks. Balance aggregation starts from the
+    latest checkpoint and only scans rows with a higher id.
+    """
+    __tablename__ = "settlement_checkpoints"
+
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"), nullable=False, index=True)
+    last_expense_id = Column(Integer, nullable=False, default=0)  # expenses with id <= this are included
+    last_payment_id = Column(Integer, nullable=False, default=0)  # payments with id <= this are included
+    balances = Column(JSON, nullable=False)  # {"<user_id>": balance_cents}
+
+    created_at = Column(DateTime, default=datetime.now)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=True)  # None when written by the system
+
+    group = relationship("Group", back_populates="settlement_checkpoints")
+
+
 class AuditLog(Base):
     __tablename__ = "audit_logs"
 
@@ -201,3 +256,73 @@ class AuditLog(Base):
 
     user = relationship("User")
     group = relationship("Group")
+
+
+class AuditOutbox(Base):
+    """
+    Audit entries written in the business transaction when AUDIT_LOG_MODE=outbox,
+    moved to audit_logs in batches by app/audit_writer.py. No foreign keys or
+    secondary indexes so the per-transaction insert stays cheap.
+    """
+    __tablename__ = "audit_outbox"
+
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    details = Column(Text, nullable=True)  # compact JSON
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class StoredFile(Base):
+    """
+    One content-addressed upload (app/uploads.py), stored once however many
+    expenses / payments reference it. ref_count is kept by mapper events on
+    Expense.image_url and Payment.image_url; a file at 0 is garbage collected.
+    """
+    __tablename__ = "stored_files"
+
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String, nullable=False)  # relative to UPLOAD_DIR
+    size = Column(Integer, nullable=False)
+    content_type = Column(String, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    released_at = Column(DateTime(timezone=True), nullable=True)  # when ref_count last dropped to 0
+
+
+class RecurringLease(Base):
+    """
+    Which process is generating a recurring template's expenses (app/recurring_leases.py).
+    Only used on SQLite; Postgres claims template rows with FOR UPDATE SKIP LOCKED instead.
+    """
+    __tablename__ = "recurring_leases"
+
+    template_id = Column(Integer, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+# ----------- Indexes for the hot query shapes in crud.py -----------
+# Created with the tables by create_all; migrations/0002_hot_query_indexes.py adds
+# them to existing databases. tests/test_query_plans.py verifies they are used.
+
+# get_group_expenses: WHERE group_id = ? ORDER BY date DESC, id DESC
+Index("ix_expenses_group_date_id", Expense.group_id, Expense.date.desc(), Expense.id.desc())
+# joined / selectin loading of splits, balance aggregation, per-user history
+Index("ix_expense_splits_expense_id", ExpenseSplit.expense_id)
+Index("ix_expense_splits_user_id", ExpenseSplit.user_id)
+# get_expense_payments and payment cascades; per-user payment history
+Index("ix_payments_expense_id", Payment.expense_id, Payment.created_at.desc())
+Index("ix_payments_from_user_id", Payment.from_user_id)
+Index("ix_payments_to_user_id", Payment.to_user_id)
+# get_audit_logs_page: WHERE group_id = ? ORDER BY timestamp DESC, id DESC (keyset on both)
+Index("ix_audit_logs_group_timestamp_id", AuditLog.group_id, AuditLog.timestamp.desc(), AuditLog.id.desc())
+# get_user_groups (group_id, user_id is already covered by _group_user_uc)
+Index("ix_group_members_user_id", GroupMember.user_id)
+# scheduler: WHERE is_active AND next_due_date <= today; group listing by start_date
+Index("ix_recurring_expenses_active_due", RecurringExpense.is_active, RecurringExpense.next_due_date)
+Index("ix_recurring_expenses_group_start", RecurringExpense.group_id, RecurringExpense.start_date.desc())
+# get_pending_invitations_for_user: WHERE invitee_id = ? AND status = ? ORDER BY created_at DESC
+Index("ix_group_invitations_invitee_status", GroupInvitation.invitee_id, GroupInvitation.status, GroupInvitation.created_at.desc())
+
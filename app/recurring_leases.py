@@ -0,0 +1,92 @@
+# recurring_leases.py  exactly-once recurring expense generation across processes
+#
+# Every web worker (and the standalone `python -m app.recurring_scheduler`)
+# may run crud.process_due_recurring_expenses at the same moment. Each
+# generated instance is one transaction that starts by claiming its template
+# with claim_template(), re-reading next_due_date under the claim, and ends
+# by committing the expense together with the advanced next_due_date:
+#
+#   postgresql  SELECT ... FOR UPDATE SKIP LOCKED: the row lock is the claim;
+#               a worker that finds the row locked moves on to other templates.
+#   sqlite      no row locks, so template_lease() first takes a row in
+#               recurring_leases (owner, expires_at) in its own short
+#               transaction; another process sees a live lease and skips the
+#               template. Leases expire after RECURRING_LEASE_S in case their
+#               owner died.
+import logging
+import os
+import socket
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import engine
+
+RECURRING_LEASE_S = int(os.getenv("RECURRING_LEASE_S", "300"))
+
+# identifies this process in recurring_leases
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+logger = logging.getLogger("recurring_leases")
+
+
+def _uses_row_locks() -> bool:
+    return engine.dialect.name == "postgresql"
+
+
+def _acquire(template_id: int) -> bool:
+    now = datetime.now(timezone.utc)
+    leases = models.RecurringLease.__table__
+    statement = sqlite_insert(leases).values(
+        template_id=template_id, owner=OWNER, expires_at=now + timedelta(seconds=RECURRING_LEASE_S)
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[leases.c.template_id],
+        set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+        where=leases.c.expires_at < now,  # take over only an expired lease
+    )
+    with engine.begin() as connection:
+        return connection.execute(statement).rowcount == 1
+
+
+def _release(template_id: int):
+    leases = models.RecurringLease.__table__
+    with engine.begin() as connection:
+        connection.execute(delete(leases).where(leases.c.template_id == template_id, leases.c.owner == OWNER))
+
+
+@contextmanager
+def template_lease(template_id: int):
+    """Yields whether this process may work on `template_id` (always True on Postgres)."""
+    if _uses_row_locks():
+        yield True
+        return
+    acquired = _acquire(template_id)
+    if not acquired:
+        logger.info(f"recurring: template {template_id} is leased by another process, skipping")
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _release(template_id)
+
+
+def claim_template(db: Session, template_id: int, today: date) -> Optional[models.RecurringExpense]:
+    """
+    Starts an instance transaction: the template if it is still active and due,
+    freshly read and (on Postgres) row locked until the commit; otherwise None.
+    """
+    query = db.query(models.RecurringExpense).filter(
+        models.RecurringExpense.id == template_id,
+        models.RecurringExpense.is_active == True,
+        models.RecurringExpense.next_due_date <= today,
+    ).populate_existing()
+    if _uses_row_locks():
+        query = query.with_for_update(skip_locked=True)
+    return query.first()
@@ -0,0 +1,252 @@
+# recurring_scheduler.py  event-driven runner for recurring expense templates
+#
+# Replaces the one-minute polling job. A min-heap holds (due time, template id)
+# for every active template, loaded once at startup. The asyncio task sleeps
+# until the earliest entry is due (a template is due from 00:00 local time on
+# its next_due_date, as with date.today() in crud), then runs
+# crud.process_due_recurring_expenses for just the due templates in the
+# threadpool, so the event loop never waits on the database.
+#
+# Template inserts / updates / deletes are picked up from the ORM after their
+# transaction commits and update the heap in place (stale heap entries are
+# skipped when popped). Changes made outside this process (other workers,
+# manual SQL) are picked up by a full reload every RECURRING_RESYNC_S. A template
+# still due after its run (a failed instance) is retried after RECURRING_RETRY_S,
+# doubling per failure up to RECURRING_RESYNC_S.
+#
+# Every web worker runs one (RECURRING_SCHEDULER=embedded, the default);
+# app/recurring_leases.py makes concurrent runs generate each instance once.
+# With RECURRING_SCHEDULER=off the web app runs none and a single
+#   python -m app.recurring_scheduler
+# process does the work; it only learns about template changes through the
+# reload, so give it a shorter RECURRING_RESYNC_S (e.g. 60).
+import asyncio
+import heapq
+import logging
+import os
+import signal
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import crud, models
+from app.database import SessionLocal
+
+RECURRING_SCHEDULER = os.getenv("RECURRING_SCHEDULER", "embedded").lower()  # embedded | off
+RECURRING_RESYNC_S = int(os.getenv("RECURRING_RESYNC_S", "3600"))
+RECURRING_RETRY_S = int(os.getenv("RECURRING_RETRY_S", "60"))
+
+if RECURRING_SCHEDULER not in ("embedded", "off"):
+    raise ValueError(f"RECURRING_SCHEDULER must be embedded or off, not {RECURRING_SCHEDULER!r}")
+
+_CHANGED_KEY = "changed_recurring_templates"
+
+logger = logging.getLogger("recurring_scheduler")
+
+
+def due_at(next_due_date: date) -> datetime:
+    return datetime.combine(next_due_date, time.min)
+
+
+class RecurringScheduler:
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self._due: Dict[int, datetime] = {}  # template id -> its live heap entry
+        self._retry: Dict[int, int] = {}  # failing template id -> its next backoff in seconds
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_sync: Optional[datetime] = None
+
+    # ----------- heap -----------
+
+    def _set(self, template_id: int, due: Optional[datetime]):
+        """Schedules `template_id` at `due`; None removes it."""
+        if due is None:
+            self._due.pop(template_id, None)
+        elif self._due.get(template_id) != due:
+            self._due[template_id] = due
+            heapq.heappush(self._heap, (due, template_id))
+        if self._wake is not None:
+            self._wake.set()
+
+    def _next_due(self) -> Optional[datetime]:
+        while self._heap:
+            due, template_id = self._heap[0]
+            if self._due.get(template_id) == due:
+                return due
+            heapq.heappop(self._heap)  # superseded or removed
+        return None
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        template_ids = []
+        while (due := self._next_due()) is not None and due <= now:
+            _, template_id = heapq.heappop(self._heap)
+            del self._due[template_id]
+            template_ids.append(template_id)
+        return template_ids
+
+    def notify(self, changes: Dict[int, Optional[date]]):
+        """Thread-safe: template id -> new next_due_date, or None when deleted / inactive."""
+        if self._loop is None or self._loop.is_closed():
+            return
+        for template_id, next_due_date in changes.items():
+            due = due_at(next_due_date) if next_due_date is not None else None
+            self._loop.call_soon_threadsafe(self._set, template_id, due)
+
+    # ----------- database -----------
+
+    @staticmethod
+    def _load(template_ids: Optional[List[int]] = None) -> Dict[int, date]:
+        with SessionLocal() as db:
+            query = select(models.RecurringExpense.id, models.RecurringExpense.next_due_date).where(
+                models.RecurringExpense.is_active == True
+            )
+            if template_ids is not None:
+                query = query.where(models.RecurringExpense.id.in_(template_ids))
+            return dict(db.execute(query).all())
+
+    async def _resync(self):
+        loaded = await run_in_threadpool(self._load)
+        for template_id in set(self._due) - set(loaded):
+            self._set(template_id, None)
+        now = datetime.now()
+        for template_id, next_due_date in loaded.items():
+            due = due_at(next_due_date)
+            if due > now:
+                self._retry.pop(template_id, None)
+            elif template_id in self._retry and template_id in self._due:
+                continue  # a failing template keeps its backoff slot
+            self._set(template_id, due)
+        for template_id in set(self._retry) - set(loaded):
+            del self._retry[template_id]
+        self._last_sync = datetime.now()
+        logger.info(f"recurring: tracking {len(self._due)} active template(s)")
+
+    @staticmethod
+    def _process(template_ids: List[int]):
+        with SessionLocal() as db:
+            crud.process_due_recurring_expenses(db, template_ids=template_ids)
+
+    async def _run_due(self, template_ids: List[int]):
+        before = await run_in_threadpool(self._load, template_ids)
+        try:
+            await run_in_threadpool(self._process, template_ids)
+        except Exception as e:
+            logger.error(f"recurring: processing templates {template_ids} failed: {e}")
+        # templates that stayed on the same due date (e.g. a failed instance) are retried with
+        # a bounded backoff, not in a tight loop; one that advanced but is still due (a bulk
+        # catch-up batch) goes again right away
+        now = datetime.now()
+        for template_id, next_due_date in (await run_in_threadpool(self._load, template_ids)).items():
+            if due_at(next_due_date) > now or next_due_date != before.get(template_id):
+                self._retry.pop(template_id, None)
+                self._set(template_id, due_at(next_due_date))
+                continue
+            backoff = self._retry.get(template_id, min(RECURRING_RETRY_S, RECURRING_RESYNC_S))
+            self._retry[template_id] = min(backoff * 2, RECURRING_RESYNC_S)
+            self._set(template_id, now + timedelta(seconds=backoff))
+            logger.warning(f"recurring: template {template_id} is still due, retrying in {backoff}s")
+
+    # ----------- loop -----------
+
+    async def _run(self):
+        while True:
+            try:
+                if self._last_sync is None or (datetime.now() - self._last_sync).total_seconds() >= RECURRING_RESYNC_S:
+                    await self._resync()
+                template_ids = self._pop_due(datetime.now())
+                if template_ids:
+                    logger.info(f"recurring: {len(template_ids)} template(s) due")
+                    await self._run_due(template_ids)
+                    continue
+                next_due = self._next_due()
+                delay = RECURRING_RESYNC_S - (datetime.now() - self._last_sync).total_seconds()
+                if next_due is not None:
+                    delay = min(delay, (next_due - datetime.now()).total_seconds())
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"recurring: scheduler error: {e}")
+                await asyncio.sleep(60)
+
+    def start(self):
+        """Starts the scheduler task on the running event loop."""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = self._loop.create_task(self._run(), name="recurring-scheduler")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._loop = None
+
+
+scheduler = RecurringScheduler()
+
+
+# ----------- template changes, applied after commit -----------
+
+def _track(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault(_CHANGED_KEY, {})[target.id] = target.next_due_date if target.is_active is not False else None
+
+
+def _track_delete(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault(_CHANGED_KEY, {})[target.id] = None
+
+
+event.listen(models.RecurringExpense, "after_insert", _track)
+event.listen(models.RecurringExpense, "after_update", _track)
+event.listen(models.RecurringExpense, "after_delete", _track_delete)
+
+
+@event.listens_for(Session, "after_commit")
+def _notify_committed(session):
+    changes = session.info.pop(_CHANGED_KEY, None)
+    if changes:
+        scheduler.notify(changes)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_rolled_back(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(_CHANGED_KEY, None)
+
+
+# ----------- standalone process -----------
+
+async def _serve():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    scheduler.start()
+    logger.info("recurring: standalone scheduler running")
+    await stop.wait()
+    await scheduler.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve())
@@ -1,7 +1,12 @@
-from pydantic import BaseModel, EmailStr, Field, model_validator
-from typing import Optional, List, Dict, Any, Union
+from pydantic import BaseModel, EmailStr, Field, PlainSerializer, model_validator
+from typing import Annotated, Optional, List, Dict, Any, Union
 from datetime import date, datetime
+from datetime import date as DateType  # for fields named `date` that default to None
 from app.models import InvitationStatus
+from app import storage
+
+# image columns hold storage keys; responses carry a download URL (pre-signed on S3)
+StorageURL = Annotated[Optional[str], PlainSerializer(storage.url_for, return_type=Optional[str])]
 
 # ----------- User Schemas -----------
 class UserBase(BaseModel):
@@ -143,7 +148,7 @@ class ExpenseBase(BaseModel):
     description: str
     amount: int
     payer_id: int
-    image_url: Optional[str] = None
+    image_url: StorageURL = None
 
 # class ExpenseCreate(ExpenseBase):
     # date: Optional[date] = None # For INPUT, date is optional
@@ -153,7 +158,7 @@ class ExpenseCreate(BaseModel):
     payer_id: int
     image_url: Optional[str] = None
     # 🔴 修复：允许 date 是 str 或 date 对象，以匹配两个调用路径
-    date: Optional[Union[date, str]] = None
+    date: Optional[Union[DateType, str]] = None
     
 # class ExpenseUpdate(BaseModel):
     # description: Optional[str] = None
@@ -168,7 +173,7 @@ class ExpenseUpdate(BaseModel):
     amount: Optional[int] = None
     payer_id: Optional[int] = None
     # 🔴 修复：允许 date 是 str 或 date 对象
-    date: Optional[Union[date, str]] = None
+    date: Optional[Union[DateType, str]] = None
     image_url: Optional[str] = None
     split_type: Optional[str] = None
     splits: Optional[List['ExpenseSplitCreate']] = None
@@ -189,6 +194,8 @@ class Expense(ExpenseBase):
     creator_id: int
     date: date
     split_type: str
+    thumbnail_url: StorageURL = None
+    display_url: StorageURL = None
     
     class Config:
         from_attributes = True
@@ -277,13 +284,35 @@ class ExpenseWithSplits(Expense):
 
 #ExpenseCreateWithSplits.model_rebuild()  # sunzhe 03 Nov
 
+
+class ExpenseListItem(BaseModel):
+    """
+    One row of the paginated expense listing. Every field is optional so a
+    `fields` projection can return a subset; routes use response_model_exclude_unset.
+    """
+    id: Optional[int] = None
+    description: Optional[str] = None
+    amount: Optional[int] = None
+    payer_id: Optional[int] = None
+    image_url: StorageURL = None
+    thumbnail_url: StorageURL = None
+    display_url: StorageURL = None
+    group_id: Optional[int] = None
+    creator_id: Optional[int] = None
+    date: Optional[DateType] = None
+    split_type: Optional[str] = None
+    splits: Optional[List[ExpenseSplit]] = None
+
+    class Config:
+        from_attributes = True
+
 # ----------- Payment Schemas -----------
 class PaymentBase(BaseModel):
     from_user_id: int
     to_user_id: int
     amount: int # 03 Nov
     description: Optional[str] = None
-    image_url: Optional[str] = None
+    image_url: StorageURL = None
     #payment_date: date
 
 class PaymentCreate(PaymentBase):
@@ -297,10 +326,28 @@ class Payment(PaymentBase):
     expense_id: int
     created_at: datetime
     creator_id: int
+    thumbnail_url: StorageURL = None
+    display_url: StorageURL = None
 
     class Config:
         from_attributes = True
 
+class UploadPresignRequest(BaseModel):
+    sha256: str  # hex digest of the file, computed by the client
+    size: int
+    content_type: str
+
+
+class UploadTarget(BaseModel):
+    method: str
+    url: str
+    headers: Dict[str, str] = {}
+
+
+class UploadPresignResponse(BaseModel):
+    key: str  # send as image_key when creating the expense / payment
+    upload: Optional[UploadTarget] = None  # None: this content is stored already
+
 # ----------- Balance Schemas -----------
 class UserBalance(BaseModel):
     user_id: int
@@ -360,6 +407,7 @@ class SettlementCreate(BaseModel):
     """创建结算的请求模型"""
     description: Optional[str] = None
     force_settlement: bool = False  # 是否强制结算（即使有未结清的余额）
+    strategy: Optional[str] = None  # 推荐路径算法: greedy / exact / heuristic
 
 class SettlementResponse(BaseModel):
     """结算操作响应模型"""
@@ -368,6 +416,19 @@ class SettlementResponse(BaseModel):
     settlement_summary: Optional[SettlementSummary] = None
     created_at: datetime
 
+class SettlementCheckpoint(BaseModel):
+    """结算检查点：截至高水位线的每个成员余额 (分)"""
+    id: int
+    group_id: int
+    last_expense_id: int
+    last_payment_id: int
+    balances: Dict[int, int]
+    created_at: datetime
+    created_by: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
 # ----------- Audit Log Schemas (🔴 修复) -----------
 class AuditLog(BaseModel):
     id: int
@@ -376,7 +437,7 @@ class AuditLog(BaseModel):
     timestamp: datetime # 🔴 修复：确保字段名与 models.py 一致
     action: str
     details: Optional[dict] = None
-    user: User  # 🔴 修复：添加 user 字段以接收关联的用户对象
+    user: Optional[User] = None  # 🔴 修复：添加 user 字段以接收关联的用户对象 (None once the user is deleted)
 
     class Config:
         from_attributes = True
@@ -182,26 +182,59 @@ export async function getGroupMembers(groupId) {
 }
 
 /**
- * API Call: Get group expenses (Real version)
+ * API Call: Get one page of group expenses (Real version)
  * API Route: @app.get("/groups/{group_id}/expenses", ...)
+ * Keyset pagination: pass the `nextCursor` of the previous page as `cursor`
+ * (null when there are no more pages). Other `params` are passed through as
+ * query filters, e.g. { fields: 'id' }.
  */
-export async function getGroupExpenses(groupId) {
-    console.log('Getting group expense data, Group ID:', groupId);
+const EXPENSE_PAGE_SIZE = 50;
+
+export async function getGroupExpensesPage(groupId, { cursor = null, ...params } = {}) {
+    console.log('Getting group expense page, Group ID:', groupId, 'cursor:', cursor);
     const token = getAuthToken();
     if (!token) throw new Error('Not authenticated');
 
-    const response = await fetch(`/groups/${groupId}/expenses`, {
+    const query = new URLSearchParams({ limit: EXPENSE_PAGE_SIZE, ...params });
+    if (cursor) query.set('cursor', cursor);
+
+    const response = await fetch(`/groups/${groupId}/expenses?${query}`, {
         method: 'GET',
         headers: { 'Authorization': `Bearer ${token}` }
     });
-    
+
     if (!response.ok) {
         const errorText = await response.text();
         console.error('Failed to get group expenses, status code:', response.status, 'error message:', errorText);
         throw new Error('Failed to get group expenses');
     }
-    
-    return await response.json();
+
+    return {
+        expenses: await response.json(),
+        nextCursor: response.headers.get('X-Next-Cursor')
+    };
+}
+
+/**
+ * API Call: Get the first page of group expenses (newest first).
+ * Further pages are loaded on demand with getGroupExpensesPage.
+ */
+export async function getGroupExpenses(groupId, params = {}) {
+    return (await getGroupExpensesPage(groupId, params)).expenses;
+}
+
+/**
+ * Ids of every expense in the group (walks all pages, ids only).
+ */
+async function getGroupExpenseIds(groupId) {
+    let ids = [];
+    let cursor = null;
+    do {
+        const page = await getGroupExpensesPage(groupId, { cursor, fields: 'id', limit: 200 });
+        ids = ids.concat(page.expenses.map(expense => expense.id));
+        cursor = page.nextCursor;
+    } while (cursor);
+    return ids;
 }
 
 /**
@@ -215,14 +248,15 @@ export async function getGroupPayments(groupId) {
 
     try {
         // 🔴 v12.0 Fix: First get all expenses, then aggregate payment records
-        const expenses = await getGroupExpenses(groupId);
+        // only the ids are needed here
+        const expenseIds = await getGroupExpenseIds(groupId);
         let allPayments = [];
         
-        console.log(`Group ${groupId} has ${expenses.length} expenses, starting to aggregate payment records...`);
+        console.log(`Group ${groupId} has ${expenseIds.length} expenses, starting to aggregate payment records...`);
         
-        for (const expense of expenses) {
+        for (const expenseId of expenseIds) {
             try {
-                const response = await fetch(`/expenses/${expense.id}/payments`, {
+                const response = await fetch(`/expenses/${expenseId}/payments`, {
                     method: 'GET',
                     headers: { 'Authorization': `Bearer ${token}` }
                 });
@@ -230,10 +264,10 @@ export async function getGroupPayments(groupId) {
                 if (response.ok) {
                     const payments = await response.json();
                     allPayments = allPayments.concat(payments);
-                    console.log(`Payment records for expense ${expense.id}: ${payments.length}`);
+                    console.log(`Payment records for expense ${expenseId}: ${payments.length}`);
                 }
             } catch (error) {
-                console.warn(`Failed to get payment records for expense ${expense.id}:`, error);
+                console.warn(`Failed to get payment records for expense ${expenseId}:`, error);
             }
         }
         
@@ -485,6 +519,7 @@ window.clearAuthData = clearAuthData;
 window.getGroupData = getGroupData;
 window.getGroupMembers = getGroupMembers;
 window.getGroupExpenses = getGroupExpenses;
+window.getGroupExpensesPage = getGroupExpensesPage;
 window.getGroupPayments = getGroupPayments;
 window.getGroupRecurringExpenses = getGroupRecurringExpenses;
 window.inviteMemberToGroup = inviteMemberToGroup;
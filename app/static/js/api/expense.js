@@ -5,6 +5,7 @@ const JS_CACHE_VERSION = '2025.11.10.007';
 // expense.js - Expense-related CRUD operations, split calculation, form processing
 import { getTodayDate, requireAdmin, getAuthToken, showCustomAlert, amountToCents } from '../ui/utils.js'; // 🔴 Fix: import amountToCents
 import { centsToAmountString } from './amount_utils.js';
+import { appendReceipt } from './uploads.js';
 
 // --- Global State ---
 let selectedParticipants = new Set();
@@ -190,10 +191,14 @@ export async function handleSaveExpense(event) {
     // The splits array must be converted to a JSON string to be sent in FormData
     formData.append('splits', JSON.stringify(splits)); 
 
-    // 🚨 New: Add the file
+    // 🚨 New: Add the file (uploaded straight to storage, the API only gets its key)
     if (receiptFile) {
-        // The backend will receive this file as 'image_file'
-        formData.append('image_file', receiptFile); 
+        try {
+            await appendReceipt(formData, receiptFile);
+        } catch (error) {
+            showCustomAlert('Error', error.message);
+            return;
+        }
     }
 
     console.log('Sending expense data (FormData):', {
@@ -314,7 +319,7 @@ export function refreshExpensesList() {
                 
                 ${expense.image_url ? `
                     <div class="flex-shrink-0 w-16 h-16 bg-gray-100 rounded-lg overflow-hidden border border-gray-200 mr-4">
-                        <img src="${expense.image_url}" alt="Expense receipt image" 
+                        <img src="${expense.thumbnail_url || expense.image_url}" alt="Expense receipt image" loading="lazy"
                              class="w-full h-full object-cover">
                     </div>
                 ` : `
@@ -337,7 +342,14 @@ export function refreshExpensesList() {
                 </div>
             </div>
         `;
-    }).join('');
+    }).join('') + (window.expensesNextCursor ? `
+        <div class="text-center pt-2">
+            <button type="button" onclick="loadMoreExpenses()"
+                    class="px-4 py-2 text-sm font-medium text-primary border border-primary rounded-lg hover:bg-primary/10 transition duration-150">
+                Load more
+            </button>
+        </div>
+    ` : '');
 }
 
 let currentEditingExpenseId = null;  //for update function 04 Nov
@@ -460,7 +472,7 @@ label.className = 'flex items-center space-x-3 p-3 bg-white rounded-lg border bo
 
     if (expense.image_url) {
         // If an image URL exists, show the preview
-        if (previewImg) previewImg.src = expense.image_url;
+        if (previewImg) previewImg.src = expense.display_url || expense.image_url;
         if (previewLink) previewLink.href = expense.image_url; // 🔴 Fix: Set the link
         if (previewContainer) previewContainer.classList.remove('hidden');
         // if (fileNameDisplay) fileNameDisplay.textContent = 'Current receipt uploaded. Click to select a replacement';
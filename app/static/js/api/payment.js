@@ -10,6 +10,7 @@ import {
     showCustomAlert,
     requireAdmin 
 } from '../ui/utils.js';
+import { appendReceipt } from './uploads.js';
 
 // --- Global State ---
 let currentEditingPayment = null;
@@ -201,9 +202,6 @@ export async function handleSavePayment(event) {
         // apiFormData.append('date', paymentData.date); // Payment date is set by the backend
         
         const receiptFile = formData.get('payment-receipt-file');
-        if (receiptFile && receiptFile.size > 0) {
-             apiFormData.append('image_file', receiptFile);
-        }
 
         // Validation (use paymentData for validation)
         const errors = [];
@@ -229,6 +227,14 @@ export async function handleSavePayment(event) {
         
         console.log('Saving payment record, Expense ID:', expenseId);
 
+        // Receipt goes straight to storage; the API only gets its key
+        try {
+            await appendReceipt(apiFormData, receiptFile);
+        } catch (error) {
+            showCustomAlert('Error', error.message);
+            return;
+        }
+
         // API call
         const response = await fetch(`/expenses/${expenseId}/payments`, {
             method: 'POST',
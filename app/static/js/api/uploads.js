@@ -0,0 +1,55 @@
+// uploads.js - Direct receipt upload: hash locally, send bytes straight to storage
+// Prevent caching version: 2025.11.20.001
+const JS_CACHE_VERSION = '2025.11.20.001';
+
+import { getAuthToken } from '../ui/utils.js';
+
+/**
+ * Add a receipt to a FormData before creating an expense / payment.
+ * Uploads the file directly to storage (POST /uploads/presign, then PUT) and
+ * appends its `image_key`; falls back to sending `image_file` through the API
+ * when the browser can't hash (no WebCrypto outside https / localhost) or the
+ * server has direct uploads disabled.
+ */
+export async function appendReceipt(formData, file) {
+    if (!file || file.size === 0) return;
+    const key = window.crypto && window.crypto.subtle ? await uploadReceipt(file) : null;
+    if (key) {
+        formData.append('image_key', key);
+    } else {
+        formData.append('image_file', file);
+    }
+}
+
+async function sha256Hex(file) {
+    const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+/** Returns the stored file's key, or null when direct uploads are disabled (404). */
+export async function uploadReceipt(file) {
+    const response = await fetch('/uploads/presign', {
+        method: 'POST',
+        headers: {
+            'Authorization': `Bearer ${getAuthToken()}`,
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            sha256: await sha256Hex(file),
+            size: file.size,
+            content_type: file.type || 'application/octet-stream'
+        })
+    });
+    if (response.status === 404) return null;
+    if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(errorData.detail || 'Could not prepare the receipt upload');
+    }
+    const { key, upload } = await response.json();
+    if (upload) {
+        // bytes go to storage directly, not through the API
+        const put = await fetch(upload.url, { method: upload.method, headers: upload.headers, body: file });
+        if (!put.ok) throw new Error('Receipt upload failed');
+    }
+    return key;
+}
@@ -6,7 +6,7 @@ import {
 //   getCurrentUser, // changed by sunzhe
     getGroupData,
     getGroupMembers,
-    getGroupExpenses,
+    getGroupExpensesPage,
     getGroupPayments,
     getGroupRecurringExpenses
 } from '../api/auth.js';
@@ -90,6 +90,7 @@ window.currentGroup = null;
 // Data Lists
 window.groupMembers = [];
 window.expensesList = [];
+window.expensesNextCursor = null; // X-Next-Cursor of the last loaded expense page
 window.paymentsList = [];
 window.recurringExpensesList = [];
 
@@ -207,11 +208,31 @@ async function loadDataLists() {
     }
 }
 
+// Expenses are loaded a page at a time (newest first); "Load more" fetches the next page
 async function loadExpensesList() {
-    window.expensesList = await getGroupExpenses(window.currentGroupId);
+    const page = await getGroupExpensesPage(window.currentGroupId);
+    window.expensesList = page.expenses;
+    window.expensesNextCursor = page.nextCursor;
     refreshExpensesList();
 }
 
+async function loadMoreExpenses() {
+    if (!window.expensesNextCursor || window.expensesLoadingMore) return;
+    window.expensesLoadingMore = true;
+    try {
+        const page = await getGroupExpensesPage(window.currentGroupId, { cursor: window.expensesNextCursor });
+        window.expensesList = window.expensesList.concat(page.expenses);
+        window.expensesNextCursor = page.nextCursor;
+        refreshExpensesList();
+        updateTabCounts();
+    } catch (error) {
+        console.error('Failed to load more expenses:', error);
+        showCustomAlert('Error', 'Failed to load more expenses');
+    } finally {
+        window.expensesLoadingMore = false;
+    }
+}
+
 async function loadPaymentsList() {
     window.paymentsList = await getGroupPayments(window.currentGroupId);
     refreshPaymentsList();
@@ -448,7 +469,7 @@ function updateTabCounts() {
     const memberCount = document.getElementById('member-count');
     const activeMemberCount = document.getElementById('active-member-count');
 
-    if (expenseCount) expenseCount.textContent = window.expensesList.length;
+    if (expenseCount) expenseCount.textContent = window.expensesList.length + (window.expensesNextCursor ? '+' : '');
     if (recurringCount) recurringCount.textContent = window.recurringExpensesList.length;
     if (paymentCount) paymentCount.textContent = window.paymentsList.length;
     if (memberCount) memberCount.textContent = window.groupMembers.length;
@@ -751,6 +772,7 @@ window.handleBackToDashboard = handleBackToDashboard;
 window.handleMyProfile = handleMyProfile;
 window.handleLogoutUser = handleLogoutUser;
 window.loadExpensesList = loadExpensesList;
+window.loadMoreExpenses = loadMoreExpenses;
 
 // Export data loading functions
 window.loadMembersList = loadMembersList;
@@ -1111,6 +1133,7 @@ setTimeout(ensureGlobalFunctions, 1000);
         window.handleMyProfile = handleMyProfile;
         window.handleLogoutUser = handleLogoutUser;
         window.loadExpensesList = loadExpensesList;
+        window.loadMoreExpenses = loadMoreExpenses;
         window.loadMembersList = loadMembersList;
         window.showCustomAlert = showCustomAlert;
         
@@ -1133,10 +1156,14 @@ setTimeout(ensureGlobalFunctions, 1000);
 // 🔴 [START] Audit Log Fix
 // ----------------------------------------------------
 
+const AUDIT_PAGE_SIZE = 50;
+
 /**
  * (Fixed) Load audit logs
+ * Loads the first page; "Load more" continues from the X-Next-Cursor header.
+ * @param {boolean} append - append the next page instead of reloading
  */
-window.loadAuditLogs = async function() {
+window.loadAuditLogs = async function(append = false) {
     const container = document.getElementById('audit-log-content');
     if (!container) {
         console.error('Audit log container not found');
@@ -1156,11 +1183,18 @@ window.loadAuditLogs = async function() {
             return;
         }
         
-        // Show loading status
-        container.innerHTML = '<div class="text-center text-gray-500">Loading audit logs...</div>';
-        
+        if (!append) {
+            // Show loading status
+            container.innerHTML = '<div class="text-center text-gray-500">Loading audit logs...</div>';
+            window.auditLogsList = [];
+            window.auditNextCursor = null;
+        }
+
+        const query = new URLSearchParams({ limit: AUDIT_PAGE_SIZE });
+        if (append && window.auditNextCursor) query.set('cursor', window.auditNextCursor);
+
         // 🔴 Fix: use the correct API route (from main.py)
-        const response = await fetch(`/groups/${groupId}/audit-trail`, {
+        const response = await fetch(`/groups/${groupId}/audit-trail?${query}`, {
             headers: {
                 'Authorization': `Bearer ${token}`
             }
@@ -1168,14 +1202,16 @@ window.loadAuditLogs = async function() {
         
         if (response.ok) {
             const logs = await response.json();
-            
-            if (!logs || logs.length === 0) {
+            window.auditLogsList = (window.auditLogsList || []).concat(logs);
+            window.auditNextCursor = response.headers.get('X-Next-Cursor');
+
+            if (window.auditLogsList.length === 0) {
                 container.innerHTML = '<p class="text-center text-gray-500">No audit logs yet</p>';
                 return;
             }
-            
+
             // Render audit logs
-            renderAuditLogs(logs); // 🔴 Fix: call the new rendering function
+            renderAuditLogs(window.auditLogsList); // 🔴 Fix: call the new rendering function
             
         } else {
             const errorData = await response.json();
@@ -1245,8 +1281,17 @@ function renderAuditLogs(logs) {
             </div>
         `;
     }).join('');
-    
-    container.innerHTML = logsHTML;
+
+    const loadMoreHTML = window.auditNextCursor ? `
+        <div class="text-center mt-3">
+            <button type="button" onclick="window.loadAuditLogs(true)"
+                class="px-4 py-2 text-sm font-medium text-primary border border-primary rounded hover:bg-blue-50">
+                Load more
+            </button>
+        </div>
+    ` : '';
+
+    container.innerHTML = logsHTML + loadMoreHTML;
 }
 
 /**
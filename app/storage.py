@@ -0,0 +1,298 @@
+# storage.py  blob storage for uploaded receipts (STORAGE_BACKEND)
+#
+#   local  (default) files under UPLOAD_DIR, downloaded through the /static
+#          mount. Direct uploads go to PUT /uploads/direct/<key> with an HMAC
+#          signed, expiring URL (the local stand-in for a pre-signed PUT).
+#   s3     any S3-compatible store (AWS, MinIO, ...; STORAGE_S3_ENDPOINT_URL).
+#          Clients PUT to a pre-signed URL that pins the length and the
+#          SHA-256 checksum, and download through pre-signed GET URLs, so the
+#          API never handles the bytes. Needs boto3.
+#
+# Rows store storage keys (e.g. "ab/ab12...ef.jpg"), never URLs: url_for()
+# turns a key into a download URL when a response is serialized. Values
+# written before keys existed ("/static/uploads/...") are passed through.
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+from urllib.parse import quote, unquote, urlencode, urlsplit
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()  # local | s3
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "app/static/uploads")
+UPLOAD_URL_PREFIX = os.getenv("UPLOAD_URL_PREFIX", "/static/uploads")
+# lifetime of pre-signed upload / download URLs
+STORAGE_URL_TTL_S = int(os.getenv("STORAGE_URL_TTL_S", "3600"))
+STORAGE_SIGNING_KEY = os.getenv("STORAGE_SIGNING_KEY", "")  # local direct-upload URLs; unset disables them
+
+STORAGE_S3_BUCKET = os.getenv("STORAGE_S3_BUCKET", "")
+STORAGE_S3_PREFIX = os.getenv("STORAGE_S3_PREFIX", "receipts/")
+STORAGE_S3_ENDPOINT_URL = os.getenv("STORAGE_S3_ENDPOINT_URL") or None  # e.g. http://localhost:9000 for MinIO
+STORAGE_S3_REGION = os.getenv("STORAGE_S3_REGION") or None
+
+if STORAGE_BACKEND not in ("local", "s3"):
+    raise ValueError(f"STORAGE_BACKEND must be local or s3, not {STORAGE_BACKEND!r}")
+
+DIRECT_UPLOAD_PATH = "/uploads/direct"
+
+logger = logging.getLogger("storage")
+
+# no default key (anyone could forge upload URLs with it): without one the local
+# backend only takes multipart uploads and the direct-upload routes answer 404
+DIRECT_UPLOADS_ENABLED = STORAGE_BACKEND == "s3" or bool(STORAGE_SIGNING_KEY)
+if not DIRECT_UPLOADS_ENABLED:
+    logger.warning("storage: STORAGE_SIGNING_KEY is not set, direct uploads (POST /uploads/presign) are disabled")
+
+
+class BlobStorage(ABC):
+    """Operations uploads.py / images.py need from a backend. Keys are relative, '/' separated."""
+
+    name = ""
+
+    @abstractmethod
+    def size(self, key: str) -> Optional[int]:
+        """Stored size in bytes, or None if there is no such object."""
+
+    def exists(self, key: str) -> bool:
+        return self.size(key) is not None
+
+    @abstractmethod
+    def read_head(self, key: str, length: int) -> bytes:
+        """The first `length` bytes of `key`."""
+
+    @abstractmethod
+    def put_file(self, key: str, path: str, content_type: str):
+        """Stores the local file `path` under `key`; the file may be moved away."""
+
+    @abstractmethod
+    def get_file(self, key: str, path: str):
+        """Copies `key` to the local file `path`."""
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Filesystem path of `key` when the backend is the local disk, else None."""
+        return None
+
+    @abstractmethod
+    def delete_prefix(self, prefix: str) -> int:
+        """Deletes every object whose key starts with `prefix`; returns how many."""
+
+    @abstractmethod
+    def download_url(self, key: str) -> str:
+        """URL a client downloads `key` from."""
+
+    def key_from_url(self, url: str) -> Optional[str]:
+        """The key behind a download_url() result, or None for any other URL."""
+        return None
+
+    @abstractmethod
+    def presign_upload(self, key: str, content_type: str, size: int, sha256: str) -> Dict:
+        """{"method", "url", "headers"} for the client to send the bytes to directly."""
+
+
+class LocalStorage(BlobStorage):
+
+    name = "local"
+
+    def __init__(self, root: str = UPLOAD_DIR, url_prefix: str = UPLOAD_URL_PREFIX):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def _path(self, key: str) -> str:
+        if key.startswith("/") or ".." in key.split("/"):
+            raise ValueError(f"Invalid storage key {key!r}")
+        return os.path.join(self.root, key)
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self._path(key)
+
+    def size(self, key: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self._path(key))
+        except OSError:
+            return None
+
+    def read_head(self, key: str, length: int) -> bytes:
+        with open(self._path(key), "rb") as f:
+            return f.read(length)
+
+    def put_file(self, key: str, path: str, content_type: str):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(path, target)  # atomic when on the same filesystem
+        except OSError:
+            shutil.move(path, target)
+
+    def get_file(self, key: str, path: str):
+        shutil.copyfile(self._path(key), path)
+
+    def delete_prefix(self, prefix: str) -> int:
+        directory, name = os.path.split(self._path(prefix))
+        removed = 0
+        for entry in os.listdir(directory) if os.path.isdir(directory) else ():
+            if entry.startswith(name):
+                try:
+                    os.remove(os.path.join(directory, entry))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def download_url(self, key: str) -> str:
+        return f"{self.url_prefix}/{key}"
+
+    def presign_upload(self, key: str, content_type: str, size: int, sha256: str) -> Dict:
+        if not STORAGE_SIGNING_KEY:
+            raise RuntimeError("direct uploads to local storage need STORAGE_SIGNING_KEY")
+        expires = int(time.time()) + STORAGE_URL_TTL_S
+        query = urlencode({"expires": expires, "size": size, "signature": _sign(key, expires, size)})
+        return {
+            "method": "PUT",
+            "url": f"{DIRECT_UPLOAD_PATH}/{quote(key)}?{query}",
+            "headers": {"Content-Type": content_type},
+        }
+
+
+def _sign(key: str, expires: int, size: int) -> str:
+    message = f"{key}|{expires}|{size}".encode()
+    return hmac.new(STORAGE_SIGNING_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify_direct_upload(key: str, expires: int, size: int, signature: str) -> bool:
+    """Checks a LocalStorage.presign_upload URL: right signature and not expired."""
+    if not STORAGE_SIGNING_KEY:
+        return False
+    return expires >= time.time() and hmac.compare_digest(_sign(key, expires, size), signature)
+
+
+class S3Storage(BlobStorage):
+
+    name = "s3"
+
+    def __init__(self, bucket: str = STORAGE_S3_BUCKET, prefix: str = STORAGE_S3_PREFIX,
+                 endpoint_url: Optional[str] = STORAGE_S3_ENDPOINT_URL, region: Optional[str] = STORAGE_S3_REGION):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 to be installed") from e
+        if not bucket:
+            raise ValueError("STORAGE_BACKEND=s3 requires STORAGE_S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client_error = ClientError
+        # credentials come from the usual AWS_* environment / config files
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=region,
+            config=Config(signature_version="s3v4", s3={"addressing_style": "path" if endpoint_url else "auto"}),
+        )
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def size(self, key: str) -> Optional[int]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+        except self._client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def read_head(self, key: str, length: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket, Key=self._key(key), Range=f"bytes=0-{length - 1}")
+        return response["Body"].read()
+
+    def put_file(self, key: str, path: str, content_type: str):
+        self.client.upload_file(path, self.bucket, self._key(key), ExtraArgs={"ContentType": content_type})
+        os.remove(path)
+
+    def get_file(self, key: str, path: str):
+        self.client.download_file(self.bucket, self._key(key), path)
+
+    def delete_prefix(self, prefix: str) -> int:
+        removed = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            objects = [{"Key": item["Key"]} for item in page.get("Contents", ())]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+                removed += len(objects)
+        return removed
+
+    def download_url(self, key: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._key(key)}, ExpiresIn=STORAGE_URL_TTL_S,
+        )
+
+    def key_from_url(self, url: str) -> Optional[str]:
+        # path style: <endpoint>/<bucket>/<prefix><key>, virtual host style: <bucket>.<endpoint>/<prefix><key>
+        parts = urlsplit(url)
+        endpoint = urlsplit(self.client.meta.endpoint_url).netloc
+        path = unquote(parts.path).lstrip("/")
+        if parts.netloc == endpoint and path.startswith(self.bucket + "/"):
+            path = path[len(self.bucket) + 1:]
+        elif parts.netloc != f"{self.bucket}.{endpoint}":
+            return None
+        if not path.startswith(self.prefix) or len(path) == len(self.prefix):
+            return None
+        return path[len(self.prefix):]
+
+    def presign_upload(self, key: str, content_type: str, size: int, sha256: str) -> Dict:
+        # length and checksum are signed: the store rejects any other body, so the
+        # key (derived from the hash) always matches the content
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        url = self.client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": self._key(key), "ContentType": content_type,
+                    "ContentLength": size, "ChecksumSHA256": checksum},
+            ExpiresIn=STORAGE_URL_TTL_S,
+        )
+        return {
+            "method": "PUT",
+            "url": url,
+            "headers": {"Content-Type": content_type, "x-amz-checksum-sha256": checksum},
+        }
+
+
+_storage: Optional[BlobStorage] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> BlobStorage:
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = S3Storage() if STORAGE_BACKEND == "s3" else LocalStorage()
+        return _storage
+
+
+def key_from_value(value: Optional[str]) -> Optional[str]:
+    """
+    Storage key for a stored image_url value; local download URLs and the
+    backend's own (e.g. pre-signed S3) download URLs are mapped back to their key.
+    """
+    prefix = UPLOAD_URL_PREFIX + "/"
+    if value and value.startswith(prefix):
+        return value[len(prefix):]
+    if value and "://" in value:
+        return get_storage().key_from_url(value)
+    if not value or value.startswith("/"):
+        return None
+    return value
+
+
+def url_for(value: Optional[str]) -> Optional[str]:
+    """Download URL for a stored key; other values (legacy or external URLs) are returned unchanged."""
+    if not value or value.startswith("/") or "://" in value:
+        return value
+    try:
+        return get_storage().download_url(value)
+    except Exception as e:
+        logger.error(f"storage: no download URL for {value!r}: {e}")
+        return None
@@ -0,0 +1,511 @@
+# uploads.py  receipt image uploads: streamed staging, validation, publish before the transaction
+#
+# Two ways in:
+#   - multipart form (image_file): stage_upload() copies the UploadFile in
+#     chunks into a temp file under UPLOAD_DIR/.tmp, enforcing
+#     UPLOAD_MAX_BYTES, sniffing the type from the magic bytes and hashing the
+#     content on the way; the disk writes run in the threadpool.
+#   - direct (image_key): the client hashes the file, asks presign() for an
+#     upload URL and sends the bytes straight to the storage backend
+#     (app/storage.py); check_stored() then validates the object by its key.
+# publish() then stores either under its key before any transaction starts,
+# registered as an unreferenced stored_files row, so no DB connection or row
+# lock is held while the bytes go to storage. attach_to_transaction() only
+# claims that row inside the transaction: a committed row never points at a
+# missing file, and a file whose transaction fails stays unreferenced and is
+# removed by gc like any released file.
+#
+# Files are content addressed: key <sha[:2]>/<sha256><ext>, so the same
+# receipt uploaded again is stored once. Rows store the key; responses turn it
+# into a URL (storage.url_for). stored_files counts the Expense / Payment rows
+# whose image_url holds each key (mapper events below); when the count drops
+# to 0 the file is deleted by a background worker after the commit, and
+# `python -m app.uploads gc` sweeps anything left over.
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+from fastapi import UploadFile
+from sqlalchemy import case, delete, event, func, inspect, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, object_session
+from starlette.concurrency import run_in_threadpool
+
+from app import models, storage
+from app.database import engine
+from app.storage import UPLOAD_DIR
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_ALLOWED_TYPES = {
+    kind.strip() for kind in os.getenv("UPLOAD_ALLOWED_TYPES", "jpeg,png,gif,webp,heic,pdf").split(",") if kind.strip()
+}
+
+# kind -> (extension, content type)
+FILE_TYPES = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "png": (".png", "image/png"),
+    "gif": (".gif", "image/gif"),
+    "webp": (".webp", "image/webp"),
+    "heic": (".heic", "image/heic"),
+    "pdf": (".pdf", "application/pdf"),
+}
+_KIND_BY_CONTENT_TYPE = {content_type: kind for kind, (_, content_type) in FILE_TYPES.items()}
+
+# staged files and direct uploads that were not referenced within this long are removed by gc
+UPLOAD_TMP_MAX_AGE_S = int(os.getenv("UPLOAD_TMP_MAX_AGE_S", "86400"))
+
+_RELEASED_KEY = "released_uploads"
+_CONTENT_KEY_RE = re.compile(r"^[0-9a-f]{2}/([0-9a-f]{64})\.[a-z0-9]+$")
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+logger = logging.getLogger("uploads")
+
+
+class UploadRejected(ValueError):
+    """The upload is not acceptable (routes answer 400, or 413 for UploadTooLarge)."""
+
+
+class UploadTooLarge(UploadRejected):
+    pass
+
+
+def sniff_type(head: bytes) -> Optional[str]:
+    """File kind from the first bytes, or None if it isn't one we know."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"hevc", b"mif1", b"msf1"):
+        return "heic"
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    return None
+
+
+def content_hash(value: Optional[str]) -> Optional[str]:
+    """SHA-256 of a content-addressed upload key; None for other values (e.g. pre-dedup uuid names)."""
+    match = _CONTENT_KEY_RE.match(storage.key_from_value(value) or "")
+    return match.group(1) if match else None
+
+
+@dataclass
+class StoredUpload:
+    """Content already in storage under its key (direct upload)."""
+    size: int
+    sha256: str
+    kind: str
+
+    @property
+    def extension(self) -> str:
+        return FILE_TYPES[self.kind][0]
+
+    @property
+    def key(self) -> str:
+        return f"{self.sha256[:2]}/{self.sha256}{self.extension}"
+
+    @property
+    def content_type(self) -> str:
+        return FILE_TYPES[self.kind][1]
+
+    def commit(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+@dataclass
+class StagedUpload(StoredUpload):
+    """Content in a local temp file, published to storage by publish()."""
+    tmp_path: str
+
+    def commit(self):
+        """Publishes the staged file under its key unless the content is already stored."""
+        backend = storage.get_storage()
+        if backend.exists(self.key):
+            self.discard()
+            return
+        backend.put_file(self.key, self.tmp_path, self.content_type)
+
+    def discard(self):
+        """Deletes the staged file; no-op once it was committed."""
+        _remove_quietly(self.tmp_path)
+
+
+def _too_large_message() -> str:
+    return f"File too large (max {round(UPLOAD_MAX_BYTES / (1024 * 1024), 1):g} MB)"
+
+
+def _tmp_dir() -> str:
+    path = os.path.join(UPLOAD_DIR, ".tmp")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _check_kind(kind: Optional[str]):
+    if kind is None or kind not in UPLOAD_ALLOWED_TYPES:
+        allowed = ", ".join(sorted(UPLOAD_ALLOWED_TYPES))
+        raise UploadRejected(f"Unsupported file type (allowed: {allowed})")
+
+
+async def _stage_chunks(chunks: AsyncIterator[bytes], max_bytes: int) -> StagedUpload:
+    tmp_path = os.path.join(await run_in_threadpool(_tmp_dir), uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    kind = None
+    out = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if kind is None:
+                kind = sniff_type(chunk[:16])
+                _check_kind(kind)
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(_too_large_message())
+            digest.update(chunk)
+            await run_in_threadpool(out.write, chunk)
+        await run_in_threadpool(out.close)
+        if kind is None:
+            raise UploadRejected("Uploaded file is empty")
+    except BaseException:
+        out.close()
+        await run_in_threadpool(_remove_quietly, tmp_path)
+        raise
+    return StagedUpload(size=size, sha256=digest.hexdigest(), kind=kind, tmp_path=tmp_path)
+
+
+async def _read_chunks(upload: UploadFile):
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def stage_upload(upload: Optional[UploadFile]) -> Optional[StagedUpload]:
+    """
+    Streams `upload` into a temp file. Returns None when no file was sent;
+    raises UploadRejected / UploadTooLarge (nothing is left on disk then).
+    """
+    if upload is None or not upload.filename:
+        return None
+    if upload.size is not None and upload.size > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(_too_large_message())
+    try:
+        staged = await _stage_chunks(_read_chunks(upload), UPLOAD_MAX_BYTES)
+    finally:
+        await upload.close()
+    logger.info(f"uploads: staged {upload.filename!r} as {staged.kind}, {staged.size} bytes, sha256 {staged.sha256[:12]}")
+    return staged
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _insert(connection):
+    return (pg_insert if connection.dialect.name == "postgresql" else sqlite_insert)(models.StoredFile)
+
+
+# ----------- direct uploads -----------
+
+def presign(db: Session, sha256: str, size: int, content_type: str) -> Dict:
+    """
+    Where the client should send a file with this hash / size / type:
+    {"key", "upload"}; upload is None when the content is stored already.
+    The client then creates the expense / payment with image_key=key.
+    """
+    sha256 = sha256.lower()
+    if not _SHA256_RE.match(sha256):
+        raise UploadRejected("sha256 must be 64 hex characters")
+    if size <= 0:
+        raise UploadRejected("Uploaded file is empty")
+    if size > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(_too_large_message())
+    kind = _KIND_BY_CONTENT_TYPE.get(content_type)
+    _check_kind(kind)
+    upload = StoredUpload(size=size, sha256=sha256, kind=kind)
+    backend = storage.get_storage()
+    if backend.exists(upload.key):
+        return {"key": upload.key, "upload": None}
+    # unreferenced row, so gc removes the object if it is never attached
+    db.execute(_insert(db.connection()).values(
+        sha256=sha256, path=upload.key, size=size, content_type=upload.content_type,
+        ref_count=0, released_at=func.now(),
+    ).on_conflict_do_nothing(index_elements=[models.StoredFile.sha256]))
+    db.commit()
+    return {"key": upload.key, "upload": backend.presign_upload(upload.key, upload.content_type, size, sha256)}
+
+
+async def receive_direct_upload(key: str, size: int, chunks: AsyncIterator[bytes]):
+    """Local backend's stand-in for a pre-signed PUT: stores the body if it matches `key`'s hash."""
+    if content_hash(key) is None:
+        raise UploadRejected("Invalid upload key")
+    staged = await _stage_chunks(chunks, min(size, UPLOAD_MAX_BYTES))
+    try:
+        if staged.key != key or staged.size != size:
+            raise UploadRejected("Uploaded content does not match the requested upload")
+        await run_in_threadpool(staged.commit)
+    finally:
+        staged.discard()
+
+
+def check_stored(key: str) -> StoredUpload:
+    """Validates a direct upload before a row takes it; raises UploadRejected."""
+    sha = content_hash(key)
+    if sha is None:
+        raise UploadRejected("Invalid image_key")
+    backend = storage.get_storage()
+    size = backend.size(key)
+    if size is None:
+        raise UploadRejected("Upload not found; send the file to its upload URL first")
+    if size > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(_too_large_message())
+    kind = sniff_type(backend.read_head(key, 16))
+    _check_kind(kind)
+    upload = StoredUpload(size=size, sha256=sha, kind=kind)
+    if upload.key != key:
+        raise UploadRejected("Upload content does not match its file type")
+    return upload
+
+
+def publish(upload: StoredUpload) -> StoredUpload:
+    """
+    Stores `upload` (a staged file, or a direct upload already in storage)
+    before the transaction that uses it; call it without holding a connection.
+    Its stored_files row is registered unreferenced first, so gc removes the
+    file if no committed row ever takes it.
+    """
+    table = models.StoredFile.__table__
+    with engine.begin() as connection:
+        statement = _insert(connection).values(
+            sha256=upload.sha256, path=upload.key, size=upload.size,
+            content_type=upload.content_type, ref_count=0, released_at=func.now(),
+        )
+        # an unreferenced row restarts its grace period, so a full gc doesn't take the file now
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[models.StoredFile.sha256], set_={"released_at": func.now()},
+            where=table.c.ref_count <= 0,
+        ))
+    upload.commit()
+    return upload
+
+
+def attach_to_transaction(db: Session, upload: StoredUpload) -> str:
+    """
+    Claims a published `upload` for a row about to store its key; returns the
+    key. No storage I/O: the file is in place already (publish()).
+    """
+    table = models.StoredFile.__table__
+    # the UPDATE also locks the row, so a concurrent gc can't delete the file underneath us
+    claimed = db.execute(
+        update(table).where(table.c.sha256 == upload.sha256).values(released_at=None)
+    ).rowcount
+    if not claimed:
+        # gc removed the unreferenced file between publish() and now
+        raise UploadRejected("The uploaded file expired before it was used; please upload it again")
+    return upload.key
+
+
+def _change_refs(connection, session: Optional[Session], values: Iterable[Optional[str]], delta: int):
+    table = models.StoredFile.__table__
+    for value in values:
+        sha = content_hash(value)
+        if sha is None:
+            continue
+        new_count = table.c.ref_count + delta
+        connection.execute(
+            update(table).where(table.c.sha256 == sha).values(
+                ref_count=new_count,
+                released_at=case((new_count <= 0, func.now()), else_=None),
+            )
+        )
+        if delta < 0 and session is not None:
+            session.info.setdefault(_RELEASED_KEY, set()).add(sha)
+
+
+def release(db: Session, values: Iterable[Optional[str]]):
+    """Drops references held by rows removed with a bulk query.delete() (no mapper events)."""
+    _change_refs(db.connection(), db, values, -1)
+
+
+# ----------- reference counting on Expense / Payment image_url -----------
+
+def _after_insert(mapper, connection, target):
+    _change_refs(connection, object_session(target), [target.image_url], +1)
+
+
+def _after_update(mapper, connection, target):
+    history = inspect(target).attrs.image_url.history
+    if history.has_changes():
+        _change_refs(connection, object_session(target), [value for value in history.deleted if value], -1)
+        _change_refs(connection, object_session(target), [value for value in history.added if value], +1)
+
+
+def _after_delete(mapper, connection, target):
+    _change_refs(connection, object_session(target), [target.image_url], -1)
+
+
+def _store_as_key(target, value, oldvalue, initiator):
+    # a client sending back the download URL it was given still stores (and counts) the key
+    return storage.key_from_value(value) or value
+
+
+for _model in (models.Expense, models.Payment):
+    event.listen(_model, "after_insert", _after_insert)
+    event.listen(_model, "after_update", _after_update)
+    event.listen(_model, "after_delete", _after_delete)
+    # active_history loads the previous value on assignment so its reference can be dropped
+    event.listen(_model.image_url, "set", _store_as_key, active_history=True, retval=True)
+
+
+@event.listens_for(Session, "after_commit")
+def _collect_released(session):
+    released = session.info.pop(_RELEASED_KEY, None)
+    if released:
+        _get_gc_pool().submit(collect_garbage, released)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_uncommitted(session, transaction):
+    # rolled back, or the session was closed without committing
+    if transaction.parent is None:
+        session.info.pop(_RELEASED_KEY, None)
+
+
+# ----------- garbage collection -----------
+
+# files released by a commit are collected here, off the request thread
+_gc_pool: Optional[ThreadPoolExecutor] = None
+_gc_pool_lock = threading.Lock()
+
+
+def _get_gc_pool() -> ThreadPoolExecutor:
+    global _gc_pool
+    with _gc_pool_lock:
+        if _gc_pool is None:
+            _gc_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="uploads-gc")
+        return _gc_pool
+
+
+def shutdown_gc_pool(wait: bool = False):
+    global _gc_pool
+    with _gc_pool_lock:
+        if _gc_pool is not None:
+            _gc_pool.shutdown(wait=wait)
+            _gc_pool = None
+
+
+def _remove_unreferenced(connection, sha: str) -> bool:
+    # the conditional DELETE locks the row (or the SQLite database) until commit, so a
+    # concurrent upload of the same content waits and then re-creates the file
+    deleted = connection.execute(
+        delete(models.StoredFile).where(models.StoredFile.sha256 == sha, models.StoredFile.ref_count <= 0)
+    ).rowcount
+    if deleted:
+        # the original plus any derived files (app/images.py variants) named after it
+        storage.get_storage().delete_prefix(f"{sha[:2]}/{sha}")
+    return bool(deleted)
+
+
+def collect_garbage(shas: Optional[Iterable[str]] = None) -> int:
+    """
+    Deletes unreferenced files: only `shas` if given, otherwise everything
+    released more than UPLOAD_TMP_MAX_AGE_S ago (so pending direct uploads
+    survive) plus stale staged files. Returns the number of stored files removed.
+    """
+    table = models.StoredFile.__table__
+    query = select(table.c.sha256).where(table.c.ref_count <= 0)
+    if shas is not None:
+        query = query.where(table.c.sha256.in_(list(shas)))
+    else:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_TMP_MAX_AGE_S)
+        query = query.where(or_(table.c.released_at.is_(None), table.c.released_at < cutoff))
+    removed = 0
+    try:
+        with engine.connect() as connection:
+            candidates = connection.execute(query).scalars().all()
+        for sha in candidates:
+            with engine.begin() as connection:
+                removed += _remove_unreferenced(connection, sha)
+    except Exception as e:
+        logger.error(f"uploads: garbage collection failed: {e}")
+    if shas is None:
+        _remove_stale_staged_files()
+    if removed:
+        logger.info(f"uploads: removed {removed} unreferenced file(s)")
+    return removed
+
+
+def _remove_stale_staged_files():
+    tmp_dir = os.path.join(UPLOAD_DIR, ".tmp")
+    if not os.path.isdir(tmp_dir):
+        return
+    cutoff = time.time() - UPLOAD_TMP_MAX_AGE_S
+    for name in os.listdir(tmp_dir):
+        path = os.path.join(tmp_dir, name)
+        if os.path.getmtime(path) < cutoff:
+            _remove_quietly(path)
+
+
+def reconcile() -> int:
+    """
+    Recomputes every ref_count from the image_url columns (repairs counts after
+    deletes that bypassed the ORM, e.g. ON DELETE CASCADE). Returns rows changed.
+    """
+    counts = {}
+    with engine.begin() as connection:
+        for model in (models.Expense, models.Payment):
+            rows = connection.execute(
+                select(model.image_url, func.count()).where(model.image_url.isnot(None)).group_by(model.image_url)
+            ).all()
+            for value, count in rows:
+                sha = content_hash(value)
+                if sha:
+                    counts[sha] = counts.get(sha, 0) + count
+        table = models.StoredFile.__table__
+        changed = 0
+        for sha, ref_count in connection.execute(select(table.c.sha256, table.c.ref_count)).all():
+            actual = counts.get(sha, 0)
+            if actual != ref_count:
+                connection.execute(update(table).where(table.c.sha256 == sha).values(
+                    ref_count=actual, released_at=datetime.now(timezone.utc) if actual == 0 else None,
+                ))
+                changed += 1
+    return changed
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    command = (argv if argv is not None else sys.argv[1:] or ["gc"])[0]
+    if command == "gc":
+        print(f"removed {collect_garbage()} unreferenced file(s)")
+    elif command == "reconcile":
+        print(f"corrected {reconcile()} reference count(s); removed {collect_garbage()} unreferenced file(s)")
+    else:
+        print("usage: python -m app.uploads gc|reconcile")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
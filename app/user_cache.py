@@ -0,0 +1,248 @@
+# user_cache.py  caches the authenticated user behind get_current_user
+#
+# Every authenticated request used to run SELECT ... FROM users WHERE email = :sub.
+# The cache keeps a small immutable snapshot (id / email / username) per token
+# subject for USER_CACHE_TTL_SECONDS, bounded to USER_CACHE_MAX_ENTRIES (LRU).
+#
+#   USER_CACHE_BACKEND=local   (default) per-process LRU/TTL dict
+#   USER_CACHE_BACKEND=shared  SharedUserCacheBackend over a key-value store, so
+#                              several workers see the same entries / invalidations.
+#                              Uses LocalKeyValueStore until configure_user_cache()
+#                              is given a real store (anything with get / set(ex=) / delete,
+#                              e.g. a redis client).
+#   USER_CACHE_BACKEND=off     always hit the database
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from app import models
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "1024"))
+USER_CACHE_BACKEND = os.getenv("USER_CACHE_BACKEND", "local").lower()
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Read-only copy of the user columns routes actually use (no password hash)."""
+    id: int
+    email: str
+    username: str
+
+    @classmethod
+    def from_user(cls, user: models.User) -> "UserSnapshot":
+        return cls(id=user.id, email=user.email, username=user.username)
+
+
+class UserCacheBackend(ABC):
+    """Interface of a user cache backend."""
+
+    @abstractmethod
+    def get(self, subject: str) -> Optional[UserSnapshot]:
+        """The cached snapshot for `subject`, or None."""
+
+    @abstractmethod
+    def set(self, subject: str, user: UserSnapshot) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, subject: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class LocalUserCacheBackend(UserCacheBackend):
+    """Size-bounded LRU with per-entry expiry, private to this process."""
+
+    def __init__(self, max_entries: int = USER_CACHE_MAX_ENTRIES, ttl_seconds: float = USER_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # subject -> (expires_at, snapshot)
+        self._lock = threading.Lock()
+
+    def get(self, subject):
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[subject]
+                return None
+            self._entries.move_to_end(subject)
+            return user
+
+    def set(self, subject, user):
+        with self._lock:
+            self._entries[subject] = (time.monotonic() + self.ttl_seconds, user)
+            self._entries.move_to_end(subject)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, subject):
+        with self._lock:
+            self._entries.pop(subject, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LocalKeyValueStore:
+    """
+    In-process stand-in for a shared key-value store (redis-style get / set(ex=) / delete).
+    Only shared between threads; swap in a real store for multiple workers.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def scan_iter(self, match="*"):
+        prefix = match.rstrip("*")
+        with self._lock:
+            return [key for key in self._data if key.startswith(prefix)]
+
+
+class SharedUserCacheBackend(UserCacheBackend):
+    """Stores JSON snapshots in a key-value store shared by all workers; the store enforces the TTL."""
+
+    def __init__(self, store=None, ttl_seconds: float = USER_CACHE_TTL_SECONDS, prefix: str = "pg12:user:"):
+        self.store = store if store is not None else LocalKeyValueStore()
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def get(self, subject):
+        try:
+            raw = self.store.get(self.prefix + subject)
+        except Exception as e:
+            logging.warning(f"user cache: shared store read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        return UserSnapshot(**json.loads(raw))
+
+    def set(self, subject, user):
+        try:
+            self.store.set(self.prefix + subject, json.dumps(asdict(user)), ex=max(1, int(self.ttl_seconds)))
+        except Exception as e:
+            logging.warning(f"user cache: shared store write failed: {e}")
+
+    def delete(self, subject):
+        try:
+            self.store.delete(self.prefix + subject)
+        except Exception as e:
+            logging.warning(f"user cache: shared store delete failed: {e}")
+
+    def clear(self):
+        keys = list(self.store.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.store.delete(*keys)
+
+
+def _backend_from_env() -> Optional[UserCacheBackend]:
+    if USER_CACHE_BACKEND == "off":
+        return None
+    if USER_CACHE_BACKEND == "shared":
+        return SharedUserCacheBackend()
+    if USER_CACHE_BACKEND != "local":
+        logging.warning(f"user cache: unknown USER_CACHE_BACKEND {USER_CACHE_BACKEND!r}, using local")
+    return LocalUserCacheBackend()
+
+
+_backend: Optional[UserCacheBackend] = _backend_from_env()
+
+
+def configure_user_cache(backend: Optional[UserCacheBackend]) -> None:
+    """Replace the active backend (None disables caching)."""
+    global _backend
+    _backend = backend
+
+
+def get_cached_user(subject: str) -> Optional[UserSnapshot]:
+    return _backend.get(subject) if _backend is not None else None
+
+
+def cache_user(subject: str, user: UserSnapshot) -> None:
+    if _backend is not None:
+        _backend.set(subject, user)
+
+
+def invalidate_user(subject: str) -> None:
+    """Drop the cached snapshot for a token subject (the user's email)."""
+    if _backend is not None:
+        _backend.delete(subject)
+
+
+def clear_user_cache() -> None:
+    if _backend is not None:
+        _backend.clear()
+
+
+# Any flush that updates / deletes a user row invalidates both its current
+# and its previous email, whichever code path made the change. The emails are
+# collected at flush time and dropped after the commit: invalidating earlier
+# would let a concurrent request re-cache the still committed old row.
+# active_history makes SQLAlchemy load the old email even when it was expired.
+_CHANGED_KEY = "changed_user_emails"
+
+
+@event.listens_for(models.User.email, "set", active_history=True)
+def _track_email_history(target, value, oldvalue, initiator):
+    return value
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _track_user_change(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    history = inspect(target).attrs.email.history
+    session.info.setdefault(_CHANGED_KEY, set()).update(
+        email for email in {target.email, *history.deleted} if email
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    for email in session.info.pop(_CHANGED_KEY, ()):
+        invalidate_user(email)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_rolled_back(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(_CHANGED_KEY, None)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Login throughput benchmark: bcrypt inline vs bcrypt in the password pool
+
+Fires concurrent POST /token requests at the app in-process (httpx ASGI
+transport, throwaway SQLite database) while a probe coroutine measures how
+long the event loop stalls. "inline" reproduces the old behaviour (bcrypt
+called directly inside the async route); "pool" is the current code.
+Keep "inline" below ~15 concurrent logins: it holds a pooled DB connection
+while blocking the loop and deadlocks the default QueuePool beyond that.
+
+Usage: python benchmark_login.py [--logins 40] [--concurrency 10] [--workers 4] [--modes inline,pool]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+_db_dir = tempfile.mkdtemp(prefix="login_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.dirname(os.path.abspath(__file__)))  # app mounts app/static relative to cwd
+
+import httpx
+
+from app import auth, crud, schemas
+from app.database import Base, SessionLocal, engine
+from app.main import app
+
+USERS = 10
+PASSWORD = "benchmark-password"
+original_authenticate = auth.authenticate_user_async
+
+
+async def _authenticate_inline(db, email, password):
+    return auth.authenticate_user(db, email=email, password=password)
+
+
+async def _probe(stop: asyncio.Event, stalls: list):
+    """Sleeps 5 ms at a time and records how late each wake-up was."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        stalls.append((time.perf_counter() - start) * 1000 - 5)
+
+
+async def run(mode: str, logins: int, concurrency: int):
+    auth.authenticate_user_async = _authenticate_inline if mode == "inline" else original_authenticate
+    semaphore = asyncio.Semaphore(concurrency)
+    stop, stalls, latencies = asyncio.Event(), [], []
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def login(index):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/token", data={
+                    "username": f"bench{index % USERS}@example.com", "password": PASSWORD,
+                })
+                assert response.status_code == 200, response.text
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        probe = asyncio.create_task(_probe(stop, stalls))
+        start = time.perf_counter()
+        await asyncio.gather(*(login(i) for i in range(logins)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "logins_per_s": logins / elapsed,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+        "max_stall_ms": max(stalls, default=0.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=auth.PASSWORD_HASH_WORKERS, help="password pool size")
+    parser.add_argument("--modes", default="inline,pool", help="comma separated: inline, pool")
+    args = parser.parse_args()
+    auth.PASSWORD_HASH_WORKERS = args.workers
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    for index in range(USERS):
+        crud.create_user(db, schemas.UserCreate(
+            email=f"bench{index}@example.com", username=f"bench{index}", password=PASSWORD,
+        ))
+    db.close()
+
+    print(f"{args.logins} logins, {args.concurrency} concurrent, pool workers {args.workers}, cpus {os.cpu_count()}")
+    print(f"{'mode':>8} | {'logins/s':>9} {'p50 ms':>9} {'p95 ms':>9} | {'max loop stall ms':>17}")
+    for mode in args.modes.split(","):
+        result = asyncio.run(run(mode, args.logins, args.concurrency))
+        print(f"{result['mode']:>8} | {result['logins_per_s']:>9.1f} {result['p50_ms']:>9.0f} "
+              f"{result['p95_ms']:>9.0f} | {result['max_stall_ms']:>17.0f}")
+    auth.shutdown_password_pool()
+
+
+if __name__ == "__main__":
+    main()
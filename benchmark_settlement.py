@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Settlement engine benchmark: Python loops vs NumPy arrays
+
+Builds synthetic groups of increasing size in a throwaway SQLite database,
+then times balance aggregation ("python" / "sql" / "numpy" modes) and
+transaction generation ("greedy" / "numpy" strategies), checking that every
+engine returns identical results.
+
+Usage: python benchmark_settlement.py [--sizes 10,100,1000] [--expenses-per-member 10] [--splits 5]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+_db_dir = tempfile.mkdtemp(prefix="settlement_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import insert
+
+from app import crud, models
+from app.database import Base, SessionLocal, engine
+
+
+def build_group(db, members: int, expenses_per_member: int, splits_per_expense: int, seed: int) -> int:
+    """Inserts one group with synthetic expenses, splits and payments; returns its id."""
+    rng = random.Random(seed)
+    user_ids = list(db.execute(
+        insert(models.User).returning(models.User.id),
+        [{"email": f"bench{seed}_{i}@example.com", "username": f"u{i}", "hashed_password": "x"} for i in range(members)]
+    ).scalars())
+    group = models.Group(name=f"bench-{members}", description="", admin_id=user_ids[0])
+    db.add(group)
+    db.flush()
+    db.execute(insert(models.GroupMember), [
+        {"group_id": group.id, "user_id": user_id, "is_admin": user_id == user_ids[0]} for user_id in user_ids
+    ])
+
+    expense_count = members * expenses_per_member
+    expense_ids = list(db.execute(insert(models.Expense).returning(models.Expense.id), [{
+        "description": "bench",
+        "amount": rng.randint(100, 50000),
+        "date": date(2024, 1, 1),
+        "group_id": group.id,
+        "creator_id": user_ids[0],
+        "payer_id": rng.choice(user_ids),
+        "split_type": "custom",
+    } for _ in range(expense_count)]).scalars())
+
+    amounts = dict(db.query(models.Expense.id, models.Expense.amount).filter(models.Expense.group_id == group.id).all())
+    split_rows, payment_rows = [], []
+    for expense_id in expense_ids:
+        participants = rng.sample(user_ids, min(splits_per_expense, members))
+        share, remainder = divmod(amounts[expense_id], len(participants))
+        for index, user_id in enumerate(participants):
+            split_rows.append({
+                "expense_id": expense_id, "user_id": user_id,
+                "amount": share + (1 if index < remainder else 0), "share_type": "custom", "balance": 0,
+            })
+        if rng.random() < 0.2:
+            from_user, to_user = rng.sample(user_ids, 2)
+            payment_rows.append({
+                "expense_id": expense_id, "from_user_id": from_user, "to_user_id": to_user,
+                "amount": rng.randint(1, 5000), "creator_id": from_user, "payment_date": date(2024, 1, 2),
+            })
+    db.execute(insert(models.ExpenseSplit), split_rows)
+    if payment_rows:
+        db.execute(insert(models.Payment), payment_rows)
+    db.commit()
+    return group.id
+
+
+def timed(func, *args, repeat: int = 3, **kwargs):
+    """Returns (best wall time in ms, result)."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000", help="comma separated member counts")
+    parser.add_argument("--expenses-per-member", type=int, default=10)
+    parser.add_argument("--splits", type=int, default=5, help="participants per expense")
+    args = parser.parse_args()
+
+    if crud.settlement_numpy is None:
+        print("numpy is not installed; nothing to compare")
+        sys.exit(1)
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+
+    header = f"{'members':>8} {'splits':>9} | {'python':>9} {'sql':>9} {'numpy':>9} | {'greedy':>9} {'numpy':>9} | transfers"
+    print("balance aggregation (ms)                     | transaction matching (ms)")
+    print(header)
+    print("-" * len(header))
+
+    for seed, members in enumerate(int(size) for size in args.sizes.split(",")):
+        group_id = build_group(db, members, args.expenses_per_member, args.splits, seed)
+        split_count = members * args.expenses_per_member * min(args.splits, members)
+
+        python_ms, python_balances = timed(crud._calculate_balances_from_history, db, group_id, repeat=1)
+        db.expunge_all()  # drop hydrated objects so they don't skew the next runs
+        sql_ms, sql_balances = timed(crud._calculate_balances_sql, db, group_id)
+        numpy_ms, numpy_balances = timed(crud._calculate_balances_numpy, db, group_id)
+        assert python_balances == sql_balances == numpy_balances, "balance engines disagree"
+
+        nets = list(python_balances.items())
+        greedy_ms, greedy_transfers = timed(crud._settle_greedy, nets)
+        vector_ms, vector_transfers = timed(crud._settle_numpy, nets)
+        assert greedy_transfers == vector_transfers, "transaction engines disagree"
+
+        print(f"{members:>8} {split_count:>9} | {python_ms:>9.1f} {sql_ms:>9.1f} {numpy_ms:>9.1f} | "
+              f"{greedy_ms:>9.2f} {vector_ms:>9.2f} | {len(greedy_transfers)}")
+
+    db.close()
+    print("\nall engines returned identical results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# conftest.py  shared fixtures: a throwaway SQLite database migrated to head
+#
+# DATABASE_URL (and the other settings read at import time) must be set before
+# anything imports app.database, so this runs first. Set TEST_DATABASE_URL to
+# run against an empty database of your own (e.g. Postgres) instead.
+import itertools
+import os
+import sys
+import tempfile
+
+_TMP_DIR = tempfile.mkdtemp(prefix="projectpg12-tests-")
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", f"sqlite:///{_TMP_DIR}/test.db")
+os.environ["UPLOAD_DIR"] = os.path.join(_TMP_DIR, "uploads")
+os.environ.setdefault("STORAGE_SIGNING_KEY", "test-signing-key")
+os.environ.setdefault("IMAGE_WORKERS", "0")
+os.environ.setdefault("RECURRING_SCHEDULER", "off")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from app import crud, models, schemas
+from app.database import SessionLocal
+from app.migrate import upgrade
+
+_unique = itertools.count(1)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    upgrade()
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def make_group(db):
+    """make_group(member_count) -> (group_id, [user ids]); the first user is the admin."""
+
+    def make(member_count: int = 3):
+        users = []
+        for _ in range(member_count):
+            n = next(_unique)
+            users.append(models.User(email=f"user{n}@test.local", username=f"user{n}", hashed_password="x"))
+        db.add_all(users)
+        db.commit()
+        user_ids = [user.id for user in users]
+        group = crud.create_group(db, schemas.GroupCreate(name=f"group{next(_unique)}"), user_ids[0])
+        for user_id in user_ids[1:]:
+            db.add(models.GroupMember(group_id=group.id, user_id=user_id))
+        db.commit()
+        return group.id, user_ids
+
+    return make
+
+
+@pytest.fixture
+def add_expense(db):
+    """add_expense(group_id, payer_id, amount, user_ids) -> Expense split equally between user_ids."""
+
+    def add(group_id: int, payer_id: int, amount: int, user_ids):
+        return crud.create_expense(db, group_id, payer_id, schemas.ExpenseCreateWithSplits(
+            description="test", amount=amount, payer_id=payer_id, split_type="equal",
+            splits=[{"user_id": user_id} for user_id in user_ids],
+        ))["expense"]
+
+    return add
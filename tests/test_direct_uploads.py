@@ -0,0 +1,34 @@
+# Without STORAGE_SIGNING_KEY the local backend turns direct uploads off
+# (user-022): both direct-upload routes answer 404, the rest of the app runs.
+import pytest
+from fastapi.testclient import TestClient
+
+from app import storage
+from app.dependencies import get_current_user
+from app.main import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_SIGNING_KEY", "")
+    monkeypatch.setattr(storage, "DIRECT_UPLOADS_ENABLED", False)
+    app.dependency_overrides[get_current_user] = lambda: None
+    try:
+        yield TestClient(app)
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+
+
+def test_presign_is_not_found(client):
+    response = client.post("/uploads/presign", json={"sha256": "ab" * 32, "size": 10, "content_type": "image/png"})
+    assert response.status_code == 404
+
+
+def test_direct_put_is_not_found_even_with_a_signature(client):
+    key = f"ab/{'ab' * 32}.png"
+    expires = 2 ** 40
+    signature = storage.hmac.new(b"", f"{key}|{expires}|1".encode(), storage.hashlib.sha256).hexdigest()
+    response = client.put(f"{storage.DIRECT_UPLOAD_PATH}/{key}",
+                          params={"expires": expires, "size": 1, "signature": signature}, content=b"x")
+    assert response.status_code == 404
+    assert not storage.verify_direct_upload(key, expires, 1, signature)
@@ -0,0 +1,125 @@
+# Query plan regression test for the hot read paths in app/crud.py (user-013)
+#
+# Runs the real crud functions, captures the SELECTs they emit and EXPLAINs
+# each one. A path fails if any statement scans one of the large tables
+# instead of using an index, or sorts expenses / audit logs instead of
+# reading them in index order.
+#
+# SQLite: EXPLAIN QUERY PLAN, "SCAN <table>" without an index is a full scan.
+# Postgres (TEST_DATABASE_URL): EXPLAIN with enable_seqscan off, "Seq Scan on
+# <table>" means no usable index exists (small tables would otherwise always
+# seq scan).
+import re
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from app import crud, models
+from app.database import SessionLocal, engine
+
+# tables that grow with usage; a full scan of any of these is a regression
+LARGE_TABLES = (
+    "expenses", "expense_splits", "payments", "audit_logs",
+    "group_members", "recurring_expenses", "group_invitations",
+)
+# statements whose ORDER BY must be served by the index
+SORTED_TABLES = ("expenses", "audit_logs")
+
+HOT_PATHS = {
+    "get_group_expenses": lambda db, ids: crud.get_group_expenses(db, ids["group"]),
+    "get_audit_logs": lambda db, ids: crud.get_audit_logs(db, ids["group"]),
+    "get_audit_logs_page (cursor)": lambda db, ids: crud.get_audit_logs_page(
+        db, ids["group"], limit=10, user_id=ids["user"],
+        cursor=crud.encode_audit_cursor("2100-01-01 00:00:00", 10 ** 9),
+    ),
+    "get_group_members": lambda db, ids: crud.get_group_members(db, ids["group"]),
+    "get_user_groups": lambda db, ids: crud.get_user_groups(db, ids["user"]),
+    "get_expense_payments": lambda db, ids: crud.get_expense_payments(db, ids["expense"]),
+    "get_pending_invitations_for_user": lambda db, ids: crud.get_pending_invitations_for_user(db, ids["user"]),
+    "get_group_recurring_expenses": lambda db, ids: crud.get_group_recurring_expenses(db, ids["group"]),
+    "process_due_recurring_expenses": lambda db, ids: crud.process_due_recurring_expenses(db),
+    "settlement balances (sql)": lambda db, ids: crud._calculate_balances_sql(db, ids["group"]),
+}
+
+
+@pytest.fixture(scope="module")
+def seeded_ids():
+    """Minimal rows so every hot path emits its queries."""
+    with SessionLocal() as db:
+        users = [models.User(email=f"plans{i}@test.local", username=f"plans{i}", hashed_password="x") for i in range(2)]
+        db.add_all(users)
+        db.flush()
+        group = models.Group(name="plans", description="", admin_id=users[0].id)
+        db.add(group)
+        db.flush()
+        db.add_all([models.GroupMember(group_id=group.id, user_id=user.id) for user in users])
+        expense = models.Expense(description="e", amount=100, date=date.today(), group_id=group.id,
+                                 creator_id=users[0].id, payer_id=users[0].id)
+        db.add(expense)
+        db.flush()
+        db.add(models.ExpenseSplit(expense_id=expense.id, user_id=users[1].id, amount=100))
+        db.add(models.Payment(expense_id=expense.id, from_user_id=users[1].id, to_user_id=users[0].id,
+                              amount=50, creator_id=users[1].id))
+        db.add(models.AuditLog(group_id=group.id, user_id=users[0].id, action="SEED", details={}))
+        db.add(models.RecurringExpense(description="r", amount=100, frequency="monthly",
+                                       start_date=date.today() + timedelta(days=30),
+                                       next_due_date=date.today() + timedelta(days=30),
+                                       group_id=group.id, creator_id=users[0].id, payer_id=users[0].id))
+        db.commit()
+        return {"group": group.id, "user": users[0].id, "expense": expense.id}
+
+
+@contextmanager
+def capture_selects():
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")) and not executemany:
+            captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        yield captured
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+
+def explain(connection, statement, parameters):
+    if engine.dialect.name == "sqlite":
+        return [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+    return [row[0] for row in connection.exec_driver_sql("EXPLAIN " + statement, parameters)]
+
+
+def problems_in(plan, statement):
+    found = []
+    for line in plan:
+        for table in LARGE_TABLES:
+            if engine.dialect.name == "sqlite":
+                # "SCAN expenses" / "SCAN expenses AS e" without "USING ... INDEX"
+                if re.search(rf"\bSCAN {table}\b(?! USING)", line) and "INDEX" not in line:
+                    found.append(f"full scan of {table}: {line}")
+            elif re.search(rf"Seq Scan on {table}\b", line):
+                found.append(f"full scan of {table}: {line.strip()}")
+    first_from = re.search(r"\bFROM (\w+)", statement)
+    if first_from and first_from.group(1) in SORTED_TABLES and "ORDER BY" in statement:
+        if any("TEMP B-TREE FOR ORDER BY" in line or line.strip().startswith("Sort ") for line in plan):
+            found.append(f"{first_from.group(1)} sorted in memory instead of read in index order")
+    return found
+
+
+@pytest.mark.parametrize("name", list(HOT_PATHS))
+def test_hot_path_uses_indexes(seeded_ids, name):
+    with SessionLocal() as db:
+        with capture_selects() as captured:
+            HOT_PATHS[name](db, seeded_ids)
+        db.rollback()
+
+    assert captured, f"{name} emitted no SELECT"
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            connection.exec_driver_sql("SET enable_seqscan = off")
+        issues = [issue for statement, parameters in captured
+                  for issue in problems_in(explain(connection, statement, parameters), statement)]
+    assert not issues, "\n".join(issues)
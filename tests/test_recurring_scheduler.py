@@ -0,0 +1,40 @@
+# A template that stays due after its run (user-023) is retried with a
+# backoff that doubles up to RECURRING_RESYNC_S, and reset once it advances.
+import asyncio
+from datetime import date, datetime, timedelta
+
+from app import recurring_scheduler
+from app.recurring_scheduler import RecurringScheduler
+
+
+def _run_due(scheduler, template_id, next_due_dates):
+    """Runs one _run_due for `template_id`; _load answers from next_due_dates (before, after)."""
+    answers = iter(next_due_dates)
+    scheduler._load = lambda template_ids=None: {template_id: next(answers)}
+    scheduler._process = lambda template_ids: None
+    asyncio.run(scheduler._run_due([template_id]))
+    return (scheduler._due[template_id] - datetime.now()).total_seconds()
+
+
+def test_failing_template_backs_off_up_to_the_resync_interval(monkeypatch):
+    monkeypatch.setattr(recurring_scheduler, "RECURRING_RETRY_S", 60)
+    monkeypatch.setattr(recurring_scheduler, "RECURRING_RESYNC_S", 300)
+    scheduler = RecurringScheduler()
+    stuck = date.today() - timedelta(days=1)
+
+    delays = [_run_due(scheduler, 7, [stuck, stuck]) for _ in range(5)]
+    assert [round(delay / 10) * 10 for delay in delays] == [60, 120, 240, 300, 300]
+
+    tomorrow = date.today() + timedelta(days=1)
+    _run_due(scheduler, 7, [stuck, tomorrow])
+    assert scheduler._due[7] == recurring_scheduler.due_at(tomorrow)
+    assert 7 not in scheduler._retry
+
+
+def test_catch_up_batch_that_advanced_runs_again_immediately():
+    scheduler = RecurringScheduler()
+    behind = date.today() - timedelta(days=30)
+
+    _run_due(scheduler, 3, [behind, behind + timedelta(days=10)])
+    assert scheduler._due[3] == recurring_scheduler.due_at(behind + timedelta(days=10))
+    assert 3 not in scheduler._retry
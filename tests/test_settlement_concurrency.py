@@ -0,0 +1,36 @@
+# Concurrent settlements of one group (user-005): the balances are read under
+# the group lock, so only the first settles and the second finds nothing to do.
+import threading
+
+from app import crud, models
+from app.database import SessionLocal
+
+
+def test_concurrent_settlements_settle_once(db, make_group, add_expense):
+    group_id, user_ids = make_group(4)
+    for payer_id in user_ids[:2]:
+        add_expense(group_id, payer_id, 12000, user_ids)
+    barrier = threading.Barrier(2)
+    outcomes = []
+
+    def settle():
+        session = SessionLocal()
+        try:
+            barrier.wait()
+            crud.execute_settlement(session, group_id, user_ids[0])
+            outcomes.append("settled")
+        except ValueError:
+            outcomes.append("nothing to settle")
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=settle) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(outcomes) == ["nothing to settle", "settled"]
+    balances = crud.get_group_member_balances(db, group_id)
+    assert set(balances.values()) == {0}
+    assert db.query(models.Payment).join(models.Expense).filter(models.Expense.group_id == group_id).count() > 0
@@ -0,0 +1,73 @@
+# The NumPy engine (user-007) must agree exactly with the Python reference:
+# the same balances from the same history, the same greedy transfers.
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from app import crud, schemas, settlement_numpy
+
+
+def _random_history(db, rng, group_id, user_ids, expenses):
+    for _ in range(expenses):
+        amount = rng.randint(1, 50000)
+        participants = rng.sample(user_ids, rng.randint(1, len(user_ids)))
+        cuts = sorted(rng.randint(0, amount) for _ in range(len(participants) - 1))
+        shares = [high - low for low, high in zip([0] + cuts, cuts + [amount])]
+        expense = crud.create_expense(db, group_id, user_ids[0], schemas.ExpenseCreateWithSplits(
+            description="random", amount=amount, payer_id=rng.choice(user_ids), split_type="custom",
+            splits=[{"user_id": user_id, "amount": share} for user_id, share in zip(participants, shares)],
+        ))["expense"]
+        if rng.random() < 0.3:
+            from_user_id, to_user_id = rng.sample(user_ids, 2)
+            crud.create_payment(db, expense.id, from_user_id, schemas.PaymentCreate(
+                from_user_id=from_user_id, to_user_id=to_user_id, amount=rng.randint(1, 5000),
+            ))
+
+
+def _nonzero(balances):
+    return {user_id: balance for user_id, balance in balances.items() if balance}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_numpy_balances_match_python(db, make_group, seed):
+    rng = random.Random(seed)
+    group_id, user_ids = make_group(rng.randint(2, 15))
+    _random_history(db, rng, group_id, user_ids, expenses=20)
+    # the numpy and sql modes start from the latest checkpoint: cover history on both sides of one
+    crud.create_settlement_checkpoint(db, group_id, created_by=user_ids[0])
+    _random_history(db, rng, group_id, user_ids, expenses=10)
+
+    reference = crud._calculate_balances_from_history(db, group_id)
+    assert crud._calculate_balances_numpy(db, group_id) == reference
+    assert _nonzero(crud._calculate_balances_sql(db, group_id)) == _nonzero(reference)
+    assert _nonzero(crud.get_group_member_balances(db, group_id)) == _nonzero(reference)
+
+
+def _random_nets(rng, members):
+    balances = [rng.choice([rng.randint(-20000, 20000), rng.randint(-3, 3)]) for _ in range(members - 1)]
+    balances.append(-sum(balances))
+    user_ids = rng.sample(range(1, 10 * members), members)
+    return list(zip(user_ids, balances))
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_numpy_transfers_match_greedy(seed):
+    rng = random.Random(seed)
+    nets = _random_nets(rng, rng.randint(1, 60))
+
+    expected = crud._settle_greedy(nets)
+    vectorized = settlement_numpy.greedy_transfers(nets)
+
+    assert vectorized is None or vectorized == expected
+    assert crud._settle_numpy(nets) == expected
+
+
+def test_numpy_strategy_matches_greedy_summary():
+    rng = random.Random(1234)
+    nets = _random_nets(rng, 40)
+    balances = [{"user_id": user_id, "final_balance": balance} for user_id, balance in nets]
+
+    assert crud.generate_settlement_transactions(balances, strategy="numpy") == \
+        crud.generate_settlement_transactions(balances, strategy="greedy")
@@ -0,0 +1,64 @@
+# Settlement summaries load their data once (user-003): the statement count
+# must not grow with the number of members, expenses or payments.
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from app import crud
+from app.database import engine
+
+# group, members (users joined), balances, total spend; "sql" reads the latest checkpoint, then aggregates
+SETTLEMENT_SUMMARY_MAX_STATEMENTS = {"ledger": 4, "sql": 5}
+
+
+@contextmanager
+def count_statements():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def _summary_statements(db, group_id, mode):
+    db.expire_all()  # nothing may come from the identity map
+    with count_statements() as statements:
+        summary = crud.get_group_settlement_summary(db, group_id, mode=mode)
+    return summary, statements
+
+
+@pytest.mark.parametrize("mode", ["ledger", "sql"])
+def test_settlement_summary_statement_count_is_bounded(db, make_group, add_expense, mode):
+    small_group, small_users = make_group(3)
+    add_expense(small_group, small_users[0], 900, small_users)
+
+    large_group, large_users = make_group(12)
+    for i in range(40):
+        add_expense(large_group, large_users[i % 12], 1000 + i, large_users[: 2 + i % 10])
+
+    small_summary, small_statements = _summary_statements(db, small_group, mode)
+    large_summary, large_statements = _summary_statements(db, large_group, mode)
+
+    assert len(small_summary["balances"]) == 3
+    assert len(large_summary["balances"]) == 12
+    assert len(large_statements) <= SETTLEMENT_SUMMARY_MAX_STATEMENTS[mode], large_statements
+    assert len(large_statements) == len(small_statements)
+
+
+def test_settlement_summary_is_built_without_the_database(db, make_group, add_expense):
+    group_id, user_ids = make_group(4)
+    add_expense(group_id, user_ids[1], 1200, user_ids)
+    context = crud.load_settlement_context(db, group_id)
+
+    with count_statements() as statements:
+        summary = crud.build_settlement_summary(context)
+
+    assert statements == []
+    assert sum(balance["balance"] for balance in summary["balances"]) == 0
+    assert summary["transactions"]
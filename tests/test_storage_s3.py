@@ -0,0 +1,78 @@
+# S3Storage (user-022) against moto: the direct upload round trip a client
+# makes (presign, PUT, image_key) and the calls gc / responses rely on.
+import hashlib
+
+import pytest
+
+pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+requests = pytest.importorskip("requests")
+
+from app import storage, uploads
+
+BUCKET = "receipts-test"
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 120
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        backend = storage.S3Storage(bucket=BUCKET, prefix="receipts/", endpoint_url=None, region="us-east-1")
+        backend.client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(storage, "_storage", backend)
+        yield backend
+
+
+def _presigned_put(db, body: bytes):
+    sha256 = hashlib.sha256(body).hexdigest()
+    presigned = uploads.presign(db, sha256, len(body), "image/png")
+    upload = presigned["upload"]
+    assert upload["method"] == "PUT"
+    response = requests.put(upload["url"], data=body, headers=upload["headers"])
+    assert response.status_code == 200, response.text
+    return presigned["key"]
+
+
+def test_presigned_put_then_check_stored(db, s3):
+    key = _presigned_put(db, PNG)
+
+    stored = uploads.check_stored(key)
+    assert (stored.key, stored.size, stored.kind) == (key, len(PNG), "png")
+    assert s3.client.head_object(Bucket=BUCKET, Key="receipts/" + key)["ContentType"] == "image/png"
+    # stored already: no second upload
+    assert uploads.presign(db, stored.sha256, len(PNG), "image/png")["upload"] is None
+
+
+def test_check_stored_rejects_missing_and_mistyped_objects(db, s3):
+    with pytest.raises(uploads.UploadRejected):
+        uploads.check_stored(f"ab/{'ab' * 32}.png")
+    text = b"not an image at all"
+    sha256 = hashlib.sha256(text).hexdigest()
+    key = f"{sha256[:2]}/{sha256}.png"
+    s3.client.put_object(Bucket=BUCKET, Key="receipts/" + key, Body=text)
+    with pytest.raises(uploads.UploadRejected):
+        uploads.check_stored(key)
+
+
+def test_download_url_serves_the_object_and_maps_back_to_its_key(db, s3):
+    key = _presigned_put(db, PNG)
+
+    url = s3.download_url(key)
+    assert requests.get(url).content == PNG
+    assert storage.key_from_value(url) == key
+    assert uploads.content_hash(url) == hashlib.sha256(PNG).hexdigest()
+    assert storage.key_from_value("https://example.com/receipts/" + key) is None
+
+
+def test_delete_prefix_removes_the_original_and_its_variants(s3):
+    sha256 = "cd" * 32
+    keys = [f"cd/{sha256}.jpg", f"cd/{sha256}.thumb.webp", f"cd/{sha256}.display.jpg"]
+    for key in keys + [f"cd/{'ce' * 32}.jpg"]:
+        s3.client.put_object(Bucket=BUCKET, Key="receipts/" + key, Body=b"x")
+
+    assert s3.delete_prefix(f"cd/{sha256}") == 3
+    assert not any(s3.exists(key) for key in keys)
+    assert s3.exists(f"cd/{'ce' * 32}.jpg")